@@ -0,0 +1,350 @@
+"""
+A two tier cache for message content.
+
+Messages, and snapshots of the messageset lengths and graph, are stored in the shared
+(redis) cache, so that they survive worker processes being recycled, with a
+small process local LRU in front of it to avoid a round trip for the hottest
+content.
+
+All keys include a content version, which is replaced whenever a Message,
+MessageSet, BinaryContent, or Schedule changes. Replacing the version invalidates both
+tiers at once: this process' local tier is cleared immediately, other
+processes notice the new version within CONTENT_CACHE_VERSION_CHECK_INTERVAL
+seconds, and the old shared entries are never read again and expire.
+"""
+import time
+from collections import OrderedDict
+from functools import reduce
+from operator import or_
+from threading import RLock
+from uuid import uuid4
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db.models import Count, Q
+
+from contentstore import cron
+from contentstore.models import Message, MessageSet, Schedule
+from seed_stage_based_messaging.instrumentation import CONTENT_CACHE_LOOKUPS
+
+VERSION_KEY = "content_version"
+MESSAGESET_LENGTHS_KEY = "messageset_lengths"
+MESSAGESET_GRAPH_KEY = "messageset_graph"
+
+
+class LocalLRUCache(object):
+    """
+    A thread safe, size bounded, least recently used cache, local to the
+    process.
+    """
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = RLock()
+
+    def get_many(self, keys):
+        found = {}
+        with self.lock:
+            for key in keys:
+                if key in self.entries:
+                    self.entries.move_to_end(key)
+                    found[key] = self.entries[key]
+        return found
+
+    def set_many(self, data):
+        with self.lock:
+            for key, value in data.items():
+                self.entries[key] = value
+                self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+def record_lookups(keys, result):
+    """
+    Counts the lookups of keys in the content cache, by the kind of content,
+    which is the first part of the key.
+    """
+    kinds = {}
+    for key in keys:
+        kind = key.split(":", 1)[0]
+        kinds[kind] = kinds.get(kind, 0) + 1
+    for kind, count in kinds.items():
+        CONTENT_CACHE_LOOKUPS.labels(kind, result).inc(count)
+
+
+class ContentCache(object):
+    def __init__(self, shared_cache, max_local_entries, version_check_interval):
+        self.shared = shared_cache
+        self.local = LocalLRUCache(max_local_entries)
+        self.version_check_interval = version_check_interval
+        self._version = None
+        self._version_checked = 0
+
+    @property
+    def version(self):
+        """
+        The current content version. The shared cache is only checked every
+        version_check_interval seconds, and the local tier is cleared if the
+        version has changed.
+        """
+        if (
+            self._version is None
+            or time.monotonic() - self._version_checked >= self.version_check_interval
+        ):
+            self.refresh()
+        return self._version
+
+    def _set_version(self, version):
+        if version != self._version:
+            self.local.clear()
+            self._version = version
+        self._version_checked = time.monotonic()
+
+    def refresh(self):
+        """
+        Checks the shared cache for a new content version now, instead of
+        waiting for version_check_interval to pass.
+        """
+        version = self.shared.get(VERSION_KEY)
+        if version is None:
+            self.shared.add(VERSION_KEY, uuid4().hex, timeout=None)
+            version = self.shared.get(VERSION_KEY)
+        self._set_version(version)
+        return self._version
+
+    def invalidate(self):
+        """
+        Invalidates all cached content, in this process and in all others
+        """
+        version = uuid4().hex
+        self.shared.set(VERSION_KEY, version, timeout=None)
+        self._set_version(version)
+
+    def get_many(self, keys, fetch):
+        """
+        Gets the values for keys, first from the local tier, then from the
+        shared tier. The keys that are in neither are passed to fetch, which
+        should return a dict of the values that it could find.
+        """
+        version = self.version
+        cache_keys = {"{}:{}".format(version, key): key for key in keys}
+        cached = self.local.get_many(cache_keys)
+        record_lookups((cache_keys[k] for k in cached), "local")
+
+        missing = [cache_key for cache_key in cache_keys if cache_key not in cached]
+        if missing:
+            shared = self.shared.get_many(missing)
+            self.local.set_many(shared)
+            cached.update(shared)
+            record_lookups((cache_keys[k] for k in shared), "shared")
+
+        values = {cache_keys[cache_key]: value for cache_key, value in cached.items()}
+        missing = [key for key in keys if key not in values]
+        if missing:
+            record_lookups(missing, "miss")
+            found = fetch(missing)
+            data = {"{}:{}".format(version, key): value for key, value in found.items()}
+            self.shared.set_many(data, timeout=settings.CONTENT_CACHE_TIMEOUT)
+            self.local.set_many(data)
+            values.update(found)
+
+        return values
+
+
+content_cache = ContentCache(
+    caches["redis"],
+    max_local_entries=settings.CONTENT_CACHE_LOCAL_MAX_ENTRIES,
+    version_check_interval=settings.CONTENT_CACHE_VERSION_CHECK_INTERVAL,
+)
+
+
+def _message_key(messageset_id, sequence_number, lang):
+    return "message:{}:{}:{}".format(messageset_id, sequence_number, lang)
+
+
+def _fetch_messages(cache_keys, keys):
+    query = reduce(
+        or_,
+        (
+            Q(messageset_id=messageset_id, sequence_number=sequence_number, lang=lang)
+            for messageset_id, sequence_number, lang in keys
+        ),
+    )
+    return {
+        cache_keys[
+            (message.messageset_id, message.sequence_number, message.lang)
+        ]: message
+        for message in Message.objects.filter(query).select_related("binary_content")
+    }
+
+
+def get_messages(keys):
+    """
+    Gets the messages for each of the (messageset_id, sequence_number, lang)
+    tuples in keys. Messages that aren't cached are fetched in a single query.
+
+    Returns a dict of key to Message. Keys that don't have a matching message
+    are left out.
+    """
+    keys = set(keys)
+    cache_keys = {key: _message_key(*key) for key in keys}
+    lookup = {cache_key: key for key, cache_key in cache_keys.items()}
+
+    def fetch(missing):
+        return _fetch_messages(cache_keys, [lookup[cache_key] for cache_key in missing])
+
+    messages = content_cache.get_many(list(lookup), fetch)
+    return {lookup[cache_key]: message for cache_key, message in messages.items()}
+
+
+def get_message(messageset_id, sequence_number, lang):
+    """
+    Gets a single message from the cache, raising Message.DoesNotExist if
+    there is no such message.
+    """
+    key = (messageset_id, sequence_number, lang)
+    try:
+        return get_messages([key])[key]
+    except KeyError:
+        raise Message.DoesNotExist(
+            "Message matching query does not exist: %s %s %s" % key
+        )
+
+
+def get_messageset_lengths():
+    """
+    Gets a snapshot of the number of messages in every messageset, for every
+    language, counted in a single query when it isn't cached.
+
+    The snapshot is cached as a single entry, so that it can be kept in the
+    local tier, and it's replaced along with the rest of the content whenever
+    a message is added or removed.
+
+    Returns a dict of (messageset_id, lang) to message count. Messagesets
+    without any messages in a language are left out.
+    """
+
+    def fetch(missing):
+        counts = (
+            Message.objects.order_by()
+            .values_list("messageset_id", "lang")
+            .annotate(count=Count("id"))
+        )
+        return {
+            MESSAGESET_LENGTHS_KEY: {
+                (messageset_id, lang): count for messageset_id, lang, count in counts
+            }
+        }
+
+    return content_cache.get_many([MESSAGESET_LENGTHS_KEY], fetch)[
+        MESSAGESET_LENGTHS_KEY
+    ]
+
+
+def get_messageset_sizes(keys):
+    """
+    Gets the number of messages for each of the (messageset_id, lang) tuples in
+    keys, from the messageset lengths snapshot.
+
+    Returns a dict of key to message count.
+    """
+    lengths = get_messageset_lengths()
+    return {key: lengths.get(key, 0) for key in set(keys)}
+
+
+class MessageSetGraph(object):
+    """
+    A snapshot of all of the messagesets, the next_set chains between them,
+    their default schedules, and their lengths in each language, so that
+    subscription lifecycles can be walked without a query for every hop.
+
+    The snapshot is cached, so it shouldn't be modified.
+    """
+
+    def __init__(self, messagesets, cron_strings, lengths):
+        # messageset_id: (next_set_id, default_schedule_id)
+        self._messagesets = messagesets
+        # schedule_id: cron_string
+        self._cron_strings = cron_strings
+        # (messageset_id, lang): message count
+        self._lengths = lengths
+
+    def __contains__(self, messageset_id):
+        return messageset_id in self._messagesets
+
+    def has_schedule(self, schedule_id):
+        return schedule_id in self._cron_strings
+
+    def next_set(self, messageset_id):
+        """
+        Returns the ID of the messageset after this one, or None
+        """
+        return self._messagesets[messageset_id][0]
+
+    def default_schedule(self, messageset_id):
+        return self._messagesets[messageset_id][1]
+
+    def cron_string(self, schedule_id):
+        return self._cron_strings[schedule_id]
+
+    def length(self, messageset_id, lang):
+        return self._lengths.get((messageset_id, lang), 0)
+
+    def last_run_date(self, messageset_id, schedule_id, lang, start, initial=None):
+        """
+        Returns the last of the dates that MessageSet.get_all_run_dates would
+        return, or None if there aren't any.
+        """
+        initial = initial if initial else 1
+        return cron.get_nth_run_time(
+            self.cron_string(schedule_id),
+            start,
+            self.length(messageset_id, lang) - initial + 1,
+        )
+
+
+def _fetch_messageset_graph(missing):
+    return {
+        MESSAGESET_GRAPH_KEY: MessageSetGraph(
+            messagesets={
+                messageset_id: (next_set_id, default_schedule_id)
+                for messageset_id, next_set_id, default_schedule_id in (
+                    MessageSet.objects.values_list(
+                        "id", "next_set_id", "default_schedule_id"
+                    )
+                )
+            },
+            cron_strings={
+                schedule.id: schedule.cron_string for schedule in Schedule.objects.all()
+            },
+            lengths=get_messageset_lengths(),
+        )
+    }
+
+
+def get_messageset_graph(messageset_id=None, schedule_id=None):
+    """
+    Gets the MessageSetGraph snapshot, which is loaded in three queries when it
+    isn't cached.
+
+    If a messageset_id or schedule_id is given that isn't in the snapshot,
+    then it may have been created in another process since this process last
+    checked the content version, so the version is checked again.
+    """
+    graph = content_cache.get_many([MESSAGESET_GRAPH_KEY], _fetch_messageset_graph)[
+        MESSAGESET_GRAPH_KEY
+    ]
+    if (messageset_id is not None and messageset_id not in graph) or (
+        schedule_id is not None and not graph.has_schedule(schedule_id)
+    ):
+        content_cache.refresh()
+        graph = content_cache.get_many([MESSAGESET_GRAPH_KEY], _fetch_messageset_graph)[
+            MESSAGESET_GRAPH_KEY
+        ]
+    return graph
@@ -0,0 +1,325 @@
+"""
+An index of the run times of cron expressions.
+
+Walking croniter one run at a time is slow, and the subscription lifecycle
+calculations ask for the runs of the same few schedules over and over. Each
+cron expression gets a sorted list of its run times, as UTC timestamps, over a
+window that grows as it is queried, so that counting or listing the runs
+between two datetimes is a bisect instead of an iteration.
+
+Simple expressions, with lists or ranges of minutes, hours, and days of the
+week, on every day of the month and every month, don't need the index at
+all. Their runs can be counted arithmetically, see ClosedFormCounter.
+
+The index and counter are only used for datetimes that are naive, which are treated as
+UTC, or that have a fixed zero UTC offset. For any other timezone croniter
+would apply daylight saving rules, so those still iterate croniter directly.
+"""
+from bisect import bisect_right
+from datetime import datetime, timedelta
+from threading import Lock
+
+import pytz
+from croniter import CroniterBadDateError, croniter
+
+# How far ahead, in seconds, to look for runs before giving up, for cron
+# expressions that rarely or never run, such as on the 30th of February
+MAX_SEARCH_SPAN = timedelta(days=3653).total_seconds()
+
+# The number of run times that each index keeps. Once there are more, the
+# segments that were used least recently are dropped.
+MAX_INDEX_TIMES = 200000
+
+
+def is_utc(dt):
+    return dt.tzinfo is None or dt.tzinfo.utcoffset(None) == timedelta(0)
+
+
+def to_timestamp(dt):
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=pytz.UTC)
+    return dt.timestamp()
+
+
+def from_timestamp(timestamp, tzinfo):
+    if tzinfo is None:
+        return datetime.utcfromtimestamp(timestamp)
+    return datetime.fromtimestamp(timestamp, tzinfo)
+
+
+class CronIndex(object):
+    """
+    The sorted run times of a cron expression.
+
+    The index is made up of disjoint segments, each a list of
+    [start, end, times, used], where times are all of the runs after start, up
+    to and including end, and used is when the segment was last queried.
+    Segments are generated as they are queried, and merged when they meet, so
+    a query far from the rest doesn't have to fill in the gap. The least
+    recently used segments are dropped once the index holds more than
+    MAX_INDEX_TIMES runs.
+    """
+
+    def __init__(self, cron_string):
+        self.cron_string = cron_string
+        self.segments = []
+        self.queries = 0
+        self.lock = Lock()
+
+    def _generate(self, start, end):
+        times = []
+        try:
+            for timestamp in croniter(self.cron_string, start):
+                if timestamp > end:
+                    break
+                times.append(timestamp)
+        except CroniterBadDateError:
+            # There are no more runs
+            pass
+        return times
+
+    def _cover(self, start, end):
+        """
+        Extends the index to cover all of the runs after start, up to and
+        including end, and returns the run times of the segment that covers
+        them.
+        """
+        segments, pieces = [], []
+        merged_start, cursor = start, start
+        for segment in self.segments:
+            segment_start, segment_end, times, _ = segment
+            if segment_end < start or segment_start > end:
+                segments.append(segment)
+                continue
+            if segment_start > cursor:
+                pieces.append(self._generate(cursor, segment_start))
+            pieces.append(times)
+            merged_start = min(merged_start, segment_start)
+            cursor = max(cursor, segment_end)
+        if cursor < end:
+            pieces.append(self._generate(cursor, end))
+            cursor = end
+
+        times = (
+            pieces[0] if len(pieces) == 1 else [t for piece in pieces for t in piece]
+        )
+        self.queries += 1
+        segment = [merged_start, cursor, times, self.queries]
+        size = len(times) + sum(len(s[2]) for s in segments)
+        for unused in sorted(segments, key=lambda s: s[3]):
+            if size <= MAX_INDEX_TIMES:
+                break
+            segments.remove(unused)
+            size -= len(unused[2])
+        segments.append(segment)
+        segments.sort(key=lambda segment: segment[0])
+        self.segments = segments
+        return times
+
+    def between(self, start, end):
+        """
+        Returns the run timestamps after start, up to and including end
+        """
+        if end <= start:
+            return []
+        with self.lock:
+            times = self._cover(start, end)
+            first = bisect_right(times, start)
+            last = bisect_right(times, end)
+            return times[first:last]
+
+    def count(self, start, end):
+        """
+        Returns the number of runs after start, up to and including end
+        """
+        if end <= start:
+            return 0
+        with self.lock:
+            times = self._cover(start, end)
+            return bisect_right(times, end) - bisect_right(times, start)
+
+    def first(self, start, n):
+        """
+        Returns the timestamps of the first n runs after start, or as many as
+        there are within MAX_SEARCH_SPAN of start.
+        """
+        if n <= 0:
+            return []
+        span = timedelta(days=1).total_seconds()
+        with self.lock:
+            while True:
+                span = min(span, MAX_SEARCH_SPAN)
+                times = self._cover(start, start + span)
+                first = bisect_right(times, start)
+                last = first + n
+                if len(times) >= last or span >= MAX_SEARCH_SPAN:
+                    return times[first:last]
+                span *= 2
+
+
+def parse_field(value, low, high):
+    """
+    Parses a numeric cron field, made up of comma separated values, ranges,
+    and steps, into the set of values that it matches. Returns None for
+    anything else, such as names or the L and W modifiers.
+    """
+    values = set()
+    for part in value.split(","):
+        part, _, step = part.partition("/")
+        if part == "*":
+            first, last = low, high
+        elif "-" in part:
+            first, _, last = part.partition("-")
+            if not first.isdigit() or not last.isdigit():
+                return None
+            first, last = int(first), int(last)
+        elif part.isdigit():
+            first = last = int(part)
+            if step:
+                last = high
+        else:
+            return None
+        if step and not step.isdigit():
+            return None
+        step = int(step) if step else 1
+        if step == 0 or first < low or last > high or first > last:
+            return None
+        values.update(range(first, last + 1, step))
+    return values
+
+
+class ClosedFormCounter(object):
+    """
+    Counts the runs of a cron expression that runs at fixed times on fixed
+    days of the week, without iterating over the runs.
+
+    The number of runs up to a time is the number of matching days before
+    that day, times the number of runs per day, plus the runs earlier on that
+    day. The days are counted from 1970-01-01, which was a Thursday.
+    """
+
+    def __init__(self, minutes, hours, days_of_week):
+        self.times = sorted(h * 3600 + m * 60 for h in hours for m in minutes)
+        self.days_of_week = days_of_week
+        # The number of matching days in the first n days of each week
+        self.days_before = [0]
+        for day in range(7):
+            self.days_before.append(
+                self.days_before[-1] + ((day + 4) % 7 in days_of_week)
+            )
+
+    @classmethod
+    def from_cron_string(cls, cron_string):
+        """
+        Returns a counter for the cron expression, or None if it isn't simple
+        enough to count arithmetically.
+        """
+        fields = cron_string.split()
+        if len(fields) != 5:
+            return None
+        minute, hour, day_of_month, month, day_of_week = fields
+        if day_of_month != "*" or month != "*":
+            return None
+        minutes = parse_field(minute, 0, 59)
+        hours = parse_field(hour, 0, 23)
+        days_of_week = parse_field(day_of_week, 0, 7)
+        if minutes is None or hours is None or days_of_week is None:
+            return None
+        if 7 in days_of_week:
+            days_of_week = (days_of_week - {7}) | {0}
+        return cls(minutes, hours, days_of_week)
+
+    def runs_until(self, timestamp):
+        """
+        Returns the number of runs from 1970-01-01 up to and including
+        timestamp, which is negative for earlier timestamps.
+        """
+        day = int(timestamp // 86400)
+        weeks, day_of_week = divmod(day, 7)
+        days = weeks * self.days_before[7] + self.days_before[day_of_week]
+        runs = days * len(self.times)
+        if (day + 4) % 7 in self.days_of_week:
+            runs += bisect_right(self.times, timestamp - day * 86400)
+        return runs
+
+    def count(self, start, end):
+        """
+        Returns the number of runs after start, up to and including end
+        """
+        if end <= start:
+            return 0
+        return self.runs_until(end) - self.runs_until(start)
+
+
+_counters = {}
+
+
+def get_closed_form_counter(cron_string):
+    if cron_string not in _counters:
+        _counters[cron_string] = ClosedFormCounter.from_cron_string(cron_string)
+    return _counters[cron_string]
+
+
+_indexes = {}
+_indexes_lock = Lock()
+
+
+def get_cron_index(cron_string):
+    with _indexes_lock:
+        if cron_string not in _indexes:
+            _indexes[cron_string] = CronIndex(cron_string)
+        return _indexes[cron_string]
+
+
+def get_run_times_between(cron_string, start, end):
+    """
+    Returns the datetimes, in start's timezone, of the runs after start, up to
+    and including end.
+    """
+    if not is_utc(start):
+        dates = []
+        for dt in croniter(cron_string, start, ret_type=datetime):
+            if dt > end:
+                break
+            dates.append(dt)
+        return dates
+    return [
+        from_timestamp(timestamp, start.tzinfo)
+        for timestamp in get_cron_index(cron_string).between(
+            to_timestamp(start), to_timestamp(end)
+        )
+    ]
+
+
+def count_run_times_between(cron_string, start, end):
+    """
+    Returns the number of runs after start, up to and including end
+    """
+    if not is_utc(start):
+        return len(get_run_times_between(cron_string, start, end))
+    counter = get_closed_form_counter(cron_string) or get_cron_index(cron_string)
+    return counter.count(to_timestamp(start), to_timestamp(end))
+
+
+def get_first_run_times(cron_string, start, n):
+    """
+    Returns the datetimes, in start's timezone, of the first n runs after start
+    """
+    if not is_utc(start):
+        iterator = croniter(cron_string, start, ret_type=datetime)
+        return [iterator.get_next() for _ in range(max(n, 0))]
+    return [
+        from_timestamp(timestamp, start.tzinfo)
+        for timestamp in get_cron_index(cron_string).first(to_timestamp(start), n)
+    ]
+
+
+def get_nth_run_time(cron_string, start, n):
+    """
+    Returns the datetime, in start's timezone, of the nth run after start, or
+    None if n isn't positive, or there aren't n runs.
+    """
+    if n <= 0:
+        return None
+    runs = get_first_run_times(cron_string, start, n)
+    return runs[-1] if len(runs) == n else None
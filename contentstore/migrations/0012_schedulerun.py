@@ -0,0 +1,49 @@
+# Generated by Django 2.2.8 on 2026-10-18 03:39
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [("contentstore", "0011_message_metadata")]
+
+    operations = [
+        migrations.CreateModel(
+            name="ScheduleRun",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("triggered_at", models.DateTimeField(auto_now_add=True)),
+                ("queued_at", models.DateTimeField(blank=True, null=True)),
+                ("subscriptions", models.IntegerField(blank=True, null=True)),
+                ("sent", models.IntegerField(default=0)),
+                ("failed", models.IntegerField(default=0)),
+                ("first_send_at", models.DateTimeField(blank=True, null=True)),
+                ("last_send_at", models.DateTimeField(blank=True, null=True)),
+                ("finished", models.BooleanField(default=False)),
+                (
+                    "schedule",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="runs",
+                        to="contentstore.Schedule",
+                    ),
+                ),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name="schedulerun",
+            index=models.Index(
+                fields=["finished", "triggered_at"],
+                name="contentstor_finishe_5e1c02_idx",
+            ),
+        ),
+    ]
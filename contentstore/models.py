@@ -2,17 +2,21 @@
 
 import os.path
 import re
-from datetime import datetime
+from datetime import datetime, time, timedelta
 
-from croniter import croniter
+import pytz
 from django.conf import settings
 from django.contrib.postgres.fields import JSONField
+from django.core.cache import caches
 from django.db import models
 from django.shortcuts import reverse
 from django.utils.encoding import python_2_unicode_compatible
+from django.utils.timezone import now
 from django.utils.translation import ugettext_lazy as _
 from rest_framework.serializers import ValidationError
 
+from contentstore import cron
+
 try:
     from urlparse import urljoin
 except ImportError:
@@ -105,12 +109,26 @@ class Schedule(models.Model):
         """Gets a list of datetimes for when this cron schedule would be
         run between the given start and end datetimes.
         """
-        dates = []
-        for dt in croniter(self.cron_string, start, ret_type=datetime):
-            if dt > end:
-                break
-            dates.append(dt)
-        return dates
+        return cron.get_run_times_between(self.cron_string, start, end)
+
+    def count_run_times_between(self, start, end):
+        """Gets the number of times that this cron schedule would be run
+        between the given start and end datetimes.
+        """
+        return cron.count_run_times_between(self.cron_string, start, end)
+
+    def runs_on(self, date):
+        """Returns True if this cron schedule would be run at least once on
+        the given date, in UTC.
+        """
+        start = datetime.combine(date, time.min).replace(tzinfo=pytz.UTC)
+        # Runs are counted after the start, so start from the minute before
+        return (
+            self.count_run_times_between(
+                start - timedelta(minutes=1), start + timedelta(days=1, minutes=-1)
+            )
+            > 0
+        )
 
 
 @python_2_unicode_compatible
@@ -145,7 +163,12 @@ class MessageSet(models.Model):
         return "%s" % self.short_name
 
     def get_messageset_max(self, lang):
-        return self.messages.filter(lang=lang).count()
+        """Returns the number of messages in this MessageSet for the given
+        language, from the cached messageset lengths.
+        """
+        from contentstore.cache import get_messageset_lengths
+
+        return get_messageset_lengths().get((self.id, lang), 0)
 
     def get_all_run_dates(self, start, lang, schedule=None, initial=None):
         """Returns the complete list of dates this MessageSet would run on given
@@ -155,15 +178,11 @@ class MessageSet(models.Model):
         """
         if schedule is None:
             schedule = self.default_schedule
-        dates = []
         set_max = self.get_messageset_max(lang)
-        iters = initial if initial else 1  # start iterator at initial message
-        for dt in croniter(schedule.cron_string, start, ret_type=datetime):
-            if iters > set_max:
-                break
-            iters = iters + 1
-            dates.append(dt)
-        return dates
+        initial = initial if initial else 1
+        return cron.get_first_run_times(
+            schedule.cron_string, start, set_max - initial + 1
+        )
 
 
 def generate_new_filename(instance, filename):
@@ -243,3 +262,97 @@ class Message(models.Model):
             self.lang,
             self.messageset.short_name,
         )
+
+
+@python_2_unicode_compatible
+class ScheduleRun(models.Model):
+
+    """
+    A single run of a schedule, from the scheduler triggering it to the last
+    of its subscriptions being sent to.
+
+    The send tasks record their progress in the shared (redis) cache, so that
+    they don't all update the same row. It's added to the runs when they're
+    read, and saved to them periodically by collect_unfinished.
+    """
+
+    schedule = models.ForeignKey(
+        Schedule, related_name="runs", null=False, on_delete=models.CASCADE
+    )
+    triggered_at = models.DateTimeField(auto_now_add=True)
+    queued_at = models.DateTimeField(null=True, blank=True)
+    subscriptions = models.IntegerField(null=True, blank=True)
+    sent = models.IntegerField(default=0)
+    failed = models.IntegerField(default=0)
+    first_send_at = models.DateTimeField(null=True, blank=True)
+    last_send_at = models.DateTimeField(null=True, blank=True)
+    finished = models.BooleanField(default=False)
+
+    class Meta:
+        indexes = [models.Index(fields=["finished", "triggered_at"])]
+
+    COUNTERS = ("sent", "failed")
+    TIMESTAMPS = ("first_send_at", "last_send_at")
+
+    @staticmethod
+    def _key(run_id, field):
+        return "schedule_run:{}:{}".format(run_id, field)
+
+    @classmethod
+    def record_sends(cls, run_id, sent=0, failed=0):
+        """
+        Records that sent subscriptions were sent to, and failed subscriptions
+        couldn't be, for the run. Does nothing if run_id is None.
+        """
+        if run_id is None or not (sent or failed):
+            return
+        cache = caches["redis"]
+        timeout = settings.SCHEDULE_RUN_TRACKING_TIMEOUT
+        for field, count in (("sent", sent), ("failed", failed)):
+            if count:
+                key = cls._key(run_id, field)
+                cache.add(key, 0, timeout=timeout)
+                cache.incr(key, count)
+        if sent:
+            timestamp = now()
+            cache.add(cls._key(run_id, "first_send_at"), timestamp, timeout=timeout)
+            cache.set(cls._key(run_id, "last_send_at"), timestamp, timeout=timeout)
+
+    @classmethod
+    def add_recorded_progress(cls, runs):
+        """
+        Adds the recorded progress to the runs that haven't finished, in a
+        single cache request, without saving them. Runs that have been tracked
+        for longer than SCHEDULE_RUN_TRACKING_TIMEOUT are finished, whether or
+        not all of their subscriptions were sent to.
+
+        Returns the runs whose progress was added.
+        """
+        cutoff = now() - timedelta(seconds=settings.SCHEDULE_RUN_TRACKING_TIMEOUT)
+        runs = [run for run in runs if not run.finished]
+        if not runs:
+            return runs
+        fields = cls.COUNTERS + cls.TIMESTAMPS
+        values = caches["redis"].get_many(
+            [cls._key(run.id, field) for run in runs for field in fields]
+        )
+        for run in runs:
+            for field in fields:
+                value = values.get(cls._key(run.id, field))
+                if value is not None:
+                    setattr(run, field, value)
+            run.finished = run.triggered_at < cutoff or (
+                run.queued_at is not None and run.sent + run.failed >= run.subscriptions
+            )
+        return runs
+
+    @classmethod
+    def collect_unfinished(cls):
+        """
+        Saves the recorded progress of all of the runs that haven't finished.
+        """
+        runs = cls.add_recorded_progress(cls.objects.filter(finished=False))
+        cls.objects.bulk_update(runs, cls.COUNTERS + cls.TIMESTAMPS + ("finished",))
+
+    def __str__(self):
+        return "{} at {}".format(self.schedule_id, self.triggered_at)
@@ -1,6 +1,6 @@
 from rest_framework import serializers
 
-from .models import BinaryContent, Message, MessageSet, Schedule
+from .models import BinaryContent, Message, MessageSet, Schedule, ScheduleRun
 
 
 class ScheduleSerializer(serializers.ModelSerializer):
@@ -16,6 +16,23 @@ class ScheduleSerializer(serializers.ModelSerializer):
         )
 
 
+class ScheduleRunSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = ScheduleRun
+        fields = (
+            "id",
+            "schedule",
+            "triggered_at",
+            "queued_at",
+            "subscriptions",
+            "sent",
+            "failed",
+            "first_send_at",
+            "last_send_at",
+            "finished",
+        )
+
+
 class MessageSetSerializer(serializers.ModelSerializer):
     class Meta:
         model = MessageSet
@@ -2,10 +2,11 @@
 Contains the singal handlers for contentstore
 """
 
+from django.db import transaction
 from django.db.models.signals import post_delete, post_save
 from django.dispatch import receiver
 
-from contentstore.models import Schedule
+from contentstore.models import BinaryContent, Message, MessageSet, Schedule
 
 
 @receiver(post_save, sender=Schedule)
@@ -36,3 +37,30 @@ def schedule_deleted(sender, instance, **kwargs):
     from contentstore.tasks import deactivate_schedule
 
     deactivate_schedule.delay(str(instance.scheduler_schedule_id))
+
+
+@receiver(post_save, sender=Message)
+@receiver(post_delete, sender=Message)
+@receiver(post_save, sender=MessageSet)
+@receiver(post_delete, sender=MessageSet)
+@receiver(post_save, sender=BinaryContent)
+@receiver(post_delete, sender=BinaryContent)
+@receiver(post_save, sender=Schedule)
+@receiver(post_delete, sender=Schedule)
+def content_changed(sender, instance, **kwargs):
+    """
+    Invalidates the cached message content whenever any of it changes.
+
+    Inside a transaction, a concurrent send could still read the old content
+    after the first invalidation, and cache it again under the new version, so
+    the cache is invalidated again once the change is committed.
+
+    Arguments:
+        sender {class} -- The model class that was changed
+        instance {Model} -- The instance that was changed
+    """
+    from contentstore.cache import content_cache
+
+    content_cache.invalidate()
+    if transaction.get_connection().in_atomic_block:
+        transaction.on_commit(content_cache.invalidate)
@@ -6,13 +6,19 @@ from celery.task import Task
 from django.conf import settings
 from django.db.models.signals import post_save
 from django.utils._os import abspathu
-from seed_services_client.scheduler import SchedulerApiClient
+from django.utils.timezone import now
 from sftpclone import sftpclone
 
-from contentstore.models import Schedule
+from contentstore.cache import get_messages, get_messageset_sizes
+from contentstore.models import Schedule, ScheduleRun
 from contentstore.signals import schedule_saved
+from seed_stage_based_messaging.clients import get_scheduler_client
 from subscriptions.models import Subscription
-from subscriptions.tasks import make_absolute_url, send_next_message
+from subscriptions.tasks import (
+    make_absolute_url,
+    send_next_message,
+    send_next_message_batch,
+)
 
 from .models import BinaryContent
 
@@ -80,16 +86,71 @@ class QueueSubscriptionSend(Task):
 
     name = "contentstore.tasks.queue_subscription_send"
 
-    def run(self, schedule_id, **kwargs):
+    def warm_content_cache(self, subscriptions):
         """
+        Loads the messages and messageset sizes that the subscriptions are
+        about to need into the content cache, so that the send tasks don't all
+        miss the cache and query for the same content at the same time.
+
+        Arguments:
+            subscriptions {QuerySet} -- The subscriptions that will be sent to
+        """
+        keys = list(
+            subscriptions.order_by()
+            .values_list("messageset_id", "next_sequence_number", "lang")
+            .distinct()
+        )
+        if not keys:
+            return
+        get_messages(keys)
+        get_messageset_sizes({(messageset_id, lang) for messageset_id, _, lang in keys})
+
+    def run(self, schedule_id, run_id=None, **kwargs):
+        """
+        The content cache is warmed before any send tasks are queued.
+
+        If settings.SUBSCRIPTION_SEND_BATCH_SIZE is set, the subscriptions are
+        split into chunks of that size, and one batch send task is queued for
+        each chunk.
+
+        The sends are tracked in the ScheduleRun run_id, which is created if
+        it isn't given.
+
         Arguments:
             schedule_id {int} -- The schedule to send messages for
+            run_id {int} -- The ScheduleRun that this send is for
         """
+        if run_id is None:
+            run_id = ScheduleRun.objects.create(schedule_id=schedule_id).id
         subscriptions = Subscription.objects.filter(
             schedule_id=schedule_id, active=True, completed=False, process_status=0
-        ).values("id")
-        for subscription in subscriptions.iterator():
-            send_next_message.delay(str(subscription["id"]))
+        )
+        self.warm_content_cache(subscriptions)
+        subscriptions = subscriptions.values("id")
+
+        count = 0
+        batch_size = settings.SUBSCRIPTION_SEND_BATCH_SIZE
+        if batch_size > 0:
+            batch = []
+            for subscription in subscriptions.iterator():
+                batch.append(str(subscription["id"]))
+                if len(batch) >= batch_size:
+                    send_next_message_batch.delay(batch, run_id=run_id)
+                    count += len(batch)
+                    batch = []
+            if batch:
+                send_next_message_batch.delay(batch, run_id=run_id)
+                count += len(batch)
+        else:
+            # The run is passed positionally, since a chain that is applied
+            # eagerly drops its keyword arguments
+            for subscription in subscriptions.iterator():
+                send_next_message.delay(str(subscription["id"]), None, run_id)
+                count += 1
+
+        ScheduleRun.objects.filter(id=run_id).update(
+            queued_at=now(), subscriptions=count
+        )
 
 
 queue_subscription_send = QueueSubscriptionSend()
@@ -101,7 +162,10 @@ class SyncSchedule(Task):
     """
 
     name = "contentstore.tasks.sync_schedule"
-    scheduler = SchedulerApiClient(settings.SCHEDULER_API_TOKEN, settings.SCHEDULER_URL)
+
+    @property
+    def scheduler(self):
+        return get_scheduler_client()
 
     def run(self, schedule_id, **kwargs):
         """
@@ -153,7 +217,10 @@ class DeactivateSchedule(Task):
     """
 
     name = "contentstore.tasks.deactivate_schedule"
-    scheduler = SchedulerApiClient(settings.SCHEDULER_API_TOKEN, settings.SCHEDULER_URL)
+
+    @property
+    def scheduler(self):
+        return get_scheduler_client()
 
     def run(self, scheduler_schedule_id, **kwargs):
         """
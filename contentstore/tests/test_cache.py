@@ -0,0 +1,279 @@
+"""
+Tests for the contentstore message content cache
+"""
+from datetime import datetime
+from unittest.mock import patch
+
+import pytz
+from django.core.cache import caches
+from django.db import transaction
+from django.test import TestCase, TransactionTestCase
+from prometheus_client import REGISTRY
+
+from contentstore.cache import (
+    VERSION_KEY,
+    ContentCache,
+    LocalLRUCache,
+    content_cache,
+    get_message,
+    get_messages,
+    get_messageset_graph,
+    get_messageset_sizes,
+)
+from contentstore.models import Message, MessageSet, Schedule
+from seed_stage_based_messaging import test_utils as utils
+
+
+class ContentCacheTests(TestCase):
+    def setUp(self):
+        utils.disable_signals()
+        schedule = Schedule.objects.create()
+        self.messageset = MessageSet.objects.create(default_schedule=schedule)
+        self.message = Message.objects.create(
+            messageset=self.messageset,
+            sequence_number=1,
+            lang="eng_ZA",
+            text_content="Message 1",
+        )
+
+    def tearDown(self):
+        utils.enable_signals()
+
+    def test_get_messages(self):
+        """
+        Messages should be fetched in a single query, and served from the
+        cache afterwards. Missing messages should be left out.
+        """
+        keys = [(self.messageset.id, 1, "eng_ZA"), (self.messageset.id, 2, "eng_ZA")]
+        with self.assertNumQueries(1):
+            messages = get_messages(keys)
+        self.assertEqual(messages, {keys[0]: self.message})
+
+        with self.assertNumQueries(1):
+            get_messages(keys)
+        with self.assertNumQueries(0):
+            get_messages(keys[:1])
+
+    def test_shared_tier_survives_local_tier(self):
+        """
+        If the local tier is lost, for example by the worker process being
+        recycled, then content should still be served from the shared tier.
+        """
+        get_message(self.messageset.id, 1, "eng_ZA")
+        content_cache.local.clear()
+        with self.assertNumQueries(0):
+            message = get_message(self.messageset.id, 1, "eng_ZA")
+        self.assertEqual(message.text_content, "Message 1")
+
+    def test_lookups_counted(self):
+        """
+        Each lookup should be counted by the tier that it was found in, or as
+        a miss.
+        """
+
+        def lookups():
+            return [
+                REGISTRY.get_sample_value(
+                    "content_cache_lookups_total", {"kind": "message", "result": result}
+                )
+                or 0
+                for result in ("local", "shared", "miss")
+            ]
+
+        before = lookups()
+        get_message(self.messageset.id, 1, "eng_ZA")
+        get_message(self.messageset.id, 1, "eng_ZA")
+        content_cache.local.clear()
+        get_message(self.messageset.id, 1, "eng_ZA")
+        self.assertEqual(
+            [after - count for after, count in zip(lookups(), before)], [1, 1, 1]
+        )
+
+    def test_get_message_missing(self):
+        """
+        If there is no matching message, then DoesNotExist should be raised
+        """
+        with self.assertRaises(Message.DoesNotExist):
+            get_message(self.messageset.id, 2, "eng_ZA")
+
+    def test_message_changed(self):
+        """
+        Changing a message should invalidate the cached content
+        """
+        get_message(self.messageset.id, 1, "eng_ZA")
+        self.message.text_content = "Changed"
+        self.message.save()
+        message = get_message(self.messageset.id, 1, "eng_ZA")
+        self.assertEqual(message.text_content, "Changed")
+
+    def test_messageset_sizes(self):
+        """
+        Sizes should be counted in a single query, and invalidated when a
+        message is added or removed.
+        """
+        keys = [(self.messageset.id, "eng_ZA"), (self.messageset.id, "zul_ZA")]
+        with self.assertNumQueries(1):
+            sizes = get_messageset_sizes(keys)
+        self.assertEqual(sizes, {keys[0]: 1, keys[1]: 0})
+        with self.assertNumQueries(0):
+            get_messageset_sizes(keys)
+
+        message = Message.objects.create(
+            messageset=self.messageset,
+            sequence_number=2,
+            lang="eng_ZA",
+            text_content="Message 2",
+        )
+        self.assertEqual(get_messageset_sizes(keys), {keys[0]: 2, keys[1]: 0})
+
+        message.delete()
+        self.assertEqual(get_messageset_sizes(keys), {keys[0]: 1, keys[1]: 0})
+
+    def test_messageset_max(self):
+        """
+        The messageset lengths should be shared by all of the messagesets, so
+        that once they're counted, no more queries are needed.
+        """
+        other = MessageSet.objects.create(
+            short_name="other", default_schedule=self.messageset.default_schedule
+        )
+        with self.assertNumQueries(1):
+            self.assertEqual(self.messageset.get_messageset_max("eng_ZA"), 1)
+        with self.assertNumQueries(0):
+            self.assertEqual(other.get_messageset_max("eng_ZA"), 0)
+            self.assertEqual(self.messageset.get_messageset_max("zul_ZA"), 0)
+
+        Message.objects.create(
+            messageset=other, sequence_number=1, lang="eng_ZA", text_content="Other"
+        )
+        self.assertEqual(other.get_messageset_max("eng_ZA"), 1)
+
+    def test_invalidated_by_other_process(self):
+        """
+        An invalidation in one process should clear the local tier in other
+        processes the next time that they check the version.
+        """
+        other = ContentCache(
+            caches["redis"], max_local_entries=10, version_check_interval=0
+        )
+        self.assertEqual(other.get_many(["key"], lambda keys: {"key": 1}), {"key": 1})
+        self.assertEqual(other.get_many(["key"], lambda keys: {"key": 2}), {"key": 1})
+
+        content_cache.invalidate()
+        self.assertEqual(other.get_many(["key"], lambda keys: {"key": 2}), {"key": 2})
+
+
+class ContentInvalidationTests(TransactionTestCase):
+    def setUp(self):
+        utils.disable_signals()
+        schedule = Schedule.objects.create()
+        self.messageset = MessageSet.objects.create(default_schedule=schedule)
+
+    def tearDown(self):
+        utils.enable_signals()
+
+    @patch("contentstore.cache.content_cache.invalidate")
+    def test_invalidated_on_commit(self, invalidate):
+        """
+        A change inside a transaction should invalidate the cache again once
+        it is committed, so that old content cached in the meantime isn't
+        kept.
+        """
+        with transaction.atomic():
+            Message.objects.create(
+                messageset=self.messageset,
+                sequence_number=1,
+                lang="eng_ZA",
+                text_content="Message",
+            )
+            self.assertEqual(invalidate.call_count, 1)
+        self.assertEqual(invalidate.call_count, 2)
+
+
+class MessageSetGraphTests(TestCase):
+    def setUp(self):
+        utils.disable_signals()
+        self.schedule1 = Schedule.objects.create(hour=8, minute=0)
+        self.schedule2 = Schedule.objects.create(hour=9, minute=0)
+        self.messageset2 = MessageSet.objects.create(
+            short_name="second", default_schedule=self.schedule2
+        )
+        self.messageset1 = MessageSet.objects.create(
+            short_name="first",
+            default_schedule=self.schedule1,
+            next_set=self.messageset2,
+        )
+        Message.objects.create(
+            messageset=self.messageset1,
+            sequence_number=1,
+            lang="eng_ZA",
+            text_content="Message 1",
+        )
+
+    def tearDown(self):
+        utils.enable_signals()
+
+    def test_graph(self):
+        """
+        The whole graph should be loaded in three queries, and then walked
+        without any further queries.
+        """
+        with self.assertNumQueries(3):
+            graph = get_messageset_graph()
+        with self.assertNumQueries(0):
+            graph = get_messageset_graph(self.messageset1.id, self.schedule1.id)
+            self.assertEqual(graph.next_set(self.messageset1.id), self.messageset2.id)
+            self.assertIsNone(graph.next_set(self.messageset2.id))
+            self.assertEqual(
+                graph.default_schedule(self.messageset2.id), self.schedule2.id
+            )
+            self.assertEqual(graph.cron_string(self.schedule1.id), "0 8 * * *")
+            self.assertEqual(graph.length(self.messageset1.id, "eng_ZA"), 1)
+            self.assertEqual(graph.length(self.messageset2.id, "eng_ZA"), 0)
+            self.assertEqual(
+                graph.last_run_date(
+                    self.messageset1.id,
+                    self.schedule1.id,
+                    "eng_ZA",
+                    datetime(2018, 1, 1, tzinfo=pytz.UTC),
+                ),
+                datetime(2018, 1, 1, 8, tzinfo=pytz.UTC),
+            )
+
+    def test_schedule_changed(self):
+        """
+        Changing a schedule should invalidate the graph
+        """
+        get_messageset_graph()
+        self.schedule1.hour = 10
+        self.schedule1.save()
+        self.assertEqual(
+            get_messageset_graph().cron_string(self.schedule1.id), "0 10 * * *"
+        )
+
+    def test_unknown_messageset(self):
+        """
+        If a messageset isn't in the graph, then it might have been created in
+        another process, so the content version should be checked again.
+        """
+        get_messageset_graph()
+        [messageset] = MessageSet.objects.bulk_create(
+            [MessageSet(short_name="third", default_schedule=self.schedule1)]
+        )
+        caches["redis"].set(VERSION_KEY, "other process", timeout=None)
+
+        with patch.object(content_cache, "version_check_interval", 3600):
+            self.assertNotIn(messageset.id, get_messageset_graph())
+            self.assertIn(messageset.id, get_messageset_graph(messageset.id))
+
+
+class LocalLRUCacheTests(TestCase):
+    def test_evicts_least_recently_used(self):
+        """
+        Once the cache is full, the least recently used entry is evicted
+        """
+        cache = LocalLRUCache(max_entries=2)
+        cache.set_many({"a": 1, "b": 2})
+        cache.get_many(["a"])
+        cache.set_many({"c": 3})
+        self.assertEqual(cache.get_many(["a", "b", "c"]), {"a": 1, "c": 3})
@@ -0,0 +1,190 @@
+"""
+Tests for the cron run time index
+"""
+import random
+from datetime import datetime, timedelta
+from unittest.mock import patch
+
+import pytz
+from croniter import croniter
+from django.test import TestCase
+
+from contentstore.cron import (
+    ClosedFormCounter,
+    CronIndex,
+    count_run_times_between,
+    get_first_run_times,
+    get_nth_run_time,
+    get_run_times_between,
+)
+
+
+def croniter_between(cron_string, start, end):
+    dates = []
+    for dt in croniter(cron_string, start, ret_type=datetime):
+        if dt > end:
+            break
+        dates.append(dt)
+    return dates
+
+
+class CronIndexTests(TestCase):
+    def test_matches_croniter(self):
+        """
+        Queries in any order, including ones far apart and overlapping ones,
+        should return the same runs as iterating croniter.
+        """
+        cron_string = "0 8 * * 1,3"
+        index = CronIndex(cron_string)
+        start = datetime(2018, 1, 1, tzinfo=pytz.UTC)
+        queries = [
+            (start + timedelta(days=400), start + timedelta(days=430)),
+            (start, start + timedelta(days=10)),
+            (start + timedelta(days=5, hours=8), start + timedelta(days=420)),
+            (start - timedelta(days=3), start + timedelta(days=500)),
+            (start + timedelta(days=7, hours=8), start + timedelta(days=14, hours=8)),
+        ]
+        for query_start, query_end in queries:
+            expected = [
+                dt.timestamp()
+                for dt in croniter_between(cron_string, query_start, query_end)
+            ]
+            self.assertEqual(
+                index.between(query_start.timestamp(), query_end.timestamp()), expected
+            )
+            self.assertEqual(
+                index.count(query_start.timestamp(), query_end.timestamp()),
+                len(expected),
+            )
+        self.assertEqual(len(index.segments), 1)
+
+    def test_disjoint_segments(self):
+        """
+        Queries that are far apart shouldn't generate the runs between them
+        """
+        index = CronIndex("* * * * *")
+        start = datetime(2018, 1, 1, tzinfo=pytz.UTC).timestamp()
+        end = datetime(2026, 1, 1, tzinfo=pytz.UTC).timestamp()
+        self.assertEqual(index.count(start, start + 3600), 60)
+        self.assertEqual(index.count(end, end + 3600), 60)
+        self.assertEqual(len(index.segments), 2)
+
+    def test_first(self):
+        """
+        The first n runs after the start should be returned, however far
+        ahead they are.
+        """
+        index = CronIndex("0 8 1 * *")
+        start = datetime(2018, 1, 1, 8, 0, tzinfo=pytz.UTC)
+        iterator = croniter("0 8 1 * *", start)
+        self.assertEqual(
+            index.first(start.timestamp(), 30), [iterator.get_next() for _ in range(30)]
+        )
+        self.assertEqual(index.first(start.timestamp(), 0), [])
+
+    def test_no_runs(self):
+        """
+        Expressions that never run should have no runs, and the search for
+        them should give up.
+        """
+        index = CronIndex("0 8 30 2 *")
+        start = datetime(2018, 1, 1, tzinfo=pytz.UTC).timestamp()
+        self.assertEqual(index.first(start, 3), [])
+        self.assertEqual(index.count(start, start + 86400 * 400), 0)
+        self.assertIsNone(get_nth_run_time("0 8 30 2 *", datetime(2018, 1, 1), 1))
+
+    @patch("contentstore.cron.MAX_INDEX_TIMES", 120)
+    def test_segments_bounded(self):
+        """
+        Once the index is too big, the least recently used segments should be
+        dropped.
+        """
+        index = CronIndex("* * * * *")
+        start = datetime(2018, 1, 1, tzinfo=pytz.UTC).timestamp()
+        day = 86400
+        self.assertEqual(index.count(start, start + 3600), 60)
+        self.assertEqual(index.count(start + day, start + day + 3600), 60)
+        self.assertEqual(index.count(start, start + 3600), 60)
+        self.assertEqual(index.count(start + 2 * day, start + 2 * day + 3600), 60)
+        self.assertEqual(
+            [segment[0] for segment in index.segments], [start, start + 2 * day]
+        )
+
+    def test_timezones(self):
+        """
+        Naive datetimes should be treated as UTC, and returned naive. Other
+        timezones should match croniter.
+        """
+        start, end = datetime(2018, 3, 20), datetime(2018, 4, 10)
+        self.assertEqual(
+            get_run_times_between("0 1 * * *", start, end),
+            croniter_between("0 1 * * *", start, end),
+        )
+        self.assertEqual(count_run_times_between("0 1 * * *", start, end), 21)
+
+        tz = pytz.timezone("Europe/London")
+        start, end = tz.localize(start), tz.localize(end)
+        self.assertEqual(
+            get_run_times_between("0 1 * * *", start, end),
+            croniter_between("0 1 * * *", start, end),
+        )
+        self.assertEqual(
+            get_first_run_times("0 1 * * *", start, 3),
+            croniter_between("0 1 * * *", start, end)[:3],
+        )
+
+
+class ClosedFormCounterTests(TestCase):
+    def test_simple_patterns_detected(self):
+        """
+        Only expressions on every day of the month and every month, with
+        numeric minutes, hours, and days of the week, can be counted
+        arithmetically.
+        """
+        for cron_string in ("0 8 * * 1,3", "*/15 8-17 * * 1-5", "30 7 * * *"):
+            self.assertIsNotNone(ClosedFormCounter.from_cron_string(cron_string))
+        for cron_string in ("0 8 1 * *", "0 8 * 6 *", "0 8 * * mon", "0 8 * * 5L"):
+            self.assertIsNone(ClosedFormCounter.from_cron_string(cron_string))
+
+    def test_matches_croniter(self):
+        """
+        The counts should match iterating croniter, for randomly generated
+        expressions and time ranges.
+        """
+        rand = random.Random(20181001)
+
+        def random_field(low, high):
+            kind = rand.choice(["value", "list", "range", "step", "*"])
+            if kind == "value":
+                return str(rand.randint(low, high))
+            if kind == "list":
+                values = rand.sample(range(low, high + 1), rand.randint(2, 3))
+                return ",".join(str(v) for v in values)
+            if kind == "range":
+                first = rand.randint(low, high - 1)
+                return "{}-{}".format(first, rand.randint(first + 1, high))
+            if kind == "step":
+                return "{}/{}".format(
+                    rand.choice(["*", str(low)]), rand.randint(2, (high - low) // 2)
+                )
+            return "*"
+
+        for _ in range(200):
+            cron_string = "{} {} * * {}".format(
+                rand.choice(["0", "30", "0,30", "15-16"]),
+                random_field(0, 23),
+                random_field(0, 7),
+            )
+            counter = ClosedFormCounter.from_cron_string(cron_string)
+            start = datetime(1969, 6, 1, tzinfo=pytz.UTC) + timedelta(
+                seconds=rand.randint(0, 60 * 60 * 24 * 365 * 60)
+            )
+            if rand.random() < 0.3:
+                start = start.replace(minute=rand.choice([0, 30]), second=0)
+            end = start + timedelta(seconds=rand.randint(0, 60 * 60 * 24 * 30))
+
+            self.assertEqual(
+                counter.count(start.timestamp(), end.timestamp()),
+                len(croniter_between(cron_string, start, end)),
+                "{} from {} to {}".format(cron_string, start, end),
+            )
@@ -1,11 +1,14 @@
 # -*- coding: utf-8 -*-
 
-from django.test import TestCase
+from datetime import timedelta
+
+from django.test import TestCase, override_settings
+from django.utils.timezone import now
 from rest_framework.serializers import ValidationError
 
 from seed_stage_based_messaging import test_utils as utils
 
-from ..models import Message, validate_special_characters
+from ..models import Message, Schedule, ScheduleRun, validate_special_characters
 from .test_general import MessageSetTestMixin
 
 
@@ -62,3 +65,72 @@ class TestMessage(MessageSetTestMixin, TestCase):
                 Message.objects.create(
                     sequence_number=1, messageset_id=messageset.id, text_content=message
                 )
+
+
+class TestScheduleRun(TestCase):
+    def setUp(self):
+        utils.disable_signals()
+        self.schedule = Schedule.objects.create()
+
+    def tearDown(self):
+        utils.enable_signals()
+
+    def test_collect_unfinished(self):
+        """
+        The recorded sends should be collected into the run, which should be
+        finished once all of its subscriptions have been sent to or failed.
+        """
+        run = ScheduleRun.objects.create(
+            schedule=self.schedule, queued_at=now(), subscriptions=3
+        )
+        ScheduleRun.record_sends(run.id, sent=1)
+        ScheduleRun.record_sends(run.id, sent=1)
+        ScheduleRun.record_sends(None, sent=1)
+
+        ScheduleRun.collect_unfinished()
+        run.refresh_from_db()
+        self.assertEqual((run.sent, run.failed, run.finished), (2, 0, False))
+        self.assertLessEqual(run.triggered_at, run.first_send_at)
+        self.assertLessEqual(run.first_send_at, run.last_send_at)
+
+        ScheduleRun.record_sends(run.id, failed=1)
+        ScheduleRun.collect_unfinished()
+        run.refresh_from_db()
+        self.assertEqual((run.sent, run.failed, run.finished), (2, 1, True))
+
+    def test_add_recorded_progress(self):
+        """
+        The recorded sends should be added to the unfinished runs, without
+        saving them.
+        """
+        run = ScheduleRun.objects.create(
+            schedule=self.schedule, queued_at=now(), subscriptions=1
+        )
+        finished = ScheduleRun.objects.create(
+            schedule=self.schedule, subscriptions=1, sent=1, finished=True
+        )
+        ScheduleRun.record_sends(run.id, sent=1)
+        ScheduleRun.record_sends(finished.id, failed=1)
+
+        self.assertEqual(ScheduleRun.add_recorded_progress([run, finished]), [run])
+        self.assertEqual((run.sent, run.finished), (1, True))
+        self.assertEqual(finished.failed, 0)
+
+        run.refresh_from_db()
+        self.assertEqual((run.sent, run.finished), (0, False))
+
+    @override_settings(SCHEDULE_RUN_TRACKING_TIMEOUT=60)
+    def test_tracking_timeout(self):
+        """
+        Runs that have been tracked for longer than the timeout should be
+        finished, even if not all of their subscriptions have been sent to.
+        """
+        run = ScheduleRun.objects.create(
+            schedule=self.schedule, queued_at=now(), subscriptions=3
+        )
+        ScheduleRun.objects.filter(id=run.id).update(
+            triggered_at=now() - timedelta(minutes=2)
+        )
+        ScheduleRun.collect_unfinished()
+        run.refresh_from_db()
+        self.assertEqual((run.sent, run.finished), (0, True))
@@ -4,9 +4,11 @@ Tests for the contentstore tasks
 
 from unittest.mock import patch
 
-from django.test import TestCase
+import responses
+from django.test import TestCase, override_settings
 
-from contentstore.models import MessageSet, Schedule
+from contentstore.cache import get_message, get_messageset_sizes
+from contentstore.models import Message, MessageSet, Schedule, ScheduleRun
 from contentstore.tasks import queue_subscription_send
 from seed_stage_based_messaging import test_utils as utils
 from subscriptions.models import Subscription
@@ -51,4 +53,108 @@ class QueueSubscriptionSendTaskTests(TestCase):
         )
 
         queue_subscription_send(str(schedule1.id))
-        send_next_message.delay.assert_called_once_with(str(subscription.id))
+        [run] = ScheduleRun.objects.all()
+        send_next_message.delay.assert_called_once_with(
+            str(subscription.id), None, run.id
+        )
+        self.assertEqual(run.schedule, schedule1)
+        self.assertEqual(run.subscriptions, 1)
+        self.assertIsNotNone(run.queued_at)
+
+    @responses.activate
+    def test_queue_subscription_send_records_run(self):
+        """
+        Sends through the send chain should be recorded against the schedule
+        run, even when the chain is applied eagerly.
+        """
+        schedule = Schedule.objects.create()
+        messageset = MessageSet.objects.create(default_schedule=schedule)
+        Message.objects.create(
+            messageset=messageset,
+            sequence_number=1,
+            lang="eng_ZA",
+            text_content="Message 1",
+        )
+        subscription = Subscription.objects.create(
+            messageset=messageset, schedule=schedule, lang="eng_ZA"
+        )
+        responses.add(
+            responses.GET,
+            "http://seed-identity-store/api/v1/identities/{}/addresses/msisdn".format(
+                subscription.identity
+            ),
+            json={"next": None, "previous": None, "results": [{"address": "+1"}]},
+        )
+        responses.add(
+            responses.POST,
+            "http://seed-message-sender/api/v1/outbound/",
+            json={"id": "c7f3c839-2bf5-42d1-86b9-ccb886645fb4"},
+        )
+
+        queue_subscription_send(str(schedule.id))
+        ScheduleRun.collect_unfinished()
+
+        [run] = ScheduleRun.objects.all()
+        self.assertEqual(run.subscriptions, 1)
+        self.assertEqual(run.sent, 1)
+        self.assertEqual(run.failed, 0)
+        self.assertIsNotNone(run.last_send_at)
+        self.assertTrue(run.finished)
+
+    @override_settings(SUBSCRIPTION_SEND_BATCH_SIZE=2)
+    @patch("contentstore.tasks.send_next_message_batch")
+    @patch("contentstore.tasks.send_next_message")
+    def test_queue_subscription_send_batched(
+        self, send_next_message, send_next_message_batch
+    ):
+        """
+        If a batch size is configured, the queue subscription send task should
+        queue one batch task per chunk of subscriptions.
+        """
+        schedule = Schedule.objects.create()
+        messageset = MessageSet.objects.create(default_schedule=schedule)
+        subscriptions = [
+            Subscription.objects.create(messageset=messageset, schedule=schedule)
+            for _ in range(5)
+        ]
+
+        queue_subscription_send(str(schedule.id))
+
+        send_next_message.delay.assert_not_called()
+        batches = [c[0][0] for c in send_next_message_batch.delay.call_args_list]
+        self.assertEqual([len(b) for b in batches], [2, 2, 1])
+        self.assertEqual(
+            sorted(sum(batches, [])), sorted(str(s.id) for s in subscriptions)
+        )
+
+    @patch("contentstore.tasks.send_next_message")
+    def test_queue_subscription_send_warms_content_cache(self, send_next_message):
+        """
+        The messages and messageset sizes for the schedule's subscriptions
+        should be loaded into the content cache before the sends are queued.
+        """
+        schedule = Schedule.objects.create()
+        messageset = MessageSet.objects.create(default_schedule=schedule)
+        for sequence_number in (1, 2):
+            Message.objects.create(
+                messageset=messageset,
+                sequence_number=sequence_number,
+                lang="eng_ZA",
+                text_content="Message {}".format(sequence_number),
+            )
+        for _ in range(3):
+            Subscription.objects.create(
+                messageset=messageset, schedule=schedule, lang="eng_ZA"
+            )
+
+        # The schedule run, the content keys, messages, sizes, the
+        # subscriptions, and then the schedule run's subscription count
+        with self.assertNumQueries(6):
+            queue_subscription_send(str(schedule.id))
+        self.assertEqual(send_next_message.delay.call_count, 3)
+
+        with self.assertNumQueries(0):
+            message = get_message(messageset.id, 1, "eng_ZA")
+            sizes = get_messageset_sizes([(messageset.id, "eng_ZA")])
+        self.assertEqual(message.text_content, "Message 1")
+        self.assertEqual(sizes, {(messageset.id, "eng_ZA"): 2})
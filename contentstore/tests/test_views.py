@@ -5,11 +5,12 @@ Tests for the contentstore views
 from unittest.mock import patch
 
 from django.contrib.auth.models import User
+from django.utils.timezone import now
 from rest_framework import status
 from rest_framework.authtoken.models import Token
 from rest_framework.test import APITestCase
 
-from contentstore.models import Schedule
+from contentstore.models import Schedule, ScheduleRun
 from seed_stage_based_messaging import test_utils as utils
 
 
@@ -37,4 +38,62 @@ class ScheduleViewsetTests(APITestCase):
 
         response = self.client.post(schedule.send_url, {}, format="json")
         self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
-        task.delay.assert_called_once_with(str(schedule.id))
+        [run] = ScheduleRun.objects.filter(schedule=schedule)
+        self.assertEqual(response.data, {"run_id": run.id})
+        task.delay.assert_called_once_with(str(schedule.id), run_id=run.id)
+
+
+class ScheduleRunViewsetTests(APITestCase):
+    """
+    Tests for the schedule run viewset
+    """
+
+    def setUp(self):
+        utils.disable_signals()
+        user = User.objects.create_user("test")
+        token = Token.objects.create(user=user)
+        self.client.credentials(HTTP_AUTHORIZATION="Token " + token.key)
+
+    def tearDown(self):
+        utils.enable_signals()
+
+    def test_list(self):
+        """
+        The runs should be listed with the sends recorded so far, and be
+        filterable by schedule.
+        """
+        schedule = Schedule.objects.create()
+        run = ScheduleRun.objects.create(schedule=schedule, subscriptions=2)
+        ScheduleRun.objects.create(schedule=Schedule.objects.create())
+        ScheduleRun.record_sends(run.id, sent=1)
+
+        response = self.client.get(
+            "/api/v1/schedulerun/", {"schedule": schedule.id}, format="json"
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        [result] = response.data["results"]
+        self.assertEqual(result["id"], run.id)
+        self.assertEqual(result["subscriptions"], 2)
+        self.assertEqual(result["sent"], 1)
+        self.assertFalse(result["finished"])
+        self.assertIsNotNone(result["last_send_at"])
+
+        # Reading the runs shouldn't save the recorded sends
+        run.refresh_from_db()
+        self.assertEqual(run.sent, 0)
+
+    def test_retrieve(self):
+        """
+        A run should be shown with the sends recorded so far
+        """
+        run = ScheduleRun.objects.create(
+            schedule=Schedule.objects.create(), queued_at=now(), subscriptions=1
+        )
+        ScheduleRun.record_sends(run.id, sent=1)
+
+        response = self.client.get(
+            "/api/v1/schedulerun/{}/".format(run.id), format="json"
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data["sent"], 1)
+        self.assertTrue(response.data["finished"])
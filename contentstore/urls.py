@@ -5,6 +5,7 @@ from . import views
 
 router = routers.DefaultRouter()
 router.register(r"schedule", views.ScheduleViewSet)
+router.register(r"schedulerun", views.ScheduleRunViewSet)
 router.register(r"messageset", views.MessageSetViewSet)
 router.register(r"message", views.MessageViewSet)
 router.register(r"binarycontent", views.BinaryContentViewSet)
@@ -4,15 +4,16 @@ from rest_framework.pagination import CursorPagination
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.response import Response
 from rest_framework.views import APIView
-from rest_framework.viewsets import ModelViewSet
+from rest_framework.viewsets import ModelViewSet, ReadOnlyModelViewSet
 
-from .models import BinaryContent, Message, MessageSet, Schedule
+from .models import BinaryContent, Message, MessageSet, Schedule, ScheduleRun
 from .serializers import (
     BinaryContentSerializer,
     MessageListSerializer,
     MessageSerializer,
     MessageSetMessagesSerializer,
     MessageSetSerializer,
+    ScheduleRunSerializer,
     ScheduleSerializer,
 )
 from .tasks import queue_subscription_send, sync_audio_messages
@@ -39,9 +40,35 @@ class ScheduleViewSet(ModelViewSet):
         Sends all the subscriptions for the specified schedule
         """
         schedule = self.get_object()
-        queue_subscription_send.delay(str(schedule.id))
+        run = ScheduleRun.objects.create(schedule=schedule)
+        queue_subscription_send.delay(str(schedule.id), run_id=run.id)
 
-        return Response({}, status=status.HTTP_202_ACCEPTED)
+        return Response({"run_id": run.id}, status=status.HTTP_202_ACCEPTED)
+
+
+class ScheduleRunViewSet(ReadOnlyModelViewSet):
+
+    """
+    API endpoint that allows ScheduleRun models to be viewed, with the
+    recorded progress of the runs that are still sending added.
+    """
+
+    permission_classes = (IsAuthenticated,)
+    queryset = ScheduleRun.objects.all()
+    serializer_class = ScheduleRunSerializer
+    filterset_fields = ("schedule", "finished")
+    pagination_class = IdCursorPagination
+
+    def paginate_queryset(self, queryset):
+        page = super(ScheduleRunViewSet, self).paginate_queryset(queryset)
+        if page is not None:
+            ScheduleRun.add_recorded_progress(page)
+        return page
+
+    def get_object(self):
+        run = super(ScheduleRunViewSet, self).get_object()
+        ScheduleRun.add_recorded_progress([run])
+        return run
 
 
 class MessageSetViewSet(ModelViewSet):
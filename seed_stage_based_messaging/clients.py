@@ -0,0 +1,136 @@
+"""
+Shared API clients for the seed services.
+
+Each client keeps a requests session with a connection pool, so that requests
+to a service reuse open connections instead of doing a new TCP and TLS
+handshake every time. Clients are created lazily, once per process, and are
+thrown away after a fork, since the child can't share the parent's
+connections.
+"""
+import os
+import time
+from threading import Lock
+
+from celery.signals import worker_process_init
+from django.conf import settings
+from seed_services_client import (
+    IdentityStoreApiClient,
+    MessageSenderApiClient,
+    SchedulerApiClient,
+)
+from seed_services_client.metrics import MetricsApiClient
+from seed_services_client.seed_services import SeedHTTPAdapter
+
+
+class ClientRegistry(object):
+    """
+    Holds one client per name for the current process.
+
+    A client that hasn't been used for HTTP_CLIENT_IDLE_TIMEOUT seconds is
+    replaced on its next use, since the service has most likely closed its
+    idle connections by then. The old client isn't closed, since other
+    threads may still be using it; its connections are closed once it's no
+    longer referenced.
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.reset()
+
+    def reset(self):
+        self.pid = os.getpid()
+        self.clients = {}
+
+    def close(self):
+        """
+        Closes the connections of all of the clients, so that they are
+        created again on their next use.
+        """
+        with self.lock:
+            if self.pid == os.getpid():
+                for client, _ in self.clients.values():
+                    client.session.close()
+            self.reset()
+
+    def get(self, name, factory):
+        with self.lock:
+            if self.pid != os.getpid():
+                self.reset()
+
+            timestamp = time.monotonic()
+            client, last_used = self.clients.get(name, (None, None))
+            if (
+                client is None
+                or timestamp - last_used > settings.HTTP_CLIENT_IDLE_TIMEOUT
+            ):
+                client = factory()
+                use_connection_pool(client.session)
+
+            self.clients[name] = (client, timestamp)
+            return client
+
+
+registry = ClientRegistry()
+
+
+@worker_process_init.connect
+def reset_clients(**kwargs):
+    registry.reset()
+
+
+def use_connection_pool(session):
+    """
+    Replaces the session's adapters with ones that keep up to
+    HTTP_POOL_MAXSIZE connections open to each host, keeping each adapter's
+    timeout and retries.
+    """
+    for prefix, adapter in list(session.adapters.items()):
+        session.mount(
+            prefix,
+            SeedHTTPAdapter(
+                timeout=getattr(adapter, "timeout", None),
+                max_retries=adapter.max_retries,
+                pool_connections=settings.HTTP_POOL_CONNECTIONS,
+                pool_maxsize=settings.HTTP_POOL_MAXSIZE,
+            ),
+        )
+
+
+def get_identity_store_client():
+    return registry.get(
+        "identity_store",
+        lambda: IdentityStoreApiClient(
+            settings.IDENTITY_STORE_TOKEN,
+            settings.IDENTITY_STORE_URL,
+            retries=5,
+            timeout=settings.DEFAULT_REQUEST_TIMEOUT,
+        ),
+    )
+
+
+def get_message_sender_client():
+    return registry.get(
+        "message_sender",
+        lambda: MessageSenderApiClient(
+            settings.MESSAGE_SENDER_TOKEN,
+            settings.MESSAGE_SENDER_URL,
+            retries=5,
+            timeout=settings.DEFAULT_REQUEST_TIMEOUT,
+        ),
+    )
+
+
+def get_scheduler_client():
+    return registry.get(
+        "scheduler",
+        lambda: SchedulerApiClient(
+            settings.SCHEDULER_API_TOKEN, settings.SCHEDULER_URL
+        ),
+    )
+
+
+def get_metrics_client():
+    return registry.get(
+        "metrics",
+        lambda: MetricsApiClient(url=settings.METRICS_URL, auth=settings.METRICS_AUTH),
+    )
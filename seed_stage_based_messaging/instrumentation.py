@@ -0,0 +1,196 @@
+"""
+Prometheus metrics for the send pipeline.
+
+django_prometheus already covers the HTTP views and the database. These cover
+the Celery send stages: how long each stage takes and how it ended, how often
+subscriptions are found already locked, how often message content is found in
+the cache, and how long the requests to the other seed services take. The
+progress of each schedule's latest run is read from the database, and the
+cache that the send tasks record it in, when the metrics are scraped.
+
+Prefork workers run each task in a child process, with its own metrics. For
+these to be combined, set the prometheus_multiproc_dir environment variable
+to a directory that is shared by all of the processes, and emptied before they
+start. The web app's /metrics view, export_metrics, then exports the metrics
+of every process that uses the directory, and workers can export them
+themselves on PROMETHEUS_WORKER_PORT.
+"""
+import logging
+import os
+import time
+from datetime import timedelta
+from functools import wraps
+
+from celery.signals import worker_process_shutdown, worker_ready
+from django.conf import settings
+from django.http import HttpResponse
+from django.utils.timezone import now
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Histogram,
+    generate_latest,
+    multiprocess,
+    start_http_server,
+)
+from prometheus_client.core import GaugeMetricFamily
+
+logger = logging.getLogger(__name__)
+
+SEND_STAGE_DURATION = Histogram(
+    "send_stage_duration_seconds",
+    "The time taken by each stage of the send pipeline",
+    ["stage"],
+)
+SEND_STAGE_OUTCOMES = Counter(
+    "send_stage_outcomes_total",
+    "How each stage of the send pipeline ended: ok, failed if it gave up on "
+    "the send, skipped if an earlier stage had, or the class of the error "
+    "raised",
+    ["stage", "outcome"],
+)
+SUBSCRIPTION_LOCK_CONTENTION = Counter(
+    "subscription_lock_contention_total",
+    "Subscriptions that couldn't be locked for sending, because another task "
+    "already had them locked",
+)
+CONTENT_CACHE_LOOKUPS = Counter(
+    "content_cache_lookups_total",
+    "Content cache lookups, by the kind of content and the tier it was found "
+    "in, or miss if it had to be fetched from the database",
+    ["kind", "result"],
+)
+SERVICE_REQUEST_DURATION = Histogram(
+    "send_service_request_duration_seconds",
+    "The time taken by requests to the other seed services while sending",
+    ["service"],
+)
+
+
+def instrument_stage(stage):
+    """
+    Decorates a send stage function, which takes and returns a send context,
+    to record its duration and outcome.
+    """
+
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.monotonic()
+            outcome = "ok"
+            if args and isinstance(args[0], dict) and "error" in args[0]:
+                outcome = "skipped"
+            try:
+                result = func(*args, **kwargs)
+                if outcome == "ok" and isinstance(result, dict) and "error" in result:
+                    outcome = "failed"
+                return result
+            except Exception as exc:
+                outcome = type(exc).__name__
+                raise
+            finally:
+                SEND_STAGE_DURATION.labels(stage).observe(time.monotonic() - start)
+                SEND_STAGE_OUTCOMES.labels(stage, outcome).inc()
+
+        return wrapper
+
+    return decorator
+
+
+class ScheduleRunCollector(object):
+    """
+    Exports the progress of the latest run of each schedule, from the
+    database and the cache, when the metrics are scraped. Nothing is saved.
+    The times are in seconds since the run was triggered.
+    """
+
+    GAUGES = (
+        ("subscriptions", "schedule_run_subscriptions", "Subscriptions queued"),
+        ("sent", "schedule_run_sent", "Subscriptions sent to"),
+        ("failed", "schedule_run_failed", "Subscriptions that couldn't be sent to"),
+        ("queued_at", "schedule_run_queued_seconds", "Time to queue all sends"),
+        ("first_send_at", "schedule_run_first_send_seconds", "Time to first send"),
+        ("last_send_at", "schedule_run_last_send_seconds", "Time to last send"),
+    )
+
+    def describe(self):
+        # Collecting queries the database, so it shouldn't be done when
+        # registering
+        return []
+
+    def collect(self):
+        from contentstore.models import ScheduleRun
+
+        cutoff = now() - timedelta(seconds=settings.SCHEDULE_RUN_TRACKING_TIMEOUT)
+        runs = list(
+            ScheduleRun.objects.filter(triggered_at__gte=cutoff)
+            .order_by("schedule_id", "-triggered_at")
+            .distinct("schedule_id")
+        )
+        ScheduleRun.add_recorded_progress(runs)
+        gauges = []
+        for field, name, documentation in self.GAUGES:
+            gauges.append(
+                (field, GaugeMetricFamily(name, documentation, labels=["schedule"]))
+            )
+        for run in runs:
+            for field, gauge in gauges:
+                value = getattr(run, field)
+                if value is None:
+                    continue
+                if field.endswith("_at"):
+                    value = (value - run.triggered_at).total_seconds()
+                gauge.add_metric([str(run.schedule_id)], value)
+        return [gauge for _, gauge in gauges]
+
+
+schedule_run_collector = ScheduleRunCollector()
+REGISTRY.register(schedule_run_collector)
+
+
+def export_metrics(request):
+    """
+    Exports the metrics, like django_prometheus' view, but including the
+    schedule run metrics when the metrics are combined from multiple
+    processes.
+    """
+    registry = REGISTRY
+    if get_multiprocess_dir():
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        registry.register(schedule_run_collector)
+    return HttpResponse(generate_latest(registry), content_type=CONTENT_TYPE_LATEST)
+
+
+def get_multiprocess_dir():
+    return os.environ.get("prometheus_multiproc_dir") or os.environ.get(
+        "PROMETHEUS_MULTIPROC_DIR"
+    )
+
+
+@worker_process_shutdown.connect
+def mark_worker_process_dead(pid=None, **kwargs):
+    if get_multiprocess_dir():
+        multiprocess.mark_process_dead(pid or os.getpid())
+
+
+@worker_ready.connect
+def start_worker_exporter(**kwargs):
+    """
+    Exports the worker's metrics on PROMETHEUS_WORKER_PORT, if it's set
+    """
+    if not settings.PROMETHEUS_WORKER_PORT:
+        return
+    registry = REGISTRY
+    if get_multiprocess_dir():
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        registry.register(schedule_run_collector)
+    else:
+        logger.warning(
+            "prometheus_multiproc_dir isn't set, so only the metrics of the "
+            "main worker process will be exported"
+        )
+    start_http_server(settings.PROMETHEUS_WORKER_PORT, registry=registry)
@@ -0,0 +1,114 @@
+"""
+Buffering of the metrics that are fired from the workers.
+
+Sending each metric in its own request to the metrics API means thousands of
+tiny requests a day. Instead, each process collects its metrics in a buffer,
+and sends them together in a single request once METRICS_BUFFER_SIZE metrics
+have been collected, once the oldest has waited METRICS_BUFFER_INTERVAL
+seconds, or when the worker shuts down.
+"""
+import logging
+import os
+from threading import Lock, Timer
+
+from celery.signals import worker_process_init, worker_process_shutdown, worker_shutdown
+from django.conf import settings
+
+from seed_stage_based_messaging import clients
+
+logger = logging.getLogger(__name__)
+
+
+def fire_metrics(metrics):
+    """
+    Sends the metrics, a dict of metric name to value, in a single request
+    """
+    clients.get_metrics_client().fire_metrics(**metrics)
+
+
+class MetricBuffer(object):
+    """
+    Collects metrics for the current process, and fires them in batches.
+
+    The metrics API only takes one value for each metric in a request, so if a
+    metric is added that is already in the buffer, the buffer is flushed first
+    instead of the earlier value being lost.
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.reset()
+
+    def reset(self):
+        self.pid = os.getpid()
+        self.metrics = {}
+        self.timer = None
+
+    def _take(self):
+        """
+        Empties the buffer, returning the metrics that were in it. Must be
+        called with the lock held.
+        """
+        if self.pid != os.getpid():
+            self.reset()
+        metrics = self.metrics
+        self.metrics = {}
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        return metrics
+
+    def add(self, name, value):
+        """
+        Adds the metric to the buffer, firing the buffered metrics if it is
+        full.
+        """
+        batches = []
+        with self.lock:
+            if self.pid != os.getpid():
+                self.reset()
+            if name in self.metrics:
+                batches.append(self._take())
+            self.metrics[name] = value
+            if len(self.metrics) >= settings.METRICS_BUFFER_SIZE:
+                batches.append(self._take())
+            elif self.timer is None:
+                self.timer = Timer(settings.METRICS_BUFFER_INTERVAL, self._timeout)
+                self.timer.daemon = True
+                self.timer.start()
+        for metrics in batches:
+            fire_metrics(metrics)
+
+    def flush(self):
+        """
+        Fires all of the buffered metrics. Returns the number of metrics fired.
+        """
+        with self.lock:
+            metrics = self._take()
+        if metrics:
+            fire_metrics(metrics)
+        return len(metrics)
+
+    def _timeout(self):
+        try:
+            self.flush()
+        except Exception:
+            logger.exception("Error firing buffered metrics")
+
+
+metric_buffer = MetricBuffer()
+
+
+@worker_process_init.connect
+def reset_metric_buffer(**kwargs):
+    with metric_buffer.lock:
+        metric_buffer.reset()
+
+
+@worker_process_shutdown.connect
+@worker_shutdown.connect
+def flush_metric_buffer(**kwargs):
+    try:
+        metric_buffer.flush()
+    except Exception:
+        logger.exception("Error firing buffered metrics on shutdown")
@@ -149,11 +149,6 @@ RAVEN_CONFIG = {
 
 CACHES = {
     "default": env.cache(default="locmemcache://"),
-    "locmem": {
-        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
-        "TIMEOUT": 60 * 60,
-        "OPTIONS": {"MAX_ENTRIES": 300000},
-    },
     "redis": env.cache("REDIS_URL", default="locmemcache://"),
 }
 
@@ -195,10 +190,13 @@ CELERY_TASK_ROUTES = {
     "subscriptions.tasks.send_message": {"queue": "send"},
     "subscriptions.tasks.post_send_process_resend": {"queue": "postsend"},
     "subscriptions.tasks.post_send_process": {"queue": "postsend"},
+    "subscriptions.tasks.send_next_message_batch": {"queue": "send"},
+    "subscriptions.tasks.process_subscription_send": {"queue": "send"},
     "subscriptions.tasks.schedule_create": {"queue": "mediumpriority"},
     "subscriptions.tasks.schedule_disable": {"queue": "mediumpriority"},
     "subscriptions.tasks.requeue_failed_tasks": {"queue": "mediumpriority"},
     "subscriptions.tasks.fire_metric": {"queue": "metrics"},
+    "subscriptions.tasks.fire_metrics_batch": {"queue": "metrics"},
     "subscriptions.tasks.scheduled_metrics": {"queue": "metrics"},
     "contentstore.tasks.queue_subscription_send": {"queue": "highmemory"},
     "subscriptions.tasks.find_behind_subscriptions": {"queue": "highmemory"},
@@ -225,7 +223,11 @@ METRICS_SCHEDULED = [
     "subscriptions.send.estimate.5.last",
     "subscriptions.send.estimate.6.last",
 ]
-METRICS_SCHEDULED_TASKS = ["fire_week_estimate_last"]
+METRICS_SCHEDULED_TASKS = [
+    "collect_schedule_runs",
+    "reconcile_schedule_subscription_counts",
+    "fire_week_estimate_last",
+]
 
 CELERY_TASK_SERIALIZER = "json"
 CELERY_RESULT_SERIALIZER = "json"
@@ -265,3 +267,63 @@ DRY_RUN_MESSAGESETS = map(
 )
 
 SUBSCRIPTION_LOCK_TIMEOUT: int = env.int("SUBSCRIPTION_LOCK_TIMEOUT", default=60 * 5)
+
+# The number of subscriptions to send to in each task when a schedule is
+# triggered. 0 queues a separate send chain for every subscription.
+SUBSCRIPTION_SEND_BATCH_SIZE: int = env.int("SUBSCRIPTION_SEND_BATCH_SIZE", default=0)
+
+# Run the whole send chain for a subscription in a single task, instead of
+# passing it through the presend, getidentity, send, and postsend queues.
+SUBSCRIPTION_SEND_SINGLE_TASK: bool = env.bool(
+    "SUBSCRIPTION_SEND_SINGLE_TASK", default=False
+)
+
+# Message content is cached in redis, with a process local LRU in front of it.
+# Changes to content invalidate both, so the redis timeout can be long.
+CONTENT_CACHE_TIMEOUT: int = env.int("CONTENT_CACHE_TIMEOUT", default=60 * 60 * 24)
+CONTENT_CACHE_LOCAL_MAX_ENTRIES: int = env.int(
+    "CONTENT_CACHE_LOCAL_MAX_ENTRIES", default=10000
+)
+# How often, in seconds, each process checks for content changes made by others
+CONTENT_CACHE_VERSION_CHECK_INTERVAL: int = env.int(
+    "CONTENT_CACHE_VERSION_CHECK_INTERVAL", default=10
+)
+
+# Identity addresses are cached for this many seconds when sending in batches
+IDENTITY_ADDRESS_CACHE_TIMEOUT: int = env.int(
+    "IDENTITY_ADDRESS_CACHE_TIMEOUT", default=60 * 5
+)
+# The number of concurrent Identity Store requests made when sending in batches
+IDENTITY_ADDRESS_CONCURRENCY: int = env.int("IDENTITY_ADDRESS_CONCURRENCY", default=10)
+# The number of concurrent Message Sender requests made when sending in batches
+MESSAGE_SENDER_CONCURRENCY: int = env.int("MESSAGE_SENDER_CONCURRENCY", default=10)
+
+# Connection pooling for the seed service API clients. Each worker process
+# keeps up to HTTP_POOL_MAXSIZE connections open to each service, and a client
+# that has been idle for HTTP_CLIENT_IDLE_TIMEOUT seconds gets new connections.
+HTTP_POOL_CONNECTIONS: int = env.int("HTTP_POOL_CONNECTIONS", default=10)
+HTTP_POOL_MAXSIZE: int = env.int("HTTP_POOL_MAXSIZE", default=10)
+HTTP_CLIENT_IDLE_TIMEOUT: int = env.int("HTTP_CLIENT_IDLE_TIMEOUT", default=60)
+
+# The number of Identity Store and Message Sender requests that the asyncio
+# send executor keeps in flight, and the number of subscriptions that it locks
+# and loads from the database at a time.
+ASYNC_SEND_CONCURRENCY: int = env.int("ASYNC_SEND_CONCURRENCY", default=100)
+ASYNC_SEND_BATCH_SIZE: int = env.int("ASYNC_SEND_BATCH_SIZE", default=1000)
+
+# Metrics fired with the fire_metric task are buffered in each worker process,
+# and sent together once METRICS_BUFFER_SIZE have been collected, or once the
+# oldest has waited METRICS_BUFFER_INTERVAL seconds.
+METRICS_BUFFER_SIZE: int = env.int("METRICS_BUFFER_SIZE", default=100)
+METRICS_BUFFER_INTERVAL: float = env.float("METRICS_BUFFER_INTERVAL", default=10)
+
+# The port that Celery workers export their Prometheus metrics on, see
+# seed_stage_based_messaging.instrumentation. Workers don't export them if unset.
+PROMETHEUS_WORKER_PORT: int = env.int("PROMETHEUS_WORKER_PORT", default=None)
+
+# Schedule runs are tracked for up to this many seconds after they're
+# triggered, after which any subscriptions that haven't been sent to are
+# assumed to have failed.
+SCHEDULE_RUN_TRACKING_TIMEOUT: int = env.int(
+    "SCHEDULE_RUN_TRACKING_TIMEOUT", default=60 * 60 * 12
+)
@@ -0,0 +1,55 @@
+from unittest.mock import patch
+
+from django.test import TestCase, override_settings
+
+from .clients import (
+    get_identity_store_client,
+    get_message_sender_client,
+    registry,
+    reset_clients,
+)
+
+
+class ClientRegistryTest(TestCase):
+    def setUp(self):
+        registry.reset()
+
+    def tearDown(self):
+        registry.reset()
+
+    def test_client_reused(self):
+        """
+        The same client should be returned each time, with a connection pool
+        that keeps the client's timeout.
+        """
+        client = get_message_sender_client()
+        self.assertIs(get_message_sender_client(), client)
+        self.assertIsNot(get_identity_store_client(), client)
+
+        adapter = client.session.get_adapter("http://seed-message-sender/")
+        self.assertEqual(adapter._pool_maxsize, 10)
+        self.assertEqual(adapter.timeout, 30)
+
+    def test_reset_after_fork(self):
+        """
+        A new client should be created in a forked process, or when a worker
+        process starts.
+        """
+        client = get_message_sender_client()
+        with patch("os.getpid", return_value=registry.pid + 1):
+            self.assertIsNot(get_message_sender_client(), client)
+
+        client = get_message_sender_client()
+        reset_clients()
+        self.assertIsNot(get_message_sender_client(), client)
+
+    @override_settings(HTTP_CLIENT_IDLE_TIMEOUT=-1)
+    def test_idle_client_replaced(self):
+        """
+        A client that has been idle for too long should be replaced, without
+        closing the old client, which other threads may still be using.
+        """
+        client = get_message_sender_client()
+        with patch.object(client.session, "close") as close:
+            self.assertIsNot(get_message_sender_client(), client)
+        close.assert_not_called()
@@ -0,0 +1,104 @@
+from datetime import timedelta
+
+from django.test import TestCase
+from django.utils.timezone import now
+from prometheus_client import REGISTRY
+
+from contentstore.models import Schedule, ScheduleRun
+
+from . import test_utils as utils
+from .instrumentation import instrument_stage
+
+
+def sample(name, **labels):
+    return REGISTRY.get_sample_value(name, labels) or 0
+
+
+class InstrumentStageTest(TestCase):
+    def test_outcomes(self):
+        """
+        Each call should be timed, and counted by how it ended
+        """
+
+        @instrument_stage("test_stage")
+        def stage(context):
+            if context.get("fail"):
+                context["error"] = "Failed"
+            if context.get("raise"):
+                raise ValueError()
+            return context
+
+        before = {
+            outcome: sample(
+                "send_stage_outcomes_total", stage="test_stage", outcome=outcome
+            )
+            for outcome in ("ok", "failed", "skipped", "ValueError")
+        }
+        count = sample("send_stage_duration_seconds_count", stage="test_stage")
+
+        stage({})
+        stage({"fail": True})
+        stage({"error": "Earlier"})
+        with self.assertRaises(ValueError):
+            stage({"raise": True})
+
+        for outcome, value in before.items():
+            self.assertEqual(
+                sample(
+                    "send_stage_outcomes_total", stage="test_stage", outcome=outcome
+                ),
+                value + 1,
+            )
+        self.assertEqual(
+            sample("send_stage_duration_seconds_count", stage="test_stage"), count + 4
+        )
+
+
+class ScheduleRunCollectorTest(TestCase):
+    def setUp(self):
+        utils.disable_signals()
+
+    def tearDown(self):
+        utils.enable_signals()
+
+    def test_latest_run(self):
+        """
+        The progress of the latest run of each schedule should be exported,
+        with the times in seconds since the run was triggered.
+        """
+        schedule = Schedule.objects.create()
+        ScheduleRun.objects.create(
+            schedule=schedule, subscriptions=5, sent=5, finished=True
+        )
+        ScheduleRun.objects.update(triggered_at=now() - timedelta(hours=1))
+        run = ScheduleRun.objects.create(schedule=schedule, subscriptions=3)
+        ScheduleRun.objects.filter(id=run.id).update(
+            triggered_at=now() - timedelta(minutes=1)
+        )
+        run.refresh_from_db()
+        ScheduleRun.objects.filter(id=run.id).update(
+            queued_at=run.triggered_at + timedelta(seconds=2),
+            first_send_at=run.triggered_at + timedelta(seconds=3),
+            sent=1,
+        )
+        ScheduleRun.record_sends(run.id, failed=1)
+        labels = {"schedule": str(schedule.id)}
+
+        self.assertEqual(
+            REGISTRY.get_sample_value("schedule_run_subscriptions", labels), 3
+        )
+        self.assertEqual(REGISTRY.get_sample_value("schedule_run_sent", labels), 1)
+        self.assertEqual(REGISTRY.get_sample_value("schedule_run_failed", labels), 1)
+        self.assertEqual(
+            REGISTRY.get_sample_value("schedule_run_queued_seconds", labels), 2
+        )
+        self.assertEqual(
+            REGISTRY.get_sample_value("schedule_run_first_send_seconds", labels), 3
+        )
+        self.assertIsNone(
+            REGISTRY.get_sample_value("schedule_run_last_send_seconds", labels)
+        )
+
+        # Collecting the metrics shouldn't save the recorded sends
+        run.refresh_from_db()
+        self.assertEqual(run.failed, 0)
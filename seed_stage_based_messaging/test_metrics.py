@@ -0,0 +1,57 @@
+from unittest.mock import patch
+
+from django.test import TestCase, override_settings
+
+from .metrics import MetricBuffer, flush_metric_buffer, metric_buffer
+
+
+@override_settings(METRICS_BUFFER_SIZE=3, METRICS_BUFFER_INTERVAL=60)
+@patch("seed_stage_based_messaging.metrics.fire_metrics")
+class MetricBufferTest(TestCase):
+    def test_size_threshold(self, fire_metrics):
+        """
+        The metrics should be fired together once the buffer is full
+        """
+        buffer = MetricBuffer()
+        buffer.add("foo.sum", 1.0)
+        buffer.add("bar.last", 2.0)
+        fire_metrics.assert_not_called()
+        buffer.add("baz.avg", 3.0)
+        fire_metrics.assert_called_once_with(
+            {"foo.sum": 1.0, "bar.last": 2.0, "baz.avg": 3.0}
+        )
+        self.assertEqual(buffer.metrics, {})
+        self.assertIsNone(buffer.timer)
+
+    def test_repeated_metric(self, fire_metrics):
+        """
+        Adding a metric that is already in the buffer should fire the buffer
+        first, so that neither value is lost.
+        """
+        buffer = MetricBuffer()
+        buffer.add("foo.sum", 1.0)
+        buffer.add("foo.sum", 1.0)
+        fire_metrics.assert_called_once_with({"foo.sum": 1.0})
+        self.assertEqual(buffer.metrics, {"foo.sum": 1.0})
+        buffer.flush()
+
+    @override_settings(METRICS_BUFFER_INTERVAL=0.01)
+    def test_time_threshold(self, fire_metrics):
+        """
+        The metrics should be fired once the oldest has waited for the buffer
+        interval.
+        """
+        buffer = MetricBuffer()
+        buffer.add("foo.sum", 1.0)
+        buffer.timer.join()
+        fire_metrics.assert_called_once_with({"foo.sum": 1.0})
+        self.assertEqual(buffer.metrics, {})
+
+    def test_worker_shutdown(self, fire_metrics):
+        """
+        Any buffered metrics should be fired when the worker shuts down
+        """
+        metric_buffer.add("foo.sum", 1.0)
+        flush_metric_buffer()
+        fire_metrics.assert_called_once_with({"foo.sum": 1.0})
+        self.assertEqual(metric_buffer.flush(), 0)
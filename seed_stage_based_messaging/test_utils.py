@@ -1,10 +1,14 @@
+from unittest.mock import patch
+from uuid import uuid4
+
+import responses
 from django.db.models.signals import post_delete, post_save
 from django.test import TestCase
 
 from contentstore.models import Schedule
 from contentstore.signals import schedule_deleted, schedule_saved
 
-from .utils import normalise_metric_name
+from .utils import RateLimiter, get_identity_addresses, normalise_metric_name
 
 
 class NormaliseMetricNameTest(TestCase):
@@ -18,6 +22,105 @@ class NormaliseMetricNameTest(TestCase):
         self.assertEqual(normalise_metric_name("_foo!bar,"), "foo_bar")
 
 
+class GetIdentityAddressesTest(TestCase):
+    def add_address_response(self, identity, status=200, results=None):
+        responses.add(
+            responses.GET,
+            "http://seed-identity-store/api/v1/identities/{}/addresses/msisdn".format(
+                identity
+            ),
+            json={"next": None, "previous": None, "results": results or []},
+            status=status,
+        )
+
+    @responses.activate
+    def test_get_identity_addresses(self):
+        """
+        The addresses should be fetched for all of the identities, with
+        identities that have no address mapping to None, and identities whose
+        lookup failed left out.
+        """
+        found, missing, failed = str(uuid4()), str(uuid4()), str(uuid4())
+        self.add_address_response(found, results=[{"address": "+27820001001"}])
+        self.add_address_response(missing)
+        self.add_address_response(failed, status=500)
+
+        addresses = get_identity_addresses(
+            [found, missing, failed], use_communicate_through=True
+        )
+
+        self.assertEqual(addresses, {found: "+27820001001", missing: None})
+        self.assertEqual(len(responses.calls), 3)
+        for call in responses.calls:
+            self.assertIn("use_communicate_through=True", call.request.url)
+
+    @responses.activate
+    def test_get_identity_addresses_malformed(self):
+        """
+        A malformed response for one identity should only fail that lookup.
+        """
+        found, malformed = str(uuid4()), str(uuid4())
+        self.add_address_response(found, results=[{"address": "+27820001001"}])
+        responses.add(
+            responses.GET,
+            "http://seed-identity-store/api/v1/identities/{}/addresses/msisdn".format(
+                malformed
+            ),
+            body="Not JSON",
+            status=200,
+        )
+
+        addresses = get_identity_addresses([found, malformed])
+
+        self.assertEqual(addresses, {found: "+27820001001"})
+
+    @responses.activate
+    def test_get_identity_addresses_cached(self):
+        """
+        Found addresses should be cached, separately for each value of
+        use_communicate_through.
+        """
+        identity = str(uuid4())
+        self.add_address_response(identity, results=[{"address": "+27820001001"}])
+
+        get_identity_addresses([identity])
+        self.assertEqual(get_identity_addresses([identity]), {identity: "+27820001001"})
+        self.assertEqual(len(responses.calls), 1)
+
+        get_identity_addresses([identity], use_communicate_through=True)
+        self.assertEqual(len(responses.calls), 2)
+
+
+class RateLimiterTest(TestCase):
+    @patch("seed_stage_based_messaging.utils.time")
+    def test_rate_limit(self, time):
+        """
+        Calls should be spaced out to the rate limit, without waiting for
+        calls that are already far enough apart.
+        """
+        time.monotonic.return_value = 100
+        limiter = RateLimiter(rate=4)
+        for _ in range(3):
+            limiter.wait()
+        self.assertEqual([c[0][0] for c in time.sleep.call_args_list], [0.25, 0.5])
+
+        time.sleep.reset_mock()
+        time.monotonic.return_value = 200
+        limiter.wait()
+        time.sleep.assert_not_called()
+
+    @patch("seed_stage_based_messaging.utils.time")
+    def test_no_limit(self, time):
+        """
+        If there's no rate, then calls should never wait
+        """
+        time.monotonic.return_value = 100
+        limiter = RateLimiter()
+        for _ in range(3):
+            limiter.wait()
+        time.sleep.assert_not_called()
+
+
 post_save_signals = ((schedule_saved, Schedule),)
 
 
@@ -22,6 +22,7 @@ MESSAGE_SENDER_TOKEN = "REPLACEME"
 
 METRICS_URL = "http://metrics-url"
 METRICS_AUTH_TOKEN = "REPLACEME"
+METRICS_BUFFER_SIZE = 1
 
 PASSWORD_HASHERS = ("django.contrib.auth.hashers.MD5PasswordHasher",)
 
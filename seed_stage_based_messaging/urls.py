@@ -3,11 +3,11 @@ import os
 from django.conf.urls import include, url
 from django.contrib import admin
 from django.urls import path
-from django_prometheus import exports as django_prometheus
 from rest_framework.authtoken.views import obtain_auth_token
 from rest_framework.documentation import include_docs_urls
 
 from seed_stage_based_messaging.decorators import internal_only
+from seed_stage_based_messaging.instrumentation import export_metrics
 from subscriptions import views
 
 admin.site.site_header = os.environ.get(
@@ -24,7 +24,5 @@ urlpatterns = [
     url(r"^", include("subscriptions.urls")),
     url(r"^", include("contentstore.urls")),
     url(r"^docs/", include_docs_urls(title="Seed Stage Based Messaging")),
-    path(
-        "metrics", internal_only(django_prometheus.ExportToDjangoView), name="metrics"
-    ),
+    path("metrics", internal_only(export_metrics), name="metrics"),
 ]
@@ -1,23 +1,24 @@
+import logging
 import random
 import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
 
 from django.conf import settings
-from seed_services_client import IdentityStoreApiClient
+from django.core.cache import caches
 
 from contentstore.models import MessageSet
+from seed_stage_based_messaging.clients import get_identity_store_client
+from seed_stage_based_messaging.instrumentation import SERVICE_REQUEST_DURATION
 
-NORMALISE_METRIC_RE = re.compile(r"\W+")
+logger = logging.getLogger(__name__)
 
-identity_store_client = IdentityStoreApiClient(
-    settings.IDENTITY_STORE_TOKEN,
-    settings.IDENTITY_STORE_URL,
-    retries=5,
-    timeout=settings.DEFAULT_REQUEST_TIMEOUT,
-)
+NORMALISE_METRIC_RE = re.compile(r"\W+")
 
 
 def get_identity(identity_uuid):
-    return identity_store_client.get_identity(identity_uuid)
+    return get_identity_store_client().get_identity(identity_uuid)
 
 
 def normalise_metric_name(name):
@@ -32,7 +33,65 @@ def get_identity_address(identity_uuid, use_communicate_through=False):
     if use_communicate_through:
         params["use_communicate_through"] = True
 
-    return identity_store_client.get_identity_address(identity_uuid, params=params)
+    return get_identity_store_client().get_identity_address(
+        identity_uuid, params=params
+    )
+
+
+def get_identity_addresses(identity_uuids, use_communicate_through=False):
+    """
+    Gets the default address for each of the identities.
+
+    Addresses are cached in redis for IDENTITY_ADDRESS_CACHE_TIMEOUT seconds.
+    The rest are fetched from the Identity Store in parallel, with up to
+    IDENTITY_ADDRESS_CONCURRENCY requests at a time.
+
+    Returns a dict of identity UUID to address, or None if the identity has no
+    address. Identities whose lookup failed are left out.
+    """
+    redis_cache = caches["redis"]
+    cache_keys = {
+        identity_uuid: "identity_address:{}:{}".format(
+            identity_uuid, int(use_communicate_through)
+        )
+        for identity_uuid in set(identity_uuids)
+    }
+    cached = redis_cache.get_many(cache_keys.values())
+    addresses = {
+        identity_uuid: cached[cache_key]
+        for identity_uuid, cache_key in cache_keys.items()
+        if cache_key in cached
+    }
+
+    missing = [uuid for uuid in cache_keys if uuid not in addresses]
+    if not missing:
+        return addresses
+
+    def lookup(identity_uuid):
+        with SERVICE_REQUEST_DURATION.labels("identity_store").time():
+            return get_identity_address(identity_uuid, use_communicate_through)
+
+    with ThreadPoolExecutor(settings.IDENTITY_ADDRESS_CONCURRENCY) as executor:
+        futures = {
+            identity_uuid: executor.submit(lookup, identity_uuid)
+            for identity_uuid in missing
+        }
+
+    found = {}
+    for identity_uuid, future in futures.items():
+        try:
+            address = future.result()
+        except Exception:
+            logger.warning(
+                "Address lookup failed for identity <%s>", identity_uuid, exc_info=True
+            )
+            continue
+        addresses[identity_uuid] = address
+        if address is not None:
+            found[cache_keys[identity_uuid]] = address
+    redis_cache.set_many(found, timeout=settings.IDENTITY_ADDRESS_CACHE_TIMEOUT)
+
+    return addresses
 
 
 def get_available_metrics():
@@ -58,3 +117,28 @@ def calculate_retry_delay(attempt, max_delay=300):
         # and keep the delay nearby the max.
         delay = int(random.uniform(max_delay - 20, max_delay + 20))
     return delay
+
+
+class RateLimiter(object):
+    """
+    Limits the rate of calls to wait, across all threads, to rate calls per
+    second. A rate of 0 or None means there is no limit.
+    """
+
+    def __init__(self, rate=None):
+        self.interval = 1.0 / rate if rate else 0
+        self.next_call = time.monotonic()
+        self.lock = Lock()
+
+    def wait(self):
+        """
+        Blocks until the next call is allowed
+        """
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.monotonic()
+            delay = self.next_call - now
+            self.next_call = max(self.next_call, now) + self.interval
+        if delay > 0:
+            time.sleep(delay)
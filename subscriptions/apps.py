@@ -0,0 +1,10 @@
+from django.apps import AppConfig
+
+
+class SubscriptionsAppConfig(AppConfig):
+    name = "subscriptions"
+
+    def ready(self):
+        import subscriptions.signals
+
+        subscriptions.signals
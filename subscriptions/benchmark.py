@@ -0,0 +1,221 @@
+"""
+Support for the bench_send command, which benchmarks the send pipeline.
+
+The Identity Store, Message Sender, scheduler, and metrics API are replaced by
+local HTTP servers, which answer every request after a configurable latency,
+so that the throughput of the pipeline itself is measured without touching
+the real services.
+
+The stage timings and query counts are read from the Prometheus metrics in
+seed_stage_based_messaging.instrumentation and django_prometheus, so that they
+can be collected from Celery worker processes too. The latency percentiles
+are estimated from the histogram buckets, the same way as Prometheus'
+histogram_quantile.
+"""
+import json
+import time
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from itertools import cycle, islice, product
+from socketserver import ThreadingMixIn
+from threading import Lock, Thread
+from uuid import uuid4
+
+from django.db import transaction
+
+from contentstore.models import Message, MessageSet, Schedule
+from subscriptions.models import ScheduleSubscriptionCount, Subscription
+
+FAKE_ADDRESS = "+27820000000"
+QUANTILES = (0.5, 0.95, 0.99)
+
+
+class FakeServiceHandler(BaseHTTPRequestHandler):
+    """
+    Answers every request after the server's latency. Address lookups return
+    FAKE_ADDRESS, and anything that is created gets a new ID.
+    """
+
+    protocol_version = "HTTP/1.1"
+
+    def respond(self):
+        self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        self.server.record_request()
+        time.sleep(self.server.latency)
+
+        status = 200
+        if self.command == "GET" and "/addresses/" in self.path:
+            data = {
+                "count": 1,
+                "next": None,
+                "previous": None,
+                "results": [{"address": FAKE_ADDRESS}],
+            }
+        elif self.command == "POST":
+            status = 201
+            data = {"id": str(uuid4())}
+        else:
+            data = {}
+
+        body = json.dumps(data).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_GET = do_POST = do_PUT = do_PATCH = do_DELETE = respond
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeService(ThreadingMixIn, HTTPServer):
+    """
+    A local stand-in for one of the seed services, served from a background
+    thread while it is used as a context manager.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, latency=0):
+        super().__init__(("127.0.0.1", 0), FakeServiceHandler)
+        self.latency = latency
+        self.requests = 0
+        self.lock = Lock()
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.server_address
+        return "http://{}:{}/api/v1".format(host, port)
+
+    def record_request(self):
+        with self.lock:
+            self.requests += 1
+
+    def __enter__(self):
+        self.thread = Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.shutdown()
+        self.server_close()
+        self.thread.join()
+
+
+def seed_subscriptions(name, subscriptions, messagesets, languages, messages):
+    """
+    Creates a schedule with `messagesets` messagesets on it, each with
+    `messages` messages in each of the languages, and `subscriptions` active
+    subscriptions spread evenly over the messagesets, languages, and messages.
+
+    Returns the schedule.
+    """
+    schedule = Schedule.objects.create()
+    sets = []
+    for i in range(messagesets):
+        messageset = MessageSet.objects.create(
+            short_name="{}-{}".format(name, i), default_schedule=schedule
+        )
+        sets.append(messageset)
+        for lang in languages:
+            for sequence_number in range(1, messages + 1):
+                Message.objects.create(
+                    messageset=messageset,
+                    lang=lang,
+                    sequence_number=sequence_number,
+                    text_content="Benchmark message {}".format(sequence_number),
+                )
+
+    combinations = islice(
+        cycle(product(range(1, messages + 1), languages, sets)), subscriptions
+    )
+    while True:
+        batch = [
+            Subscription(
+                identity=str(uuid4()),
+                messageset=messageset,
+                schedule=schedule,
+                lang=lang,
+                next_sequence_number=sequence_number,
+            )
+            for sequence_number, lang, messageset in islice(combinations, 1000)
+        ]
+        if not batch:
+            break
+        Subscription.objects.bulk_create(batch)
+    # bulk_create doesn't send the signals that maintain the count
+    ScheduleSubscriptionCount.adjust({schedule.id: subscriptions})
+    return schedule
+
+
+def remove_seeded(schedule):
+    """
+    Removes a schedule created by seed_subscriptions, along with its
+    messagesets, messages, subscriptions, and runs.
+    """
+    with transaction.atomic():
+        Subscription.objects.filter(schedule=schedule).delete()
+        MessageSet.objects.filter(default_schedule=schedule).delete()
+        schedule.delete()
+
+
+def snapshot(families):
+    """
+    Returns the values of all of the samples of the metric families, keyed by
+    the sample name and its labels.
+    """
+    return {
+        (sample.name, tuple(sorted(sample.labels.items()))): sample.value
+        for family in families
+        for sample in family.samples
+    }
+
+
+def difference(after, before):
+    """
+    Returns the change in each sample between two snapshots
+    """
+    return {key: value - before.get(key, 0) for key, value in after.items()}
+
+
+def histogram_quantile(q, buckets):
+    """
+    Estimates the q quantile from cumulative histogram buckets, a list of
+    (upper bound, count) sorted by bound, by interpolating linearly within the
+    bucket that it falls in. Returns None if there are no observations.
+    """
+    if not buckets or not buckets[-1][1]:
+        return None
+    rank = q * buckets[-1][1]
+    lower, below = 0.0, 0
+    for upper, count in buckets:
+        if count >= rank:
+            if upper == float("inf"):
+                return lower
+            return lower + (upper - lower) * (rank - below) / (count - below)
+        lower, below = upper, count
+
+
+def histogram_quantiles(samples, metric, label):
+    """
+    Returns the number of observations and the QUANTILES of the histogram
+    `metric` in the samples, for each value of label.
+    """
+    buckets = defaultdict(list)
+    for (name, labels), value in samples.items():
+        if name == metric + "_bucket":
+            labels = dict(labels)
+            buckets[labels[label]].append((float(labels["le"]), value))
+
+    quantiles = {}
+    for key, values in buckets.items():
+        values.sort()
+        if not values[-1][1]:
+            continue
+        quantiles[key] = {"count": int(values[-1][1])}
+        for q in QUANTILES:
+            quantiles[key]["p{:g}".format(q * 100)] = histogram_quantile(q, values)
+    return quantiles
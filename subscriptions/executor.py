@@ -0,0 +1,147 @@
+"""
+An asyncio executor for the send pipeline.
+
+The Celery send tasks block a whole worker process on every Identity Store
+and Message Sender request. The executor instead keeps many of those requests
+in flight at once from a single process, up to a bounded concurrency, while
+the database reads and writes are still done once per batch of subscriptions.
+
+The seed service clients are built on requests, so each request runs in a
+thread from a pool the size of the concurrency, and is awaited from the event
+loop. HTTP_POOL_MAXSIZE should be raised to match the concurrency, so that
+connections aren't opened and closed for every request.
+"""
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+
+from django.conf import settings
+
+from seed_stage_based_messaging import clients, utils
+from subscriptions.tasks import (
+    build_outbound_payload,
+    build_send_context,
+    complete_send_batch,
+    load_send_batch,
+    lock_send_batch,
+    requeue_post_sends,
+    requeue_send,
+    unlock_subscriptions,
+)
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncSendExecutor(object):
+    """
+    Sends the next message to subscriptions, with up to `concurrency` HTTP
+    requests in flight, and `batch_size` subscriptions locked and loaded at a
+    time.
+    """
+
+    def __init__(self, concurrency=None, batch_size=None):
+        self.concurrency = concurrency or settings.ASYNC_SEND_CONCURRENCY
+        self.batch_size = batch_size or settings.ASYNC_SEND_BATCH_SIZE
+
+    def run(self, subscription_ids):
+        """
+        Sends to all of the subscriptions in the iterable subscription_ids.
+
+        Returns a tuple of the number of subscriptions sent to, and the number
+        of subscriptions given.
+        """
+        loop = asyncio.new_event_loop()
+        try:
+            return loop.run_until_complete(self.send_all(loop, subscription_ids))
+        finally:
+            loop.close()
+
+    async def send_all(self, loop, subscription_ids):
+        self.loop = loop
+        self.semaphore = asyncio.Semaphore(self.concurrency)
+        sent, total = 0, 0
+        subscription_ids = iter(subscription_ids)
+        with ThreadPoolExecutor(self.concurrency) as self.pool:
+            while True:
+                batch = list(islice(subscription_ids, self.batch_size))
+                if not batch:
+                    break
+                sent += await self.send_batch(batch)
+                total += len(batch)
+        return sent, total
+
+    async def call(self, fn, *args):
+        """
+        Runs the blocking function fn in the thread pool, once there is a free
+        slot.
+        """
+        async with self.semaphore:
+            return await self.loop.run_in_executor(self.pool, fn, *args)
+
+    async def send(self, subscription, message):
+        """
+        Looks up the address for the subscription and sends it the message.
+
+        Returns the send context, or None if the identity has no address.
+        """
+        to_addr = await self.call(
+            utils.get_identity_address, subscription.identity, True
+        )
+        if to_addr is None:
+            return None
+
+        context = build_send_context(subscription, message)
+        context["to_addr"] = to_addr
+        if subscription.messageset_id in settings.DRY_RUN_MESSAGESETS:
+            logger.info("Skipping sending of message")
+        else:
+            result = await self.call(
+                clients.get_message_sender_client().create_outbound,
+                build_outbound_payload(context),
+            )
+            context["outbound_id"] = result["id"]
+        return context
+
+    async def send_batch(self, subscription_ids):
+        """
+        Sends to a batch of subscriptions. Subscriptions that fail are handed
+        over to the send_next_message chain, and if moving the sent
+        subscriptions on fails, they're handed over to post_send_process.
+
+        Returns the number of subscriptions that were sent to.
+        """
+        locked_ids = lock_send_batch(subscription_ids)
+        try:
+            pending, set_sizes = load_send_batch(locked_ids)
+            results = await asyncio.gather(
+                *(
+                    self.send(subscription, message)
+                    for subscription, message in pending
+                ),
+                return_exceptions=True
+            )
+
+            sent, invalid = [], []
+            for (subscription, _), result in zip(pending, results):
+                if isinstance(result, Exception):
+                    logger.warning(
+                        "Send failed for <%s>, queuing send",
+                        subscription.id,
+                        exc_info=result,
+                    )
+                    requeue_send(locked_ids, subscription.id)
+                elif result is None:
+                    logger.info("No valid recipient to_addr found")
+                    invalid.append(subscription.id)
+                else:
+                    sent.append((subscription, result))
+
+            try:
+                complete_send_batch(sent, invalid, set_sizes)
+            except Exception:
+                requeue_post_sends(locked_ids, sent)
+                raise
+        finally:
+            unlock_subscriptions(locked_ids)
+        return len(sent)
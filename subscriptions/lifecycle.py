@@ -0,0 +1,273 @@
+"""
+Bulk calculation of where subscriptions are in their lifecycle.
+
+This gives the same results as Subscription.messages_behind and
+Subscription.fast_forward_lifecycle, but for many subscriptions at once. The
+message sets, schedules, and message counts come from the cached messageset
+graph, the subscriptions are read as plain values, and the schedule runs are
+counted with the cron index and closed form counters instead of by iterating
+croniter.
+"""
+from collections import Counter, namedtuple
+from datetime import timedelta
+
+from django.db import transaction
+from django.utils.timezone import now
+
+from contentstore.cache import get_messageset_graph
+from contentstore.cron import count_run_times_between
+from subscriptions.models import (
+    BehindSubscription,
+    ScheduleSubscriptionCount,
+    Subscription,
+)
+
+SUBSCRIPTION_FIELDS = (
+    "id",
+    "messageset_id",
+    "schedule_id",
+    "lang",
+    "created_at",
+    "initial_sequence_number",
+    "next_sequence_number",
+)
+
+
+# Where a subscription in the lifecycle would end up after fast forwarding
+LifecycleStep = namedtuple(
+    "LifecycleStep",
+    ["messageset_id", "schedule_id", "created_at", "next_sequence_number", "completed"],
+)
+
+
+class LifecycleEngine(object):
+    def __init__(self, end_date=None):
+        if end_date is None:
+            end_date = now()
+        self.end_date = end_date
+        self.graph = get_messageset_graph()
+
+    def expected_next_sequence_number(
+        self, messageset_id, schedule_id, lang, created_at, initial
+    ):
+        """
+        Same as Subscription.get_expected_next_sequence_number. Returns a tuple
+        of next_sequence_number, completed.
+        """
+        set_max = self.graph.length(messageset_id, lang)
+        runs = count_run_times_between(
+            self.graph.cron_string(schedule_id), created_at, self.end_date
+        )
+        count = runs + (initial - 1)
+        if count >= set_max:
+            return set_max, True
+        return count + 1, False
+
+    def messages_behind(
+        self,
+        messageset_id,
+        schedule_id,
+        lang,
+        created_at,
+        initial_sequence_number,
+        next_sequence_number,
+    ):
+        """
+        Same as Subscription.messages_behind
+        """
+        behind = 0
+        while True:
+            expected, complete = self.expected_next_sequence_number(
+                messageset_id, schedule_id, lang, created_at, initial_sequence_number
+            )
+            behind += max(0, expected - next_sequence_number)
+            if complete and expected != 0:
+                behind += 1
+
+            next_set_id = self.graph.next_set(messageset_id)
+            if not complete or next_set_id is None:
+                return behind
+
+            last_run = self.graph.last_run_date(
+                messageset_id, schedule_id, lang, created_at, initial_sequence_number
+            )
+            if last_run is not None:
+                created_at = last_run
+            messageset_id = next_set_id
+            schedule_id = self.graph.default_schedule(next_set_id)
+            initial_sequence_number = next_sequence_number = 1
+
+    def fast_forward_lifecycle(
+        self, messageset_id, schedule_id, lang, created_at, initial_sequence_number
+    ):
+        """
+        Same as Subscription.fast_forward_lifecycle, without saving anything.
+        Returns a list of LifecycleSteps, for the subscription, and for each of
+        the subscriptions that would be created after it.
+        """
+        steps = []
+        while True:
+            expected, complete = self.expected_next_sequence_number(
+                messageset_id, schedule_id, lang, created_at, initial_sequence_number
+            )
+            steps.append(
+                LifecycleStep(
+                    messageset_id, schedule_id, created_at, expected, complete
+                )
+            )
+            next_set_id = self.graph.next_set(messageset_id)
+            if not complete or next_set_id is None or not lang:
+                return steps
+
+            last_run = self.graph.last_run_date(
+                messageset_id, schedule_id, lang, created_at, initial_sequence_number
+            )
+            if last_run is None:
+                return steps
+            created_at = last_run + timedelta(minutes=1)
+            messageset_id = next_set_id
+            schedule_id = self.graph.default_schedule(next_set_id)
+            initial_sequence_number = 1
+
+    def expected_position(
+        self, messageset_id, schedule_id, lang, created_at, initial_sequence_number
+    ):
+        """
+        Same as the last subscription of Subscription.fast_forward_lifecycle.
+        Returns a tuple of messageset_id, next_sequence_number.
+        """
+        step = self.fast_forward_lifecycle(
+            messageset_id, schedule_id, lang, created_at, initial_sequence_number
+        )[-1]
+        return step.messageset_id, step.next_sequence_number
+
+    def behind_subscriptions(self, subscriptions):
+        """
+        Returns an unsaved BehindSubscription for each of the subscriptions,
+        given as tuples of SUBSCRIPTION_FIELDS, that is behind.
+        """
+        behind_subscriptions = []
+        for (
+            subscription_id,
+            messageset_id,
+            schedule_id,
+            lang,
+            created_at,
+            initial_sequence_number,
+            next_sequence_number,
+        ) in subscriptions:
+            behind = self.messages_behind(
+                messageset_id,
+                schedule_id,
+                lang,
+                created_at,
+                initial_sequence_number,
+                next_sequence_number,
+            )
+            if behind == 0:
+                continue
+            expected_messageset_id, expected_sequence_number = self.expected_position(
+                messageset_id, schedule_id, lang, created_at, initial_sequence_number
+            )
+            behind_subscriptions.append(
+                BehindSubscription(
+                    subscription_id=subscription_id,
+                    messages_behind=behind,
+                    current_messageset_id=messageset_id,
+                    current_sequence_number=next_sequence_number,
+                    expected_messageset_id=expected_messageset_id,
+                    expected_sequence_number=expected_sequence_number,
+                )
+            )
+        return behind_subscriptions
+
+
+def create_behind_subscriptions(subscriptions, end_date=None, batch_size=1000):
+    """
+    Creates a BehindSubscription for each of the subscriptions in the queryset
+    that is behind, in batches of batch_size.
+
+    Returns the number of BehindSubscriptions created.
+    """
+    engine = LifecycleEngine(end_date)
+    rows = subscriptions.order_by().values_list(*SUBSCRIPTION_FIELDS)
+    created, batch = 0, []
+    for row in rows.iterator(chunk_size=batch_size):
+        batch.append(row)
+        if len(batch) >= batch_size:
+            created += len(
+                BehindSubscription.objects.bulk_create(
+                    engine.behind_subscriptions(batch)
+                )
+            )
+            batch = []
+    if batch:
+        created += len(
+            BehindSubscription.objects.bulk_create(engine.behind_subscriptions(batch))
+        )
+    return created
+
+
+def apply_fast_forwards(fast_forwards):
+    """
+    Saves the results of LifecycleEngine.fast_forward_lifecycle for many
+    subscriptions, in a single transaction.
+
+    Args:
+        fast_forwards (list): (subscription_id, identity, lang, steps) tuples
+
+    Returns the number of new subscriptions created.
+    """
+    timestamp = now()
+    updated, completed, created = [], [], []
+    deltas = Counter()
+    for subscription_id, identity, lang, steps in fast_forwards:
+        first, rest = steps[0], steps[1:]
+        subscription = Subscription(
+            id=subscription_id,
+            next_sequence_number=first.next_sequence_number,
+            updated_at=timestamp,
+        )
+        if first.completed:
+            subscription.mark_as_complete(save=False)
+            completed.append(subscription)
+            deltas[first.schedule_id] -= 1
+        else:
+            updated.append(subscription)
+        for step in rest:
+            subscription = Subscription(
+                identity=identity,
+                lang=lang,
+                messageset_id=step.messageset_id,
+                schedule_id=step.schedule_id,
+                next_sequence_number=step.next_sequence_number,
+            )
+            if step.completed:
+                subscription.mark_as_complete(save=False)
+            else:
+                deltas[step.schedule_id] += 1
+            created.append((subscription, step.created_at))
+
+    with transaction.atomic():
+        Subscription.objects.bulk_update(
+            updated, ["next_sequence_number", "updated_at"]
+        )
+        Subscription.objects.bulk_update(
+            completed,
+            [
+                "next_sequence_number",
+                "completed",
+                "active",
+                "process_status",
+                "updated_at",
+            ],
+        )
+        Subscription.objects.bulk_create(subscription for subscription, _ in created)
+        # created_at is set to now on insert, so it's set separately afterwards
+        for subscription, created_at in created:
+            subscription.created_at = created_at
+        Subscription.objects.bulk_update(
+            [subscription for subscription, _ in created], ["created_at"]
+        )
+        ScheduleSubscriptionCount.adjust(deltas)
+    return len(created)
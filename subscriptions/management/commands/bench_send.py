@@ -0,0 +1,332 @@
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from contextlib import ExitStack, contextmanager
+from itertools import chain
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.test import override_settings
+from django_prometheus.db.metrics import execute_total
+from prometheus_client import CollectorRegistry, multiprocess
+
+from contentstore.models import ScheduleRun
+from contentstore.tasks import queue_subscription_send
+from seed_stage_based_messaging import clients
+from seed_stage_based_messaging.celery import app
+from seed_stage_based_messaging.instrumentation import (
+    SEND_STAGE_DURATION,
+    SERVICE_REQUEST_DURATION,
+)
+from seed_stage_based_messaging.metrics import metric_buffer
+from subscriptions.benchmark import (
+    FakeService,
+    difference,
+    histogram_quantiles,
+    remove_seeded,
+    seed_subscriptions,
+    snapshot,
+)
+
+# How often, in seconds, the run is checked while the workers are sending
+POLL_INTERVAL = 0.1
+
+
+class Command(BaseCommand):
+    help = (
+        "Benchmarks the send pipeline. A schedule is seeded with subscriptions "
+        "across messagesets and languages, and sent to, with local stand-ins "
+        "for the Identity Store, Message Sender, scheduler, and metrics API. "
+        "Reports the messages sent per second, the database queries per "
+        "message, and the latency percentiles of each send stage. The seeded "
+        "data is removed afterwards. The send settings, such as "
+        "SUBSCRIPTION_SEND_BATCH_SIZE, are read from the environment as "
+        "usual. Only run this against a database, cache, and broker that "
+        "aren't used in production."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--subscriptions",
+            type=int,
+            default=1000,
+            help="The number of subscriptions to send to. Defaults to 1000.",
+        )
+        parser.add_argument(
+            "--messagesets",
+            type=int,
+            default=4,
+            help="The number of messagesets to spread them over. Defaults to 4.",
+        )
+        parser.add_argument(
+            "--languages",
+            nargs="+",
+            default=["eng_ZA", "zul_ZA"],
+            help="The languages to spread them over. Defaults to eng_ZA zul_ZA.",
+        )
+        parser.add_argument(
+            "--messages",
+            type=int,
+            default=10,
+            help=(
+                "The number of messages in each messageset, for each "
+                "language. Defaults to 10."
+            ),
+        )
+        parser.add_argument(
+            "--identity-store-latency",
+            type=float,
+            default=0,
+            help="The seconds taken to answer each Identity Store request.",
+        )
+        parser.add_argument(
+            "--message-sender-latency",
+            type=float,
+            default=0,
+            help="The seconds taken to answer each Message Sender request.",
+        )
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=0,
+            help=(
+                "Send with a Celery worker with this many processes, started "
+                "for the benchmark, instead of running the tasks eagerly in "
+                "this process. The worker uses the configured broker."
+            ),
+        )
+        parser.add_argument(
+            "--timeout",
+            type=float,
+            default=600,
+            help=(
+                "The seconds to wait for the worker to start, and for the "
+                "sends to finish. Defaults to 600."
+            ),
+        )
+        parser.add_argument(
+            "--json",
+            action="store_true",
+            default=False,
+            help="Write the results as JSON, to keep track of them over time.",
+        )
+
+    def handle(self, *args, **options):
+        name = "bench_send-{}".format(os.getpid())
+        with ExitStack() as stack:
+            identity_store = stack.enter_context(
+                FakeService(options["identity_store_latency"])
+            )
+            message_sender = stack.enter_context(
+                FakeService(options["message_sender_latency"])
+            )
+            others = stack.enter_context(FakeService())
+            urls = {
+                "IDENTITY_STORE_URL": identity_store.url,
+                "MESSAGE_SENDER_URL": message_sender.url,
+                "SCHEDULER_URL": others.url,
+                "METRICS_URL": others.url,
+            }
+            if options["workers"] > 0:
+                collect = stack.enter_context(
+                    self.start_workers(name, options["workers"], urls, options)
+                )
+            else:
+                collect = stack.enter_context(self.run_eagerly(urls))
+
+            schedule = seed_subscriptions(
+                name,
+                options["subscriptions"],
+                options["messagesets"],
+                options["languages"],
+                options["messages"],
+            )
+            try:
+                results = self.send(schedule, collect, options["timeout"])
+            finally:
+                remove_seeded(schedule)
+
+            results["requests"] = {
+                "identity_store": identity_store.requests,
+                "message_sender": message_sender.requests,
+            }
+
+        if options["json"]:
+            self.stdout.write(json.dumps(results, indent=2, sort_keys=True))
+        else:
+            self.write_results(results)
+
+    @contextmanager
+    def run_eagerly(self, urls):
+        """
+        Runs the tasks in this process, using the fake services. Yields a
+        function that collects the metrics.
+        """
+        always_eager = app.conf.task_always_eager
+        app.conf.task_always_eager = True
+        clients.registry.close()
+        try:
+            with override_settings(**urls):
+                try:
+                    yield lambda: chain(
+                        SEND_STAGE_DURATION.collect(),
+                        SERVICE_REQUEST_DURATION.collect(),
+                        execute_total.collect(),
+                    )
+                finally:
+                    metric_buffer.flush()
+        finally:
+            clients.registry.close()
+            app.conf.task_always_eager = always_eager
+
+    @contextmanager
+    def start_workers(self, name, concurrency, urls, options):
+        """
+        Starts a Celery worker that uses the fake services, and consumes all
+        of the queues. The worker's metrics are combined in a temporary
+        Prometheus multiprocess directory. Yields a function that collects
+        the metrics.
+        """
+        hostname = "{}@{}".format(name, socket.gethostname())
+        queues = {settings.CELERY_TASK_DEFAULT_QUEUE}
+        queues.update(route["queue"] for route in settings.CELERY_TASK_ROUTES.values())
+
+        with tempfile.TemporaryDirectory(prefix="bench_send-") as directory:
+            env = dict(
+                os.environ,
+                prometheus_multiproc_dir=directory,
+                PROMETHEUS_MULTIPROC_DIR=directory,
+                **urls
+            )
+            worker = subprocess.Popen(
+                [
+                    sys.executable,
+                    "-m",
+                    "celery",
+                    "--app",
+                    "seed_stage_based_messaging",
+                    "worker",
+                    "--hostname",
+                    hostname,
+                    "--concurrency",
+                    str(concurrency),
+                    "--queues",
+                    ",".join(sorted(queues)),
+                    "--loglevel",
+                    "WARNING",
+                    "--without-gossip",
+                    "--without-mingle",
+                ],
+                env=env,
+            )
+            try:
+                deadline = time.monotonic() + options["timeout"]
+                while not app.control.ping(destination=[hostname], timeout=1):
+                    if worker.poll() is not None:
+                        raise CommandError(
+                            "The Celery worker exited with status %d"
+                            % worker.returncode
+                        )
+                    if time.monotonic() > deadline:
+                        raise CommandError("Timed out waiting for the Celery worker")
+
+                registry = CollectorRegistry()
+                multiprocess.MultiProcessCollector(registry, path=directory)
+                yield registry.collect
+            finally:
+                worker.terminate()
+                try:
+                    worker.wait(options["timeout"])
+                except subprocess.TimeoutExpired:
+                    worker.kill()
+                    worker.wait()
+
+    def send(self, schedule, collect, timeout):
+        """
+        Sends to all of the subscriptions on the schedule, and waits for the
+        run to finish. Returns the results.
+        """
+        run = ScheduleRun.objects.create(schedule=schedule)
+        before = snapshot(collect())
+        start = time.monotonic()
+        queue_subscription_send.delay(str(schedule.id), run_id=run.id)
+        while True:
+            ScheduleRun.collect_unfinished()
+            run.refresh_from_db()
+            if run.finished:
+                break
+            if time.monotonic() - start > timeout:
+                raise CommandError("Timed out waiting for the sends to finish")
+            time.sleep(POLL_INTERVAL)
+        seconds = time.monotonic() - start
+        samples = difference(snapshot(collect()), before)
+
+        queries = sum(
+            value
+            for (sample, _), value in samples.items()
+            if sample == "django_db_execute_total"
+        )
+        return {
+            "subscriptions": run.subscriptions,
+            "sent": run.sent,
+            "failed": run.failed,
+            "seconds": seconds,
+            "messages_per_second": run.sent / seconds,
+            "queries": int(queries),
+            "queries_per_message": queries / run.sent if run.sent else None,
+            "stages": histogram_quantiles(
+                samples, "send_stage_duration_seconds", "stage"
+            ),
+            "services": histogram_quantiles(
+                samples, "send_service_request_duration_seconds", "service"
+            ),
+        }
+
+    def write_results(self, results):
+        self.stdout.write(
+            "Sent %d of %d messages in %.2fs, %.1f messages/s"
+            % (
+                results["sent"],
+                results["subscriptions"],
+                results["seconds"],
+                results["messages_per_second"],
+            )
+        )
+        if results["queries_per_message"] is not None:
+            self.stdout.write(
+                "%d database queries, %.1f per message"
+                % (results["queries"], results["queries_per_message"])
+            )
+        self.stdout.write(
+            "%d Identity Store and %d Message Sender requests"
+            % (
+                results["requests"]["identity_store"],
+                results["requests"]["message_sender"],
+            )
+        )
+
+        latencies = sorted(results["stages"].items())
+        latencies.extend(
+            ("%s request" % service, quantiles)
+            for service, quantiles in sorted(results["services"].items())
+        )
+        if not latencies:
+            return
+        self.stdout.write(
+            "%-28s %8s %8s %8s %8s" % ("Latency (ms)", "count", "p50", "p95", "p99")
+        )
+        for stage, quantiles in latencies:
+            self.stdout.write(
+                "%-28s %8d %8.1f %8.1f %8.1f"
+                % (
+                    stage,
+                    quantiles["count"],
+                    quantiles["p50"] * 1000,
+                    quantiles["p95"] * 1000,
+                    quantiles["p99"] * 1000,
+                )
+            )
@@ -1,14 +1,20 @@
 import json
+import time
 from datetime import datetime
 
-from django.core.management.base import BaseCommand
 from django.utils import timezone
 
+from subscriptions.lifecycle import (
+    SUBSCRIPTION_FIELDS,
+    LifecycleEngine,
+    apply_fast_forwards,
+)
 from subscriptions.models import Subscription
+from subscriptions.partitions import PartitionedCommand
 from subscriptions.tasks import send_next_message
 
 
-class Command(BaseCommand):
+class Command(PartitionedCommand):
     help = (
         "This command is used when the subscription has fallen behind "
         "schedule. Leave the action argument blank to see how many "
@@ -17,10 +23,15 @@ class Command(BaseCommand):
         "Running the command with `--action fast_forward` will fast "
         "forward the subscriptions that are behind to the end_date. "
         "Running the command with `--action diff` will print out the "
-        "differences that running the command would make."
+        "differences that running the command would make. Use `--bulk` "
+        "to calculate the lifecycles for all of the subscriptions in memory, "
+        "and save the fast forwarded subscriptions in batches. Use "
+        "`--workers` and `--partition` to split the subscriptions between "
+        "processes and hosts."
     )
 
     def add_arguments(self, parser):
+        super(Command, self).add_arguments(parser)
         parser.add_argument(
             "--end_date",
             dest="end_date",
@@ -66,7 +77,43 @@ class Command(BaseCommand):
             ),
         )
 
+        parser.add_argument(
+            "--bulk",
+            dest="bulk",
+            action="store_true",
+            default=False,
+            help=(
+                "Calculate the lifecycles in bulk, and fast forward the "
+                "subscriptions in batches, instead of one at a time."
+            ),
+        )
+        parser.add_argument(
+            "--batch-size",
+            dest="batch_size",
+            default=1000,
+            type=int,
+            help=(
+                "The number of subscriptions to fast forward in each "
+                "transaction in bulk mode. Defaults to 1000."
+            ),
+        )
+
     def handle(self, *args, **options):
+        counts = self.run_partitions(**options)
+        behind, forwards, sends = counts["behind"], counts["forwards"], counts["sends"]
+
+        self.stdout.write(
+            "%s subscription%s behind schedule." % (behind, "" if behind == 1 else "s")
+        )
+        self.stdout.write(
+            "%s subscription%s fast forwarded to end date."
+            % (forwards, "" if forwards == 1 else "s")
+        )
+        self.stdout.write(
+            "Message sent to %s subscription%s." % (sends, "" if sends == 1 else "s")
+        )
+
+    def handle_partition(self, partition, **options):
         action = options["action"]
         verbose = options["verbose"]
         end_date = options["end_date"]
@@ -74,13 +121,37 @@ class Command(BaseCommand):
         message_set = options["message_set"]
         messages_limit = options["messages_limit"]
 
-        behind = 0
-        forwards = 0
-        sends = 0
-
         subscriptions = Subscription.objects.filter(active=True, process_status=0)
         if message_set is not None:
             subscriptions = subscriptions.filter(messageset__pk=message_set)
+        subscriptions = partition.filter(subscriptions)
+
+        if options["bulk"]:
+            handle = self.handle_bulk
+        else:
+            handle = self.handle_each
+        behind, forwards, sends = handle(
+            subscriptions,
+            action,
+            verbose,
+            end_date,
+            messages_limit,
+            options["batch_size"],
+        )
+        return {"behind": behind, "forwards": forwards, "sends": sends}
+
+    def handle_each(
+        self, subscriptions, action, verbose, end_date, messages_limit, batch_size
+    ):
+        """
+        Applies the action to each subscription that is behind, one at a time.
+
+        Returns a tuple of the number of subscriptions behind, fast forwarded,
+        and sent to.
+        """
+        behind = 0
+        forwards = 0
+        sends = 0
 
         for sub in subscriptions.iterator():
             messages_behind = sub.messages_behind()
@@ -121,14 +192,97 @@ class Command(BaseCommand):
                     )
 
                 behind += 1
+        return behind, forwards, sends
 
-        self.stdout.write(
-            "%s subscription%s behind schedule." % (behind, "" if behind == 1 else "s")
-        )
-        self.stdout.write(
-            "%s subscription%s fast forwarded to end date."
-            % (forwards, "" if forwards == 1 else "s")
-        )
-        self.stdout.write(
-            "Message sent to %s subscription%s." % (sends, "" if sends == 1 else "s")
-        )
+    def handle_bulk(
+        self, subscriptions, action, verbose, end_date, messages_limit, batch_size
+    ):
+        """
+        Same as the actions in handle, but the lifecycles are calculated by
+        the LifecycleEngine, and fast forwards are saved a batch at a time.
+
+        Returns a tuple of the number of subscriptions behind, fast forwarded,
+        and sent to.
+        """
+        behind_engine = LifecycleEngine()
+        end_engine = LifecycleEngine(end_date)
+        behind = forwards = sends = processed = 0
+        fast_forwards = []
+        start = time.monotonic()
+
+        def save_fast_forwards():
+            created = apply_fast_forwards(fast_forwards)
+            elapsed = time.monotonic() - start
+            self.stdout.write(
+                "Processed {} subscriptions, fast forwarded {}, created {} "
+                "({:.0f} subscriptions/s)".format(
+                    processed,
+                    forwards,
+                    created,
+                    processed / elapsed if elapsed else processed,
+                )
+            )
+            fast_forwards.clear()
+
+        rows = subscriptions.order_by().values_list(*SUBSCRIPTION_FIELDS, "identity")
+        for row in rows.iterator(chunk_size=batch_size):
+            processed += 1
+            (
+                subscription_id,
+                messageset_id,
+                schedule_id,
+                lang,
+                created_at,
+                initial_sequence_number,
+                next_sequence_number,
+                identity,
+            ) = row
+            position = (
+                messageset_id,
+                schedule_id,
+                lang,
+                created_at,
+                initial_sequence_number,
+            )
+            messages_behind = behind_engine.messages_behind(
+                *position, next_sequence_number
+            )
+
+            if messages_limit is not None and messages_behind > messages_limit:
+                continue
+            if messages_behind == 0:
+                continue
+
+            if verbose:
+                self.stdout.write("{}: {}".format(subscription_id, messages_behind))
+
+            if action == "fast_forward":
+                steps = end_engine.fast_forward_lifecycle(*position)
+                fast_forwards.append((subscription_id, identity, lang, steps))
+                forwards += 1
+                if len(fast_forwards) >= batch_size:
+                    save_fast_forwards()
+            elif action == "send":
+                send_next_message.apply_async(args=[str(subscription_id)])
+                sends += 1
+            elif action == "diff":
+                expected = end_engine.expected_position(*position)
+                self.stdout.write(
+                    json.dumps(
+                        {
+                            "language": lang,
+                            "identity": identity,
+                            "current_messageset_id": messageset_id,
+                            "current_sequence_number": next_sequence_number,
+                            "expected_messageset_id": expected[0],
+                            "expected_sequence_number": expected[1],
+                            "messages_behind": messages_behind,
+                        }
+                    )
+                )
+
+            behind += 1
+
+        if fast_forwards:
+            save_fast_forwards()
+        return behind, forwards, sends
@@ -1,11 +1,24 @@
+import glob
+import os
+import re
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+
 from demands import HTTPServiceError
 from django.conf import settings
-from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
 from django.core.validators import URLValidator
 from requests import exceptions
 from seed_services_client import HubApiClient, IdentityStoreApiClient
 
+from seed_stage_based_messaging.utils import RateLimiter
 from subscriptions.models import Subscription
+from subscriptions.partitions import PartitionedCommand
+
+# The suffix of the checkpoint files of a partitioned run, which records the
+# number of partitions
+CHECKPOINT_SUFFIX_RE = re.compile(r"\.\d+-of-(\d+)$")
 
 
 def url_validator(url_str):
@@ -13,7 +26,7 @@ def url_validator(url_str):
     return url_str
 
 
-class Command(BaseCommand):
+class Command(PartitionedCommand):
     help = (
         "Searches all subscription with status 5 and updates the linked "
         "identity and registration object. This is for excluding the "
@@ -21,6 +34,7 @@ class Command(BaseCommand):
     )
 
     def add_arguments(self, parser):
+        super(Command, self).add_arguments(parser)
         parser.add_argument("--hub-url", type=url_validator, help="The HUB url to use")
         parser.add_argument("--hub-token", type=str, help=("The HUB API token"))
         parser.add_argument(
@@ -41,73 +55,206 @@ class Command(BaseCommand):
             default="mother_id",
             help=("The HUB Identity field"),
         )
+        parser.add_argument(
+            "--concurrency",
+            type=int,
+            default=10,
+            help="The number of subscriptions to update at the same time",
+        )
+        parser.add_argument(
+            "--rate-limit",
+            type=float,
+            default=None,
+            help=(
+                "The maximum number of requests per second to make to the HUB "
+                "and Identity Store combined. The limit is shared between the "
+                "--workers, but applies separately to each host that processes "
+                "a --partition. Defaults to no limit."
+            ),
+        )
+        parser.add_argument(
+            "--checkpoint",
+            type=str,
+            default=None,
+            help=(
+                "A file to save the last processed subscription ID to. If the "
+                "file exists, processing resumes after that subscription. "
+                "When the subscriptions are partitioned, each partition has "
+                "its own file, so a run can only be resumed with the same "
+                "number of --workers and --partition count."
+            ),
+        )
 
     def handle(self, *args, **options):
-        hub_url = options["hub_url"]
-        hub_token = options["hub_token"]
-        id_url = options["identity_url"]
-        id_token = options["identity_token"]
-        hub_id_field = options["hub_identity_field"]
-
-        if not hub_url or not hub_token:
+        if not options["hub_url"] or not options["hub_token"]:
             self.warning("hub-url and hub-token is required.")
             return
 
-        hubApi = HubApiClient(hub_token, hub_url)
-        idApi = IdentityStoreApiClient(id_token, id_url)
+        if options["checkpoint"]:
+            self.check_checkpoints(
+                options["checkpoint"],
+                options["partition"].count * max(options["workers"], 1),
+            )
 
-        subscriptions = Subscription.objects.filter(process_status=5)
+        counts = self.run_partitions(**options)
 
-        reg_count = 0
-        id_count = 0
-        for subscription in subscriptions.iterator():
-            identity = subscription.identity
+        self.success(
+            "Updated %s identities and %s registrations."
+            % (counts["identities"], counts["registrations"])
+        )
 
-            # find and update linked registrations
-            registrations = hubApi.get_registrations({hub_id_field: identity})
+    def handle_partition(self, partition, **options):
+        concurrency = options["concurrency"]
+        self.hub_id_field = options["hub_identity_field"]
+        self.hubApi = HubApiClient(options["hub_token"], options["hub_url"])
+        self.idApi = IdentityStoreApiClient(
+            options["identity_token"], options["identity_url"]
+        )
+        # Each worker process has its own rate limiter, so they each get an
+        # equal share of the limit
+        rate_limit = options["rate_limit"]
+        if rate_limit:
+            rate_limit /= max(options["workers"], 1)
+        self.rate_limiter = RateLimiter(rate_limit)
 
-            for registration in registrations["results"]:
+        subscriptions = partition.filter(Subscription.objects.filter(process_status=5))
+        checkpoint = self.checkpoint_path(options["checkpoint"], partition)
+        last_id = self.read_checkpoint(checkpoint)
+        if last_id:
+            subscriptions = subscriptions.filter(id__gt=last_id)
+        subscriptions = subscriptions.order_by("id").values_list("id", "identity")
 
-                if not registration["data"].get("exclude_report", False):
-                    registration["data"]["exclude_report"] = True
+        counts = Counter()
+        subscriptions = subscriptions.iterator()
+        with ThreadPoolExecutor(concurrency) as pool:
+            while True:
+                batch = list(islice(subscriptions, concurrency * 10))
+                if not batch:
+                    break
+                # An identity with several subscriptions is only updated once
+                identities = list(dict.fromkeys(identity for _, identity in batch))
+                results = pool.map(self.exclude_from_reports, identities)
+                for identity_counts, warnings in results:
+                    counts.update(identity_counts)
+                    for warning in warnings:
+                        self.warning(warning)
+                # Everything up to the end of the batch has been processed
+                self.write_checkpoint(checkpoint, batch[-1][0])
 
-                    try:
-                        hubApi.update_registration(
-                            registration["id"], {"data": registration["data"]}
-                        )
-                        reg_count += 1
-                    except exceptions.ConnectionError as exc:
-                        self.warning("Connection error to Hub API: {}".format(exc))
-                    except HTTPServiceError as exc:
-                        self.warning(
-                            "Invalid Hub API response({}): {}".format(
-                                exc.response.status_code, exc.response.url
-                            )
-                        )
+        return {
+            "identities": counts["identities"],
+            "registrations": counts["registrations"],
+        }
 
-            # find and update linked identities
-            identity = idApi.get_identity(identity)
+    def checkpoint_path(self, checkpoint, partition):
+        """
+        The checkpoint file for the partition
+        """
+        if checkpoint and partition.count > 1:
+            return "{}.{}-of-{}".format(
+                checkpoint, partition.index + 1, partition.count
+            )
+        return checkpoint
 
-            if not identity["details"].get("exclude_report", False):
-                identity["details"]["exclude_report"] = True
+    def check_checkpoints(self, checkpoint, count):
+        """
+        Raises a CommandError if there are checkpoints from a run with a
+        different number of partitions, since they wouldn't be resumed from.
+        """
+        counts = set()
+        if os.path.exists(checkpoint):
+            counts.add(1)
+        for path in glob.glob(glob.escape(checkpoint) + ".*-of-*"):
+            match = CHECKPOINT_SUFFIX_RE.search(path)
+            if match:
+                counts.add(int(match.group(1)))
+        if counts - {count}:
+            raise CommandError(
+                "The checkpoints for {} are from a run with {} partitions, not "
+                "{}. Use the same --workers and --partition count to resume "
+                "it, or remove the checkpoints to start again.".format(
+                    checkpoint, " or ".join(map(str, sorted(counts))), count
+                )
+            )
+
+    def read_checkpoint(self, checkpoint):
+        if not checkpoint or not os.path.exists(checkpoint):
+            return None
+        with open(checkpoint) as f:
+            return f.read().strip() or None
+
+    def write_checkpoint(self, checkpoint, subscription_id):
+        if checkpoint:
+            with open(checkpoint, "w") as f:
+                f.write(str(subscription_id))
+
+    def call(self, fn, *args):
+        """
+        Calls fn, once the rate limit allows it
+        """
+        self.rate_limiter.wait()
+        return fn(*args)
+
+    def exclude_from_reports(self, identity):
+        """
+        Marks the identity, and the registrations linked to it, to be excluded
+        from reports.
+
+        Returns a dict of the number of identities and registrations updated,
+        and a list of warnings.
+        """
+        counts = {"identities": 0, "registrations": 0}
+        warnings = []
+
+        # find and update linked registrations
+        registrations = self.call(
+            self.hubApi.get_registrations, {self.hub_id_field: identity}
+        )
+
+        for registration in registrations["results"]:
+
+            if not registration["data"].get("exclude_report", False):
+                registration["data"]["exclude_report"] = True
 
                 try:
-                    idApi.update_identity(
-                        identity["id"], {"details": identity["details"]}
+                    self.call(
+                        self.hubApi.update_registration,
+                        registration["id"],
+                        {"data": registration["data"]},
                     )
-                    id_count += 1
+                    counts["registrations"] += 1
                 except exceptions.ConnectionError as exc:
-                    self.warning("Connection error to Identity API: {}".format(exc))
+                    warnings.append("Connection error to Hub API: {}".format(exc))
                 except HTTPServiceError as exc:
-                    self.warning(
-                        "Invalid Identity Store API response({}): {}".format(
+                    warnings.append(
+                        "Invalid Hub API response({}): {}".format(
                             exc.response.status_code, exc.response.url
                         )
                     )
 
-        self.success(
-            "Updated %s identities and %s registrations." % (id_count, reg_count)
-        )
+        # find and update linked identities
+        identity = self.call(self.idApi.get_identity, identity)
+
+        if not identity["details"].get("exclude_report", False):
+            identity["details"]["exclude_report"] = True
+
+            try:
+                self.call(
+                    self.idApi.update_identity,
+                    identity["id"],
+                    {"details": identity["details"]},
+                )
+                counts["identities"] += 1
+            except exceptions.ConnectionError as exc:
+                warnings.append("Connection error to Identity API: {}".format(exc))
+            except HTTPServiceError as exc:
+                warnings.append(
+                    "Invalid Identity Store API response({}): {}".format(
+                        exc.response.status_code, exc.response.url
+                    )
+                )
+
+        return counts, warnings
 
     def log(self, level, msg):
         self.stdout.write(level(msg))
@@ -1,9 +1,15 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
 from django.conf import settings
-from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
 from django.core.validators import URLValidator
+from django.db.models import F, Window
+from django.db.models.functions import Lag
 from seed_services_client import SchedulerApiClient
 
 from subscriptions.models import Subscription
+from subscriptions.partitions import PartitionedCommand
 
 
 def url_validator(url_str):
@@ -11,7 +17,7 @@ def url_validator(url_str):
     return url_str
 
 
-class Command(BaseCommand):
+class Command(PartitionedCommand):
     help = "Removes all duplicate subscriptions"
 
     DEFAULT_TIME_DELTA = 60
@@ -26,6 +32,7 @@ class Command(BaseCommand):
     ]
 
     def add_arguments(self, parser):
+        super(Command, self).add_arguments(parser)
         parser.add_argument(
             "--time-delta",
             action="store",
@@ -68,66 +75,119 @@ class Command(BaseCommand):
                 "The schedule API token, defaults to " "settings.SCHEDULER_API_TOKEN"
             ),
         )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=1000,
+            help="The number of duplicates to delete at a time, defaults to 1000",
+        )
+        parser.add_argument(
+            "--concurrency",
+            type=int,
+            default=10,
+            help=(
+                "The number of scheduler deletions to make at the same time, "
+                "defaults to 10"
+            ),
+        )
 
-    def second_diff(self, d1, d2):
-        """
-        Returns the difference, in seconds, between d1 and d2. The amount
-        returned is always positive.
-        """
-        return abs((d1 - d2).total_seconds())
+    def handle(self, *args, **options):
+        # Duplicates have to have the same identity to be in the same partition
+        partitioned = options["workers"] > 1 or options["partition"].count > 1
+        if partitioned and "identity" not in options["fields"]:
+            raise CommandError(
+                "The identity field must be compared to use --workers or --partition"
+            )
 
-    def is_within_limits(self, limit, date, dates):
-        """
-        Returns True if the difference between date and any value in dates
-        is less than or equal to limit.
-        """
-        return any((self.second_diff(date, d) <= limit for d in dates))
+        counts = self.run_partitions(**options)
 
-    def handle(self, *args, **options):
+        self.success("Removed %d duplicate subscriptions." % (counts["removed"],))
+        if counts["schedule_errors"]:
+            self.warning(
+                "Failed to delete %d scheduler schedules."
+                % (counts["schedule_errors"],)
+            )
+
+    def handle_partition(self, partition, **options):
         time_delta = options["time_delta"]
         fields = options["fields"]
         fix = options["fix"]
         scheduler_token = options["scheduler_token"]
         scheduler_url = options["scheduler_url"]
-        removed = 0
+        batch_size = options["batch_size"]
 
         scheduler_client = SchedulerApiClient(scheduler_token, scheduler_url)
 
-        uniques = Subscription.objects.distinct(*fields)
-        for unique in uniques:
-            subscriptions = Subscription.objects.filter(
-                **{field: getattr(unique, field) for field in fields}
+        def delete_schedule(scheduler_id):
+            """
+            Deletes the scheduler schedule, returning the error if it fails, so
+            that one failure doesn't stop the rest from being deleted
+            """
+            try:
+                scheduler_client.delete_schedule(scheduler_id)
+            except Exception as exc:
+                return exc
+
+        # A subscription is a duplicate if it was created within time_delta of
+        # the previous subscription with the same fields, which the database
+        # finds in a single sorted pass over the subscriptions.
+        subscriptions = (
+            partition.filter(Subscription.objects, "identity")
+            .filter(active=True, completed=False)
+            .annotate(
+                previous_created_at=Window(
+                    expression=Lag("created_at"),
+                    partition_by=[F(field) for field in fields],
+                    order_by=[F("created_at").asc(), F("id").asc()],
+                )
             )
-            subscriptions = subscriptions.filter(active=True, completed=False)
-            subscriptions = subscriptions.order_by("created_at")
-            if len(subscriptions) <= 1:
-                continue
-            dates = [subscriptions[0].created_at]
-            for sub in subscriptions[1:]:
-                if self.is_within_limits(time_delta, sub.created_at, dates):
-                    if fix:
-                        scheduler_id = sub.get_scheduler_id()
-                        # NOTE: grabbing the signature of the sub before
-                        #       deleting otherwise the warning below just
-                        #       shows `None` as Django deletes the PK
-                        #       after delete() is called
-                        sub_str = str(sub)
-                        sub.delete()
-                        if scheduler_id:
-                            scheduler_client.delete_schedule(scheduler_id)
-                        else:
-                            self.warning(
-                                "Subscription %s has no scheduler_id." % (sub_str,)
-                            )
-                    else:
+            .order_by()
+            .values_list("id", "metadata", "created_at", "previous_created_at")
+        )
+        limit = timedelta(seconds=time_delta)
+        duplicates = [
+            (subscription_id, (metadata or {}).get("scheduler_schedule_id"))
+            for subscription_id, metadata, created_at, previous in (
+                subscriptions.iterator()
+            )
+            if previous is not None and created_at - previous <= limit
+        ]
+
+        if not fix:
+            for subscription_id, _ in duplicates:
+                self.warning(
+                    "Not removing %s, use --fix to actually remove."
+                    % (subscription_id,)
+                )
+            return {"removed": len(duplicates), "schedule_errors": 0}
+
+        schedule_errors = 0
+        with ThreadPoolExecutor(options["concurrency"]) as pool:
+            for start in range(0, len(duplicates), batch_size):
+                end = start + batch_size
+                batch = duplicates[start:end]
+                Subscription.objects.filter(
+                    id__in=[subscription_id for subscription_id, _ in batch]
+                ).delete()
+                for subscription_id, scheduler_id in batch:
+                    if not scheduler_id:
                         self.warning(
-                            "Not removing %s, use --fix to actually remove." % (sub,)
+                            "Subscription %s has no scheduler_id." % (subscription_id,)
+                        )
+                scheduler_ids = [
+                    scheduler_id for _, scheduler_id in batch if scheduler_id
+                ]
+                for scheduler_id, error in zip(
+                    scheduler_ids, pool.map(delete_schedule, scheduler_ids)
+                ):
+                    if error is not None:
+                        schedule_errors += 1
+                        self.warning(
+                            "Failed to delete scheduler schedule %s: %s"
+                            % (scheduler_id, error)
                         )
 
-                    removed += 1
-                dates.append(sub.created_at)
-
-        self.success("Removed %d duplicate subscriptions." % (removed,))
+        return {"removed": len(duplicates), "schedule_errors": schedule_errors}
 
     def log(self, level, msg):
         self.stdout.write(level(msg))
@@ -1,10 +1,15 @@
 from django.core import exceptions
 from django.core.management.base import BaseCommand
+from django.db import transaction
 from django.db.models import Count
 from django.utils.six.moves import input
 
 from contentstore.models import MessageSet
-from subscriptions.models import Subscription
+from subscriptions.models import (
+    ScheduleSubscriptionCount,
+    Subscription,
+    count_by_schedule,
+)
 
 
 def list_validator(valid_inputs):
@@ -81,7 +86,15 @@ class Command(BaseCommand):
             confirm = self.get_input_data(msg, list_validator(["y", "n"]))
 
         if confirm:
-            rows_updated = records.update(process_status=0)
+            with transaction.atomic():
+                ScheduleSubscriptionCount.adjust(
+                    count_by_schedule(
+                        records.filter(active=True, completed=False).values_list(
+                            "schedule_id", flat=True
+                        )
+                    )
+                )
+                rows_updated = records.update(process_status=0)
             msg = "Updated {0} rows to ready status".format(rows_updated)
             self.stdout.write(self.style.SUCCESS(msg))
         else:
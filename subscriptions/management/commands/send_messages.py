@@ -0,0 +1,76 @@
+import sys
+
+from django.core.management.base import BaseCommand
+
+from subscriptions.executor import AsyncSendExecutor
+from subscriptions.models import Subscription
+
+
+class Command(BaseCommand):
+    help = (
+        "Sends the next message to subscriptions using the asyncio send "
+        "executor, which keeps many Identity Store and Message Sender "
+        "requests in flight at once. The subscription IDs are taken from the "
+        "arguments, from all of the active subscriptions on `--schedule`, or "
+        "otherwise read from stdin, one per line."
+    )
+    stealth_options = ("stdin",)
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "subscription_ids", nargs="*", help="The subscriptions to send to"
+        )
+        parser.add_argument(
+            "--schedule",
+            dest="schedule",
+            type=int,
+            default=None,
+            help="Send to all of the active subscriptions on this schedule.",
+        )
+        parser.add_argument(
+            "--concurrency",
+            dest="concurrency",
+            type=int,
+            default=None,
+            help=(
+                "The maximum number of HTTP requests in flight. Defaults to "
+                "the ASYNC_SEND_CONCURRENCY setting."
+            ),
+        )
+        parser.add_argument(
+            "--batch-size",
+            dest="batch_size",
+            type=int,
+            default=None,
+            help=(
+                "The number of subscriptions to load and update in the "
+                "database at a time. Defaults to the ASYNC_SEND_BATCH_SIZE "
+                "setting."
+            ),
+        )
+
+    def handle(self, *args, **options):
+        if options["schedule"] is not None:
+            subscription_ids = (
+                str(subscription_id)
+                for subscription_id in Subscription.objects.filter(
+                    schedule_id=options["schedule"],
+                    active=True,
+                    completed=False,
+                    process_status=0,
+                )
+                .values_list("id", flat=True)
+                .iterator()
+            )
+        elif options["subscription_ids"]:
+            subscription_ids = options["subscription_ids"]
+        else:
+            stdin = options.get("stdin", sys.stdin)
+            subscription_ids = (line.strip() for line in stdin if line.strip())
+
+        executor = AsyncSendExecutor(
+            concurrency=options["concurrency"], batch_size=options["batch_size"]
+        )
+        sent, total = executor.run(subscription_ids)
+
+        self.stdout.write("Sent to %d of %d subscriptions." % (sent, total))
@@ -0,0 +1,49 @@
+# Generated by Django 2.2.8 on 2026-10-18 03:31
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def count_subscriptions(apps, schema_editor):
+    Subscription = apps.get_model("subscriptions", "Subscription")
+    ScheduleSubscriptionCount = apps.get_model(
+        "subscriptions", "ScheduleSubscriptionCount"
+    )
+    counts = (
+        Subscription.objects.filter(active=True, completed=False, process_status=0)
+        .order_by()
+        .values_list("schedule_id")
+        .annotate(models.Count("id"))
+    )
+    ScheduleSubscriptionCount.objects.bulk_create(
+        ScheduleSubscriptionCount(schedule_id=schedule_id, count=count)
+        for schedule_id, count in counts
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("contentstore", "0011_message_metadata"),
+        ("subscriptions", "0010_add_can_find_behind_subscriptions_permission"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="ScheduleSubscriptionCount",
+            fields=[
+                (
+                    "schedule",
+                    models.OneToOneField(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        primary_key=True,
+                        related_name="subscription_count",
+                        serialize=False,
+                        to="contentstore.Schedule",
+                    ),
+                ),
+                ("count", models.IntegerField(default=0)),
+            ],
+        ),
+        migrations.RunPython(count_subscriptions, migrations.RunPython.noop),
+    ]
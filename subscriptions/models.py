@@ -1,12 +1,17 @@
 import uuid
+from collections import Counter
 from datetime import timedelta
 
 from django.contrib.auth.models import User
 from django.contrib.postgres.fields import JSONField
-from django.db import models
+from django.db import IntegrityError, models, transaction
+from django.db.models import DEFERRED
+from django.db.models.functions import Greatest
 from django.utils.encoding import python_2_unicode_compatible
 from django.utils.timezone import now
 
+from contentstore import cron
+from contentstore.cache import get_messageset_graph
 from contentstore.models import Message, MessageSet, Schedule
 
 
@@ -42,6 +47,49 @@ class Subscription(models.Model):
     )
     user = property(lambda self: self.created_by)
 
+    # The schedule that this subscription was counted against in
+    # ScheduleSubscriptionCount when it was loaded or last saved, see
+    # subscriptions.signals. Queryset updates don't change it, so an instance
+    # loaded before one can move the wrong count when saved; the counts are
+    # corrected by ScheduleSubscriptionCount.reconcile.
+    _counted_schedule_id = None
+
+    # The fields that decide which schedule the subscription is counted
+    # against
+    COUNTED_FIELDS = frozenset(("schedule_id", "active", "completed", "process_status"))
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance.track_counted_schedule()
+        return instance
+
+    def refresh_from_db(self, using=None, fields=None):
+        super().refresh_from_db(using=using, fields=fields)
+        if fields is None or self.COUNTED_FIELDS.intersection(fields):
+            self.track_counted_schedule()
+
+    @property
+    def counted_schedule_id(self):
+        """
+        The schedule whose active subscription count includes this
+        subscription, or None if it isn't active and ready to be sent to.
+        """
+        if self.active and not self.completed and self.process_status == 0:
+            return self.schedule_id
+        return None
+
+    def track_counted_schedule(self):
+        """
+        Records which schedule this subscription is currently counted against,
+        so that the count can be moved when it changes. If any of the fields
+        that it depends on are deferred, it isn't known.
+        """
+        if self.get_deferred_fields() & self.COUNTED_FIELDS:
+            self._counted_schedule_id = DEFERRED
+        else:
+            self._counted_schedule_id = self.counted_schedule_id
+
     def get_scheduler_id(self):
         return self.metadata.get("scheduler_schedule_id")
 
@@ -60,20 +108,22 @@ class Subscription(models.Model):
         if complete and expected != 0:
             behind += 1
 
-        if complete and self.messageset.next_set is not None:
-            try:
-                last_run = self.messageset.get_all_run_dates(
-                    self.created_at,
-                    self.lang,
-                    self.schedule,
-                    self.initial_sequence_number,
-                ).pop()
-            except IndexError:
+        graph = get_messageset_graph(self.messageset_id, self.schedule_id)
+        next_set_id = graph.next_set(self.messageset_id)
+        if complete and next_set_id is not None:
+            last_run = graph.last_run_date(
+                self.messageset_id,
+                self.schedule_id,
+                self.lang,
+                self.created_at,
+                self.initial_sequence_number,
+            )
+            if last_run is None:
                 last_run = self.created_at
             next_sub = Subscription(
                 lang=self.lang,
-                messageset=self.messageset.next_set,
-                schedule=self.messageset.next_set.default_schedule,
+                messageset_id=next_set_id,
+                schedule_id=graph.default_schedule(next_set_id),
                 created_at=last_run,
             )
             return next_sub.messages_behind(end_date, behind)
@@ -88,9 +138,12 @@ class Subscription(models.Model):
         """
         if end_date is None:
             end_date = now()
-        set_max = self.messageset.get_messageset_max(self.lang)
-        runs = self.schedule.get_run_times_between(self.created_at, end_date)
-        count = len(runs) + (self.initial_sequence_number - 1)
+        graph = get_messageset_graph(self.messageset_id, self.schedule_id)
+        set_max = graph.length(self.messageset_id, self.lang)
+        runs = cron.count_run_times_between(
+            graph.cron_string(self.schedule_id), self.created_at, end_date
+        )
+        count = runs + (self.initial_sequence_number - 1)
         if count >= set_max:
             return set_max, True
         else:
@@ -103,7 +156,8 @@ class Subscription(models.Model):
         configured MessageSet's maximum sequence number, returns False
         otherwise.
         """
-        return self.next_sequence_number < self.messageset.get_messageset_max(self.lang)
+        graph = get_messageset_graph(self.messageset_id)
+        return self.next_sequence_number < graph.length(self.messageset_id, self.lang)
 
     def mark_as_complete(self, save=True):
         self.completed = True
@@ -150,7 +204,9 @@ class Subscription(models.Model):
         while not done:
             completed = sub.fast_forward(end_date, save=save)
             if completed:
-                if sub.messageset.next_set:
+                graph = get_messageset_graph(sub.messageset_id, sub.schedule_id)
+                next_set_id = graph.next_set(sub.messageset_id)
+                if next_set_id is not None:
                     # If the sub.lang is None or empty there is a problem with
                     # the data that we can't directly resolve here so we
                     # guard against that breaking things here.
@@ -158,19 +214,19 @@ class Subscription(models.Model):
                         # TODO: what do we do here?
                         break
 
-                    run_dates = sub.messageset.get_all_run_dates(
-                        sub.created_at,
+                    last_date = graph.last_run_date(
+                        sub.messageset_id,
+                        sub.schedule_id,
                         sub.lang,
-                        sub.schedule,
+                        sub.created_at,
                         sub.initial_sequence_number,
                     )
-                    if run_dates:
-                        last_date = run_dates.pop()
+                    if last_date is not None:
                         newsub = Subscription(
                             identity=sub.identity,
                             lang=sub.lang,
-                            messageset=sub.messageset.next_set,
-                            schedule=sub.messageset.next_set.default_schedule,
+                            messageset_id=next_set_id,
+                            schedule_id=graph.default_schedule(next_set_id),
                         )
                         if save:
                             newsub.save()
@@ -204,6 +260,94 @@ class Subscription(models.Model):
         )
 
 
+class ScheduleSubscriptionCount(models.Model):
+    """
+    The number of active subscriptions, that are ready to be sent to, on each
+    schedule. It's updated as subscriptions are created, completed,
+    deactivated, errored, and deleted, so that the send estimates don't have
+    to count the subscriptions.
+
+    The counts are kept up to date on a best effort basis. Updates that
+    bypass them, or that race with them, make them drift, and the
+    subscriptions themselves are the source of truth; reconcile recounts
+    them.
+    """
+
+    schedule = models.OneToOneField(
+        to=Schedule,
+        primary_key=True,
+        on_delete=models.CASCADE,
+        related_name="subscription_count",
+    )
+    count = models.IntegerField(default=0)
+
+    @classmethod
+    def adjust(cls, deltas):
+        """
+        Adds the deltas, a dict of schedule ID to change in count, to the
+        counts. Each count is updated in place, and only created if it
+        doesn't exist yet. Counts are never taken below zero, since they can
+        only get there by drifting. The schedules are updated in order, so
+        that concurrent adjustments can't deadlock.
+        """
+        for schedule_id, delta in sorted(deltas.items()):
+            if not delta:
+                continue
+            counts = cls.objects.filter(schedule_id=schedule_id)
+            count = Greatest(models.F("count") + delta, 0)
+            if counts.update(count=count) or delta < 0:
+                continue
+            try:
+                with transaction.atomic():
+                    cls.objects.create(schedule_id=schedule_id, count=delta)
+            except IntegrityError:
+                # Another transaction created it first
+                counts.update(count=count)
+
+    @classmethod
+    def reconcile(cls):
+        """
+        Recounts the active subscriptions on every schedule, correcting any
+        drift from updates that bypassed the counts.
+
+        Returns the number of schedules whose count was corrected.
+        """
+        with transaction.atomic():
+            counts = dict(
+                cls.objects.select_for_update().values_list("schedule_id", "count")
+            )
+            actual = Subscription.objects.filter(
+                active=True, completed=False, process_status=0
+            )
+            actual = dict(
+                actual.order_by()
+                .values_list("schedule_id")
+                .annotate(models.Count("id"))
+            )
+            deltas = {
+                schedule_id: actual.get(schedule_id, 0) - counts.get(schedule_id, 0)
+                for schedule_id in set(actual) | set(counts)
+            }
+            cls.adjust(deltas)
+        return sum(1 for delta in deltas.values() if delta)
+
+    def __str__(self):
+        return "{}: {}".format(self.schedule_id, self.count)
+
+
+def count_by_schedule(schedule_ids, sign=1):
+    """
+    Returns the deltas for ScheduleSubscriptionCount.adjust, for adding (or
+    with a sign of -1, removing) a subscription on each of the schedule IDs.
+    None is ignored.
+    """
+    deltas = Counter()
+    for schedule_id in schedule_ids:
+        if schedule_id is not None:
+            deltas[schedule_id] += sign
+    return deltas
+
+
 @python_2_unicode_compatible
 class SubscriptionSendFailure(models.Model):
     subscription = models.ForeignKey(Subscription, on_delete=models.CASCADE)
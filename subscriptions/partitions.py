@@ -0,0 +1,166 @@
+"""
+Partitioned execution for the subscription management commands.
+
+The UUID keyspace is split into equal ranges, so that a command can process
+each range in a separate worker process, with `--workers`, or on a separate
+host, with `--partition i/N`. The two can be combined, in which case the
+host's partition is split again between its workers.
+"""
+import multiprocessing
+from argparse import ArgumentTypeError
+from collections import Counter
+from io import StringIO
+from uuid import UUID
+
+from django.core.management.base import BaseCommand, OutputWrapper
+from django.db import connections
+
+UUID_SPACE = 2 ** 128
+
+
+class Partition(object):
+    """
+    The index'th of count equal ranges of the UUID keyspace, with index
+    starting at 0.
+    """
+
+    def __init__(self, index, count):
+        self.index = index
+        self.count = count
+
+    def __repr__(self):
+        return "Partition({}, {})".format(self.index, self.count)
+
+    def __eq__(self, other):
+        return (self.index, self.count) == (other.index, other.count)
+
+    @property
+    def bounds(self):
+        """
+        The (lower, upper) UUID bounds of the range, with the lower bound
+        inclusive and the upper bound exclusive. The first partition has no
+        lower bound, and the last no upper bound, so that together the
+        partitions cover every value, even ones that aren't UUIDs.
+        """
+        lower = upper = None
+        if self.index > 0:
+            lower = UUID(int=UUID_SPACE * self.index // self.count)
+        if self.index < self.count - 1:
+            upper = UUID(int=UUID_SPACE * (self.index + 1) // self.count)
+        return lower, upper
+
+    def split(self, workers):
+        """
+        Splits this partition into one partition for each worker
+        """
+        return [
+            Partition(self.index * workers + i, self.count * workers)
+            for i in range(workers)
+        ]
+
+    def filter(self, queryset, field="id"):
+        """
+        Filters the queryset to the rows whose field is within this partition.
+        The field can either be a UUIDField, or a text field containing UUIDs.
+        """
+        lower, upper = self.bounds
+        if queryset.model._meta.get_field(field).get_internal_type() != "UUIDField":
+            lower = lower and str(lower)
+            upper = upper and str(upper)
+        if lower is not None:
+            queryset = queryset.filter(**{"{}__gte".format(field): lower})
+        if upper is not None:
+            queryset = queryset.filter(**{"{}__lt".format(field): upper})
+        return queryset
+
+
+def partition_type(value):
+    """
+    Parses an i/N partition argument, where i is from 1 to N
+    """
+    try:
+        index, count = (int(part) for part in value.split("/"))
+    except ValueError:
+        raise ArgumentTypeError("Partition must be in the format i/N")
+    if not 1 <= index <= count:
+        raise ArgumentTypeError("Partition must be between 1/N and N/N")
+    return Partition(index - 1, count)
+
+
+# The command and options that are being run by the worker processes. The
+# workers are forked, so they inherit these instead of them being pickled.
+_command = None
+_options = None
+
+
+def _run_partition(partition):
+    stdout = StringIO()
+    _command.stdout = OutputWrapper(stdout)
+    counts = _command.handle_partition(**dict(_options, partition=partition))
+    connections.close_all()
+    return counts, stdout.getvalue()
+
+
+class PartitionedCommand(BaseCommand):
+    """
+    A management command that processes the subscriptions one partition at a
+    time. Subclasses should implement handle_partition, and call
+    run_partitions from handle.
+    """
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=1,
+            help=(
+                "The number of worker processes to split the subscriptions "
+                "between. Defaults to 1."
+            ),
+        )
+        parser.add_argument(
+            "--partition",
+            type=partition_type,
+            default=Partition(0, 1),
+            help=(
+                "Only process the i'th of N equal partitions of the "
+                "subscriptions, in the format i/N. Defaults to all of them."
+            ),
+        )
+
+    def handle_partition(self, partition, **options):
+        """
+        Processes the subscriptions in partition, writing any output to
+        self.stdout. The other options are the same as for handle.
+
+        Returns a dict of counts, which are summed over all of the partitions.
+        """
+        raise NotImplementedError()
+
+    def run_partitions(self, **options):
+        """
+        Runs handle_partition for this process' partition, split between the
+        workers, and returns the summed counts. The output of each worker is
+        written once it has finished, in partition order.
+        """
+        workers = max(options["workers"], 1)
+        partition = options["partition"]
+        if workers == 1:
+            return Counter(self.handle_partition(**options))
+
+        global _command, _options
+        _command, _options = self, options
+        stdout = self.stdout
+        # The workers would otherwise share this process' database connections
+        connections.close_all()
+        totals = Counter()
+        try:
+            with multiprocessing.get_context("fork").Pool(workers) as pool:
+                for counts, output in pool.imap(
+                    _run_partition, partition.split(workers)
+                ):
+                    totals.update(counts)
+                    stdout.write(output, ending="")
+        finally:
+            _command = _options = None
+        return totals
@@ -0,0 +1,58 @@
+"""
+Contains the signal handlers for subscriptions
+"""
+
+from django.db.models import DEFERRED
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from subscriptions.models import (
+    ScheduleSubscriptionCount,
+    Subscription,
+    count_by_schedule,
+)
+
+
+@receiver(post_save, sender=Subscription)
+def subscription_saved(sender, instance, update_fields=None, **kwargs):
+    """
+    Moves the subscription between the active subscription counts of its
+    schedules, if it has been activated, deactivated, or rescheduled. The
+    counts aren't touched if none of the fields they depend on were saved,
+    or changed.
+
+    Arguments:
+        sender {class} -- The model class, always Subscription
+        instance {Subscription} -- The subscription that was saved
+        update_fields {frozenset} -- The fields that were saved, or None for
+            all of them
+    """
+    if update_fields is not None and not Subscription.COUNTED_FIELDS.intersection(
+        sender._meta.get_field(field).attname for field in update_fields
+    ):
+        return
+    previous = instance._counted_schedule_id
+    if previous is DEFERRED:
+        return
+    current = instance.counted_schedule_id
+    if current != previous:
+        deltas = count_by_schedule([current])
+        deltas.update(count_by_schedule([previous], sign=-1))
+        ScheduleSubscriptionCount.adjust(deltas)
+    instance._counted_schedule_id = current
+
+
+@receiver(post_delete, sender=Subscription)
+def subscription_deleted(sender, instance, **kwargs):
+    """
+    Removes the subscription from the active subscription count of its
+    schedule.
+
+    Arguments:
+        sender {class} -- The model class, always Subscription
+        instance {Subscription} -- The subscription that was deleted
+    """
+    previous = instance._counted_schedule_id
+    if previous is not DEFERRED:
+        ScheduleSubscriptionCount.adjust(count_by_schedule([previous], sign=-1))
+    instance._counted_schedule_id = None
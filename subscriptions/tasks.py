@@ -3,8 +3,8 @@ try:
 except ImportError:
     from urllib.parse import urlunparse
 
+from concurrent.futures import ThreadPoolExecutor
 from datetime import timedelta
-from functools import partial
 
 from celery.exceptions import SoftTimeLimitExceeded
 from celery.task import Task
@@ -16,31 +16,41 @@ from django.core import serializers
 from django.core.cache import caches
 from django.core.exceptions import ObjectDoesNotExist
 from django.db import transaction
-from django.db.models import Count, F, Q
+from django.db.models import Count, F
 from django.utils.timezone import now
 from requests.exceptions import ConnectionError, HTTPError, Timeout
-from seed_services_client import MessageSenderApiClient, SchedulerApiClient
 from seed_services_client.metrics import MetricsApiClient
 
-from contentstore.models import Message, Schedule
-from seed_stage_based_messaging import utils
+from contentstore.cache import get_message, get_messages, get_messageset_sizes
+from contentstore.models import Schedule, ScheduleRun
+from seed_stage_based_messaging import clients, utils
 from seed_stage_based_messaging.celery import app
+from seed_stage_based_messaging.instrumentation import (
+    SERVICE_REQUEST_DURATION,
+    SUBSCRIPTION_LOCK_CONTENTION,
+    instrument_stage,
+)
+from seed_stage_based_messaging.metrics import metric_buffer
 
+from .lifecycle import create_behind_subscriptions
 from .models import (
     BehindSubscription,
     EstimatedSend,
     ResendRequest,
+    ScheduleSubscriptionCount,
     Subscription,
     SubscriptionSendFailure,
+    count_by_schedule,
 )
 
 logger = get_task_logger(__name__)
 
-locmem_cache = caches["locmem"]
 redis_cache = caches["redis"]
 
 
 def get_metric_client(session=None):
+    if session is None:
+        return clients.get_metrics_client()
     return MetricsApiClient(
         url=settings.METRICS_URL, auth=settings.METRICS_AUTH, session=session
     )
@@ -55,6 +65,225 @@ def make_absolute_url(path):
     )
 
 
+SEND_CONTEXT_VERSION = 1
+
+
+def build_send_context(subscription, message=None):
+    """
+    Builds the context that is passed between the steps of the send chain.
+
+    The context only contains the IDs and fields of the subscription, its
+    message set, and the message, that the later steps need, so that the task
+    messages stay small and cheap to encode.
+    """
+    messageset = subscription.messageset
+    context = {
+        "version": SEND_CONTEXT_VERSION,
+        "subscription_id": str(subscription.id),
+        "identity": subscription.identity,
+        "lang": subscription.lang,
+        "next_sequence_number": subscription.next_sequence_number,
+        "prepend_next": (subscription.metadata or {}).get("prepend_next_delivery"),
+        "messageset": {
+            "id": messageset.id,
+            "channel": messageset.channel,
+            "content_type": messageset.content_type,
+            "next_set_id": messageset.next_set_id,
+            "next_set_schedule_id": (
+                messageset.next_set.default_schedule_id
+                if messageset.next_set_id
+                else None
+            ),
+        },
+    }
+    if message is not None:
+        context["message"] = {
+            "id": message.id,
+            "text_content": message.text_content,
+            "metadata": message.metadata,
+            "binary_content_url": (
+                message.binary_content.content.url
+                if message.binary_content_id
+                else None
+            ),
+        }
+    return context
+
+
+def load_send_context(context):
+    """
+    Returns the send context in the current format.
+
+    Contexts that were queued before the format was versioned contain Django
+    serialized models, and are converted.
+    """
+    if "version" in context or "subscription" not in context:
+        return context
+
+    [subscription] = serializers.deserialize("json", context.pop("subscription"))
+    subscription = subscription.object
+    [messageset] = serializers.deserialize("json", context.pop("messageset"))
+    subscription.messageset = messageset.object
+    message = None
+    if "message" in context:
+        [message] = serializers.deserialize("json", context.pop("message"))
+        message = message.object
+
+    context.update(build_send_context(subscription, message))
+    return context
+
+
+def clear_prepend_next_delivery(subscription_id):
+    """
+    Clears the prepended content for the next delivery on the subscription.
+    The row is locked while the metadata is updated, so that concurrent
+    changes to the rest of the metadata aren't lost.
+    """
+    with transaction.atomic():
+        subscription = (
+            Subscription.objects.select_for_update()
+            .only("id", "metadata")
+            .get(id=subscription_id)
+        )
+        subscription.metadata["prepend_next_delivery"] = None
+        subscription.save(update_fields=("metadata",))
+
+
+def build_outbound_payload(context):
+    """
+    Builds the Message Sender outbound payload for the message in the send
+    context.
+    """
+    messageset = context["messageset"]
+    message = context["message"]
+    payload = {
+        "to_addr": context["to_addr"],
+        "to_identity": context["identity"],
+        "delivered": "false",
+        "resend": "true" if "resend_id" in context else "false",
+        "metadata": dict(message["metadata"]),
+    }
+
+    if messageset["channel"]:
+        payload["channel"] = messageset["channel"]
+
+    prepend_next = context["prepend_next"]
+    if messageset["content_type"] == "text":
+        logger.debug("Determining payload content")
+        if prepend_next:
+            logger.debug("Prepending next delivery")
+            payload["content"] = "%s\n%s" % (prepend_next, message["text_content"])
+        else:
+            logger.debug("Loading default content")
+            payload["content"] = message["text_content"]
+
+        if message["binary_content_url"]:
+            payload["metadata"]["image_url"] = make_absolute_url(
+                message["binary_content_url"]
+            )
+
+        logger.debug("text content loaded")
+    else:
+        if prepend_next:
+            payload["metadata"]["voice_speech_url"] = [
+                prepend_next,
+                make_absolute_url(message["binary_content_url"]),
+            ]
+        else:
+            payload["metadata"]["voice_speech_url"] = [
+                make_absolute_url(message["binary_content_url"])
+            ]
+
+    return payload
+
+
+def lock_subscriptions(subscription_ids):
+    """
+    Takes the processing lock for each of the subscriptions in
+    subscription_ids.
+
+    Returns the IDs of the subscriptions that were locked. Any subscriptions
+    not returned are already locked by another task.
+    """
+    expiry = now() + timedelta(seconds=settings.SUBSCRIPTION_LOCK_TIMEOUT)
+    locked = [
+        subscription_id
+        for subscription_id in subscription_ids
+        if redis_cache.add(
+            "subscription_lock:{}".format(subscription_id),
+            expiry,
+            timeout=settings.SUBSCRIPTION_LOCK_TIMEOUT,
+        )
+    ]
+    SUBSCRIPTION_LOCK_CONTENTION.inc(len(subscription_ids) - len(locked))
+    return locked
+
+
+def unlock_subscriptions(subscription_ids):
+    redis_cache.delete_many(
+        ["subscription_lock:{}".format(i) for i in subscription_ids]
+    )
+
+
+@instrument_stage("pre_send_process")
+def build_pre_send_context(subscription_id, resend_id=None, run_id=None):
+    """
+    Loads the subscription and the message that should be sent to it, and
+    builds the send context for the rest of the steps. The subscription must
+    already be locked. If the send is part of a ScheduleRun, its ID is kept in
+    the context.
+    """
+    logger.info("Loading Subscription")
+    subscription = Subscription.objects.select_related("messageset__next_set").get(
+        id=subscription_id
+    )
+
+    context = build_send_context(subscription)
+    if resend_id:
+        context["resend_id"] = resend_id
+    if run_id:
+        context["run_id"] = run_id
+
+    if not subscription.is_ready_for_processing:
+        if subscription.process_status == 2 or subscription.completed is True:
+            # Subscription is complete
+            logger.info("Subscription has completed")
+            context["error"] = "Subscription has completed"
+
+        else:
+            logger.info("Message sending aborted - broken or inactive")
+            # TODO: be more specific about why it aborted
+            context["error"] = (
+                "Message sending aborted, status <%s>" % subscription.process_status
+            )
+        return context
+
+    try:
+        logger.info("Loading Message")
+        next_sequence_number = subscription.next_sequence_number
+        if next_sequence_number > 1 and resend_id:
+            next_sequence_number -= 1
+
+        message = get_message(
+            subscription.messageset_id, next_sequence_number, subscription.lang
+        )
+
+        context.update(build_send_context(subscription, message))
+    except ObjectDoesNotExist:
+        error = (
+            "Missing Message: MessageSet: <%s>, Sequence Number: <%s>" ", Lang: <%s>"
+        ) % (
+            subscription.messageset,
+            subscription.next_sequence_number,
+            subscription.lang,
+        )
+        logger.error(error, exc_info=True)
+        context["error"] = "Message sending aborted, missing message"
+        return context
+
+    return context
+
+
 class FireMetric(Task):
 
     """ Fires a metric using the MetricsApiClient
@@ -64,15 +293,34 @@ class FireMetric(Task):
 
     def run(self, metric_name, metric_value, session=None, **kwargs):
         metric_value = float(metric_value)
-        metric = {metric_name: metric_value}
-        metric_client = get_metric_client(session=session)
-        metric_client.fire_metrics(**metric)
+        if session is None:
+            metric_buffer.add(metric_name, metric_value)
+        else:
+            metric_client = get_metric_client(session=session)
+            metric_client.fire_metrics(**{metric_name: metric_value})
         return "Fired metric <%s> with value <%s>" % (metric_name, metric_value)
 
 
 fire_metric = FireMetric()
 
 
+class FireMetricsBatch(Task):
+
+    """ Fires many metrics in a single request using the MetricsApiClient
+    """
+
+    name = "subscriptions.tasks.fire_metrics_batch"
+
+    def run(self, metrics, session=None, **kwargs):
+        metrics = {name: float(value) for name, value in metrics.items()}
+        metric_client = get_metric_client(session=session)
+        metric_client.fire_metrics(**metrics)
+        return "Fired %d metrics" % len(metrics)
+
+
+fire_metrics_batch = FireMetricsBatch()
+
+
 class StoreResendRequest(Task):
 
     """
@@ -105,6 +353,11 @@ class BaseSendMessage(Task):
         code.
         """
 
+    # Whether failing means that the message wasn't sent, and should be
+    # recorded as a failed send for the schedule run. The post send tasks run
+    # after the send has been recorded.
+    records_failed_send = True
+
     def on_failure(self, exc, task_id, args, kwargs, einfo):
         # This function only gets called once all retries have failed, not with
         # each retry, this was tested in real life and is tested on a Celery
@@ -114,9 +367,13 @@ class BaseSendMessage(Task):
         # functionality works
         if isinstance(args[0], dict):
             subscription_id = args[0]["subscription_id"]
+            run_id = args[0].get("run_id")
         else:
             subscription_id = args[0]
+            run_id = args[2] if len(args) > 2 else kwargs.get("run_id")
 
+        if self.records_failed_send:
+            ScheduleRun.record_sends(run_id, failed=1)
         SubscriptionSendFailure.objects.create(
             subscription_id=subscription_id,
             initiated_at=self.request.eta or now(),
@@ -136,116 +393,45 @@ class BaseSendMessage(Task):
     base=BaseSendMessage,
     bind=True,
 )
-def pre_send_process(self, subscription_id, resend_id=None):
+def pre_send_process(self, subscription_id, resend_id=None, run_id=None):
     logger.debug("Locking subscription")
-    key = "subscription_lock:{}".format(subscription_id)
-    locked = not redis_cache.add(
-        key,
-        now() + timedelta(seconds=settings.SUBSCRIPTION_LOCK_TIMEOUT),
-        timeout=settings.SUBSCRIPTION_LOCK_TIMEOUT,
-    )
-    if locked:
-        retry_timestamp = redis_cache.get(key)
+    if not lock_subscriptions([subscription_id]):
+        retry_timestamp = redis_cache.get(
+            "subscription_lock:{}".format(subscription_id)
+        )
         logger.debug("Subscription locked, retrying at {}".format(retry_timestamp))
         self.retry(eta=retry_timestamp)
 
-    context = {}
-    if resend_id:
-        context["resend_id"] = resend_id
-
-    logger.info("Loading Subscription")
-    subscription = Subscription.objects.select_related("messageset").get(
-        id=subscription_id
-    )
-
-    if not subscription.is_ready_for_processing:
-        if subscription.process_status == 2 or subscription.completed is True:
-            # Subscription is complete
-            logger.info("Subscription has completed")
-            context["error"] = "Subscription has completed"
-
-        else:
-            logger.info("Message sending aborted - broken or inactive")
-            # TODO: be more specific about why it aborted
-            context["error"] = (
-                "Message sending aborted, status <%s>" % subscription.process_status
-            )
-        return context
-
-    context.update(
-        {
-            "subscription": serializers.serialize("json", [subscription]),
-            "messageset": serializers.serialize("json", [subscription.messageset]),
-        }
-    )
-
-    try:
-        logger.info("Loading Message")
-        next_sequence_number = subscription.next_sequence_number
-        if next_sequence_number > 1 and resend_id:
-            next_sequence_number -= 1
-
-        message = locmem_cache.get_or_set(
-            "message:{}:{}:{}".format(
-                subscription.messageset_id, next_sequence_number, subscription.lang
-            ),
-            partial(
-                Message.objects.get,
-                messageset=subscription.messageset,
-                sequence_number=next_sequence_number,
-                lang=subscription.lang,
-            ),
-        )
-
-        context["message"] = serializers.serialize("json", [message])
-    except ObjectDoesNotExist:
-        error = (
-            "Missing Message: MessageSet: <%s>, Sequence Number: <%s>" ", Lang: <%s>"
-        ) % (
-            subscription.messageset,
-            subscription.next_sequence_number,
-            subscription.lang,
-        )
-        logger.error(error, exc_info=True)
-        context["error"] = "Message sending aborted, missing message"
-        return context
-
-    return context
+    return build_pre_send_context(subscription_id, resend_id, run_id)
 
 
-@app.task(
-    autoretry_for=(
-        HTTPError,
-        ConnectionError,
-        Timeout,
-        HTTPServiceError,
-        SoftTimeLimitExceeded,
-    ),
-    retry_backoff=True,
-    retry_jitter=True,
-    max_retries=15,
-    acks_late=True,
-    soft_time_limit=10,
-    time_limit=15,
-    base=BaseSendMessage,
-)
-def get_identity_address(context):
+@instrument_stage("get_identity_address")
+def add_identity_address(context):
+    """
+    Looks up the address to send the message in the context to.
+    """
     if "error" in context:
         return context
 
-    [deserialized_subscription] = serializers.deserialize(
-        "json", context["subscription"]
-    )
-    subscription = deserialized_subscription.object
-
-    to_addr = utils.get_identity_address(
-        subscription.identity, use_communicate_through=True
-    )
+    context = load_send_context(context)
+    with SERVICE_REQUEST_DURATION.labels("identity_store").time():
+        to_addr = utils.get_identity_address(
+            context["identity"], use_communicate_through=True
+        )
 
     if to_addr is None:
         logger.info("No valid recipient to_addr found")
-        subscription.process_status = -1
-        deserialized_subscription.save(update_fields=("process_status",))
+        with transaction.atomic():
+            subscriptions = Subscription.objects.filter(id=context["subscription_id"])
+            ScheduleSubscriptionCount.adjust(
+                count_by_schedule(
+                    subscriptions.filter(
+                        active=True, completed=False, process_status=0
+                    ).values_list("schedule_id", flat=True),
+                    sign=-1,
+                )
+            )
+            subscriptions.update(process_status=-1)
 
         context["error"] = "Valid recipient could not be found"
     else:
@@ -270,81 +456,49 @@ def get_identity_address(context):
     time_limit=15,
     base=BaseSendMessage,
 )
-def send_message(context):
-    if "error" in context:
-        return context
-
-    [deserialized_subscription] = serializers.deserialize(
-        "json", context["subscription"]
-    )
-    subscription = deserialized_subscription.object
-    [messageset] = serializers.deserialize("json", context["messageset"])
-    messageset = messageset.object
-    [message] = serializers.deserialize("json", context["message"])
-    message = message.object
-
-    payload = {
-        "to_addr": context["to_addr"],
-        "to_identity": subscription.identity,
-        "delivered": "false",
-        "resend": "true" if "resend_id" in context else "false",
-        "metadata": message.metadata,
-    }
+def get_identity_address(context):
+    return add_identity_address(context)
 
-    if messageset.channel:
-        payload["channel"] = messageset.channel
 
-    prepend_next = (subscription.metadata or {}).get("prepend_next_delivery", None)
-    if messageset.content_type == "text":
-        logger.debug("Determining payload content")
-        if prepend_next:
-            logger.debug("Prepending next delivery")
-            payload["content"] = "%s\n%s" % (prepend_next, message.text_content)
-        else:
-            logger.debug("Loading default content")
-            payload["content"] = message.text_content
-
-        if message.binary_content:
-            payload["metadata"]["image_url"] = make_absolute_url(
-                message.binary_content.content.url
-            )
+@instrument_stage("send_message")
+def send_outbound(context):
+    """
+    Sends the message in the context to the Message Sender.
+    """
+    if "error" in context:
+        ScheduleRun.record_sends(context.get("run_id"), failed=1)
+        return context
 
-        logger.debug("text content loaded")
-    else:
-        if prepend_next:
-            payload["metadata"]["voice_speech_url"] = [
-                prepend_next,
-                make_absolute_url(message.binary_content.content.url),
-            ]
-        else:
-            payload["metadata"]["voice_speech_url"] = [
-                make_absolute_url(message.binary_content.content.url)
-            ]
+    context = load_send_context(context)
+    payload = build_outbound_payload(context)
 
-    if messageset.id in settings.DRY_RUN_MESSAGESETS:
+    if context["messageset"]["id"] in settings.DRY_RUN_MESSAGESETS:
         logger.info("Skipping sending of message")
     else:
         logger.info("Sending message to Message Sender")
-        message_sender_client = MessageSenderApiClient(
-            settings.MESSAGE_SENDER_TOKEN,
-            settings.MESSAGE_SENDER_URL,
-            retries=5,
-            timeout=settings.DEFAULT_REQUEST_TIMEOUT,
-        )
-        result = message_sender_client.create_outbound(payload)
+        message_sender_client = clients.get_message_sender_client()
+        with SERVICE_REQUEST_DURATION.labels("message_sender").time():
+            result = message_sender_client.create_outbound(payload)
         context["outbound_id"] = result["id"]
+    ScheduleRun.record_sends(context.get("run_id"), sent=1)
 
-    if prepend_next:
+    if context["prepend_next"]:
         logger.debug("Clearing prepended message")
-        subscription.metadata["prepend_next_delivery"] = None
-        deserialized_subscription.save(update_fields=("metadata",))
-        context["subscription"] = serializers.serialize("json", [subscription])
+        clear_prepend_next_delivery(context["subscription_id"])
+        context["prepend_next"] = None
 
     logger.debug("Message queued for send. ID: <%s>" % str(context.get("outbound_id")))
     return context
 
 
 @app.task(
+    autoretry_for=(
+        HTTPError,
+        ConnectionError,
+        Timeout,
+        HTTPServiceError,
+        SoftTimeLimitExceeded,
+    ),
     retry_backoff=True,
     retry_jitter=True,
     max_retries=15,
@@ -353,62 +507,63 @@ def send_message(context):
     time_limit=15,
     base=BaseSendMessage,
 )
-def post_send_process(context):
+def send_message(context):
+    return send_outbound(context)
+
+
+@instrument_stage("post_send_process")
+def update_sent_subscription(context):
     """
-    Task to ensure subscription is bumped or converted
+    Moves the subscription on to its next message, or completes it.
     """
     if "error" in context:
         return context
 
-    [deserialized_subscription] = serializers.deserialize(
-        "json", context["subscription"]
-    )
-    subscription = deserialized_subscription.object
-    [messageset] = serializers.deserialize("json", context["messageset"])
-    messageset = messageset.object
+    context = load_send_context(context)
+    subscription_id = context["subscription_id"]
+    messageset = context["messageset"]
 
     # Get set max
-    set_max = locmem_cache.get_or_set(
-        "messageset_size:{}:{}".format(messageset.id, subscription.lang),
-        messageset.messages.filter(lang=subscription.lang).count,
-    )
+    [set_max] = get_messageset_sizes({(messageset["id"], context["lang"])}).values()
     logger.debug("set_max calculated - %s" % set_max)
 
     # Compare user position to max
-    if subscription.next_sequence_number == set_max:
+    if context["next_sequence_number"] == set_max:
         with transaction.atomic():
             # Mark current as completed
             logger.debug("marking current subscription as complete")
-            subscription.completed = True
-            subscription.active = False
-            subscription.process_status = 2  # Completed
-            subscription.updated_at = now()
-            deserialized_subscription.save(
-                update_fields=("completed", "active", "process_status", "updated_at")
+            subscriptions = Subscription.objects.filter(id=subscription_id)
+            ScheduleSubscriptionCount.adjust(
+                count_by_schedule(
+                    subscriptions.filter(
+                        active=True, completed=False, process_status=0
+                    ).values_list("schedule_id", flat=True),
+                    sign=-1,
+                )
+            )
+            subscriptions.update(
+                completed=True, active=False, process_status=2, updated_at=now()
             )
             # If next set defined create new subscription
-            if messageset.next_set:
+            if messageset["next_set_id"]:
                 logger.info("Creating new subscription for next set")
                 newsub = Subscription.objects.create(
-                    identity=subscription.identity,
-                    lang=subscription.lang,
-                    messageset=messageset.next_set,
-                    schedule=messageset.next_set.default_schedule,
+                    identity=context["identity"],
+                    lang=context["lang"],
+                    messageset_id=messageset["next_set_id"],
+                    schedule_id=messageset["next_set_schedule_id"],
                 )
                 logger.debug("Created Subscription <%s>" % newsub.id)
     else:
         # More in this set so increment by one
         logger.debug("incrementing next_sequence_number")
-        subscription.next_sequence_number = F("next_sequence_number") + 1
-        subscription.updated_at = now()
-        logger.debug("saving subscription")
-        deserialized_subscription.save(
-            update_fields=("next_sequence_number", "updated_at")
+        Subscription.objects.filter(id=subscription_id).update(
+            next_sequence_number=F("next_sequence_number") + 1, updated_at=now()
         )
     logger.debug("unlocking the subscription")
-    redis_cache.delete("subscription_lock:{}".format(subscription.id))
+    redis_cache.delete("subscription_lock:{}".format(subscription_id))
     # return response
-    return "Subscription for %s updated" % str(subscription.id)
+    return "Subscription for %s updated" % subscription_id
 
 
 @app.task(
@@ -419,39 +574,424 @@ def post_send_process(context):
     soft_time_limit=10,
     time_limit=15,
     base=BaseSendMessage,
+    records_failed_send=False,
 )
-def post_send_process_resend(context):
-    [message] = serializers.deserialize("json", context["message"])
-    message = message.object
-    [deserialized_subscription] = serializers.deserialize(
-        "json", context["subscription"]
-    )
-    subscription = deserialized_subscription.object
-    resend_request = ResendRequest.objects.get(id=context["resend_id"])
+def post_send_process(context):
+    """
+    Task to ensure subscription is bumped or converted
+    """
+    return update_sent_subscription(context)
+
+
+@instrument_stage("post_send_process_resend")
+def update_resent_subscription(context):
+    """
+    Records the resent message on the resend request.
+    """
+    context = load_send_context(context)
+    resend_fields = {"message_id": context["message"]["id"]}
+    if "outbound_id" in context:
+        resend_fields["outbound"] = context["outbound_id"]
 
     with transaction.atomic():
-        if "outbound_id" in context:
-            resend_request.outbound = context["outbound_id"]
-        resend_request.message_id = message.id
-        resend_request.save(update_fields=("outbound", "message_id"))
-        subscription.process_status = 0
-        subscription.updated_at = now()
-        deserialized_subscription.save(update_fields=("process_status", "updated_at"))
-
-
-send_next_message = (
-    pre_send_process.s()
-    | get_identity_address.s()
-    | send_message.s()
-    | post_send_process.s()
+        ResendRequest.objects.filter(id=context["resend_id"]).update(**resend_fields)
+        subscriptions = Subscription.objects.filter(id=context["subscription_id"])
+        ScheduleSubscriptionCount.adjust(
+            count_by_schedule(
+                subscriptions.filter(active=True, completed=False)
+                .exclude(process_status=0)
+                .values_list("schedule_id", flat=True)
+            )
+        )
+        subscriptions.update(process_status=0, updated_at=now())
+
+
+@app.task(
+    retry_backoff=True,
+    retry_jitter=True,
+    max_retries=15,
+    acks_late=True,
+    soft_time_limit=10,
+    time_limit=15,
+    base=BaseSendMessage,
+    records_failed_send=False,
 )
+def post_send_process_resend(context):
+    return update_resent_subscription(context)
 
-send_current_message = (
-    pre_send_process.s()
-    | get_identity_address.s()
-    | send_message.s()
-    | post_send_process_resend.s()
+
+@app.task(
+    max_retries=15,
+    acks_late=True,
+    soft_time_limit=30,
+    time_limit=45,
+    base=BaseSendMessage,
+    bind=True,
 )
+def process_subscription_send(self, subscription_id, resend_id=None, run_id=None):
+    """
+    Runs all the steps of the send chain for the subscription in this worker,
+    instead of passing the context through the broker between each step.
+
+    Identity Store and Message Sender errors retry the whole task. If the
+    post send step fails after the message has been sent, it is queued as a
+    separate task instead, so that the message isn't sent again.
+    """
+    logger.debug("Locking subscription")
+    if not lock_subscriptions([subscription_id]):
+        retry_timestamp = redis_cache.get(
+            "subscription_lock:{}".format(subscription_id)
+        )
+        logger.debug("Subscription locked, retrying at {}".format(retry_timestamp))
+        self.retry(eta=retry_timestamp)
+
+    try:
+        context = build_pre_send_context(subscription_id, resend_id, run_id)
+        context = add_identity_address(context)
+        context = send_outbound(context)
+    except (
+        HTTPError,
+        ConnectionError,
+        Timeout,
+        HTTPServiceError,
+        SoftTimeLimitExceeded,
+    ) as exc:
+        unlock_subscriptions([subscription_id])
+        self.retry(exc=exc, countdown=utils.calculate_retry_delay(self.request.retries))
+    except Exception:
+        unlock_subscriptions([subscription_id])
+        raise
+
+    try:
+        if resend_id:
+            return update_resent_subscription(context)
+        return update_sent_subscription(context)
+    except Exception:
+        logger.warning(
+            "Post send failed for <%s>, queuing post send",
+            subscription_id,
+            exc_info=True,
+        )
+        if resend_id:
+            post_send_process_resend.delay(context)
+        else:
+            post_send_process.delay(context)
+
+
+if settings.SUBSCRIPTION_SEND_SINGLE_TASK:
+    send_next_message = process_subscription_send.s()
+    send_current_message = process_subscription_send.s()
+else:
+    send_next_message = (
+        pre_send_process.s()
+        | get_identity_address.s()
+        | send_message.s()
+        | post_send_process.s()
+    )
+
+    send_current_message = (
+        pre_send_process.s()
+        | get_identity_address.s()
+        | send_message.s()
+        | post_send_process_resend.s()
+    )
+
+
+def post_send_process_batch(subscriptions, set_sizes):
+    """
+    Moves all of the subscriptions on to their next message, with one update
+    for the subscriptions that are continuing and one for the subscriptions
+    that have completed. Completed subscriptions are moved on to the next
+    message set, if there is one.
+
+    Args:
+        subscriptions (list): The Subscriptions that were sent a message
+        set_sizes (dict): (messageset_id, lang) to message count
+    """
+    completed, continuing = [], []
+    for subscription in subscriptions:
+        set_max = set_sizes[(subscription.messageset_id, subscription.lang)]
+        if subscription.next_sequence_number == set_max:
+            completed.append(subscription)
+        else:
+            continuing.append(subscription)
+
+    with transaction.atomic():
+        if continuing:
+            logger.debug("incrementing %d subscriptions", len(continuing))
+            Subscription.objects.filter(id__in=[s.id for s in continuing]).update(
+                next_sequence_number=F("next_sequence_number") + 1, updated_at=now()
+            )
+        if completed:
+            logger.debug("marking %d subscriptions as complete", len(completed))
+            Subscription.objects.filter(id__in=[s.id for s in completed]).update(
+                completed=True, active=False, process_status=2, updated_at=now()
+            )
+            created = Subscription.objects.bulk_create(
+                Subscription(
+                    identity=s.identity,
+                    lang=s.lang,
+                    messageset_id=s.messageset.next_set_id,
+                    schedule_id=s.messageset.next_set.default_schedule_id,
+                )
+                for s in completed
+                if s.messageset.next_set_id
+            )
+            deltas = count_by_schedule(s.schedule_id for s in created)
+            deltas.update(
+                count_by_schedule((s.counted_schedule_id for s in completed), sign=-1)
+            )
+            ScheduleSubscriptionCount.adjust(deltas)
+
+
+def lock_send_batch(subscription_ids, run_id=None):
+    """
+    Locks the subscriptions for sending. Subscriptions that are already locked
+    are handed over to the send_next_message chain, which will retry once the
+    lock expires.
+
+    Returns the set of subscription IDs that were locked.
+    """
+    locked_ids = set(lock_subscriptions(subscription_ids))
+    for subscription_id in subscription_ids:
+        if subscription_id not in locked_ids:
+            logger.info("Subscription <%s> locked, queuing send", subscription_id)
+            send_next_message.delay(subscription_id, None, run_id)
+    return locked_ids
+
+
+def load_send_batch(subscription_ids):
+    """
+    Loads the subscriptions that are ready to be sent to, along with their next
+    messages and the messageset sizes, in a constant number of queries.
+    Subscriptions whose next message is missing are logged and left out.
+
+    Returns a list of (subscription, message) tuples, and a dict of
+    (messageset_id, lang) to messageset size.
+    """
+    subscriptions = [
+        subscription
+        for subscription in Subscription.objects.select_related(
+            "messageset__next_set"
+        ).filter(id__in=subscription_ids)
+        if subscription.is_ready_for_processing
+    ]
+    messages = get_messages(
+        {(s.messageset_id, s.next_sequence_number, s.lang) for s in subscriptions}
+    )
+    set_sizes = get_messageset_sizes({(s.messageset_id, s.lang) for s in subscriptions})
+
+    pending = []
+    for subscription in subscriptions:
+        message = messages.get(
+            (
+                subscription.messageset_id,
+                subscription.next_sequence_number,
+                subscription.lang,
+            )
+        )
+        if message is None:
+            logger.error(
+                "Missing Message: MessageSet: <%s>, Sequence Number: <%s>"
+                ", Lang: <%s>",
+                subscription.messageset,
+                subscription.next_sequence_number,
+                subscription.lang,
+            )
+            continue
+        pending.append((subscription, message))
+    return pending, set_sizes
+
+
+def requeue_send(locked_ids, subscription_id, run_id=None):
+    """
+    Unlocks the subscription and hands it over to the send_next_message chain,
+    so that it gets the normal retry and failure handling.
+    """
+    locked_ids.discard(str(subscription_id))
+    unlock_subscriptions([subscription_id])
+    send_next_message.delay(str(subscription_id), None, run_id)
+
+
+def requeue_post_sends(locked_ids, sent):
+    """
+    Hands the sent subscriptions over to the post_send_process task, when
+    moving them on as a batch failed. They mustn't be unlocked without being
+    moved on, or their messages would be sent again.
+    """
+    logger.warning("Post send failed for batch, queuing post sends", exc_info=True)
+    for subscription, context in sent:
+        locked_ids.discard(str(subscription.id))
+        post_send_process.delay(context)
+
+
+def complete_send_batch(sent, invalid, set_sizes):
+    """
+    Moves the sent subscriptions on to their next message, and marks the
+    invalid subscriptions as broken.
+
+    Args:
+        sent (list): (subscription, context) tuples for the sent messages
+        invalid (list): IDs of the subscriptions without a valid address
+        set_sizes (dict): Messageset sizes, from load_send_batch
+    """
+    for subscription, context in sent:
+        if context["prepend_next"]:
+            logger.debug("Clearing prepended message")
+            clear_prepend_next_delivery(subscription.id)
+    if invalid:
+        with transaction.atomic():
+            subscriptions = Subscription.objects.filter(id__in=invalid)
+            ScheduleSubscriptionCount.adjust(
+                count_by_schedule(
+                    subscriptions.filter(
+                        active=True, completed=False, process_status=0
+                    ).values_list("schedule_id", flat=True),
+                    sign=-1,
+                )
+            )
+            subscriptions.update(process_status=-1)
+    post_send_process_batch([subscription for subscription, _ in sent], set_sizes)
+
+
+def create_outbounds(payloads):
+    """
+    Creates an outbound on the Message Sender for each of the payloads, with up
+    to MESSAGE_SENDER_CONCURRENCY requests at a time.
+
+    Args:
+        payloads (dict): The outbound payloads, keyed by subscription ID
+
+    Returns a dict of subscription ID to the ID of the created outbound.
+    Subscriptions whose outbound couldn't be created are left out.
+    """
+    if not payloads:
+        return {}
+
+    message_sender_client = clients.get_message_sender_client()
+
+    def create_outbound(payload):
+        with SERVICE_REQUEST_DURATION.labels("message_sender").time():
+            return message_sender_client.create_outbound(payload)
+
+    with ThreadPoolExecutor(settings.MESSAGE_SENDER_CONCURRENCY) as executor:
+        futures = {
+            subscription_id: executor.submit(create_outbound, payload)
+            for subscription_id, payload in payloads.items()
+        }
+
+    outbound_ids = {}
+    for subscription_id, future in futures.items():
+        try:
+            outbound_ids[subscription_id] = future.result()["id"]
+        except Exception:
+            logger.warning(
+                "Send failed for <%s>, queuing send", subscription_id, exc_info=True
+            )
+    return outbound_ids
+
+
+def prepare_send_batch(locked_ids, run_id=None):
+    """
+    Loads the locked subscriptions, and looks up their addresses. Any
+    subscription whose address lookup failed is handed over to the
+    send_next_message chain.
+
+    Returns a list of (subscription, context) tuples for the subscriptions
+    that are ready to be sent to, a dict of subscription ID to outbound
+    payload for those that aren't dry runs, a list of the IDs of the
+    subscriptions without a valid address, and the messageset sizes.
+    """
+    pending, set_sizes = load_send_batch(locked_ids)
+    addresses = utils.get_identity_addresses(
+        {s.identity for s, _ in pending}, use_communicate_through=True
+    )
+
+    ready, payloads, invalid = [], {}, []
+    for subscription, message in pending:
+        if subscription.identity not in addresses:
+            logger.warning(
+                "Address lookup failed for <%s>, queuing send", subscription.id
+            )
+            requeue_send(locked_ids, subscription.id, run_id)
+            continue
+        to_addr = addresses[subscription.identity]
+        if to_addr is None:
+            logger.info("No valid recipient to_addr found")
+            invalid.append(subscription.id)
+            continue
+
+        context = build_send_context(subscription, message)
+        context["to_addr"] = to_addr
+        ready.append((subscription, context))
+        if subscription.messageset_id in settings.DRY_RUN_MESSAGESETS:
+            logger.info("Skipping sending of message")
+        else:
+            payloads[subscription.id] = build_outbound_payload(context)
+    return ready, payloads, invalid, set_sizes
+
+
+@app.task(acks_late=True)
+@instrument_stage("send_batch")
+def send_next_message_batch(subscription_ids, run_id=None):
+    """
+    Sends the next message to all of the subscriptions in subscription_ids.
+
+    The chunk is locked, loaded, and updated with a constant number of cache
+    and database requests, and each distinct message is only fetched once.
+
+    The identities' addresses are looked up in parallel, and cached, and the
+    outbounds are then created in parallel.
+
+    Any subscription that can't be sent to, either because it is already
+    locked or because of an error talking to the Identity Store or Message
+    Sender, is handed over to the send_next_message chain, so that it gets the
+    normal retry and failure handling. If preparing the batch fails before
+    anything is sent, the whole chunk is handed over.
+
+    If moving the sent subscriptions on fails, each of them is handed over to
+    the post_send_process task instead, so that their messages aren't sent
+    again.
+
+    Args:
+        subscription_ids (list): IDs of the subscriptions to send to
+        run_id (int): The ScheduleRun that the subscriptions are being sent for
+    """
+    locked_ids = lock_send_batch(subscription_ids, run_id)
+    try:
+        try:
+            ready, payloads, invalid, set_sizes = prepare_send_batch(locked_ids, run_id)
+        except Exception:
+            # Nothing has been sent yet, so each subscription can still be
+            # sent to separately, with the normal retry and failure handling
+            logger.warning("Preparing batch failed, queuing sends", exc_info=True)
+            for subscription_id in sorted(locked_ids):
+                requeue_send(locked_ids, subscription_id, run_id)
+            raise
+
+        outbound_ids = create_outbounds(payloads)
+
+        sent = []
+        for subscription, context in ready:
+            if subscription.id in payloads and subscription.id not in outbound_ids:
+                requeue_send(locked_ids, subscription.id, run_id)
+            else:
+                sent.append((subscription, context))
+
+        # Anything still locked wasn't handed over, so was either sent or
+        # couldn't be sent to
+        ScheduleRun.record_sends(
+            run_id, sent=len(sent), failed=len(locked_ids) - len(sent)
+        )
+        try:
+            complete_send_batch(sent, invalid, set_sizes)
+        except Exception:
+            requeue_post_sends(locked_ids, sent)
+            raise
+    finally:
+        unlock_subscriptions(locked_ids)
+
+    return "Sent to %d of %d subscriptions" % (len(sent), len(subscription_ids))
 
 
 class ScheduleDisable(Task):
@@ -462,7 +1002,7 @@ class ScheduleDisable(Task):
     name = "subscriptions.tasks.schedule_disable"
 
     def scheduler_client(self):
-        return SchedulerApiClient(settings.SCHEDULER_API_TOKEN, settings.SCHEDULER_URL)
+        return clients.get_scheduler_client()
 
     def run(self, subscription_id, **kwargs):
         log = self.get_logger(**kwargs)
@@ -522,40 +1062,56 @@ class FireWeekEstimateLast(Task):
     name = "subscriptions.tasks.fire_week_estimate_last"
 
     def run(self):
-        schedules = Schedule.objects.filter(
-            subscriptions__active=True,
-            subscriptions__completed=False,
-            subscriptions__process_status=0,
-        ).annotate(total_subs=Count("subscriptions"))
-        totals = {0: 0, 1: 0, 2: 0, 3: 0, 4: 0, 5: 0, 6: 0}
-        for schedule in schedules:
-            for day in range(7):
-                if str(day) in schedule.day_of_week or "*" in schedule.day_of_week:
-                    totals[day] = totals[day] + schedule.total_subs
-
         # Django's datetime's weekday method has Monday = 0
         # whereas the cron format used in the schedules has Sunday = 0
-        sunday = totals.pop(0)
-        totals[7] = sunday
-        totals = {(k - 1): v for k, v in totals.items()}
-
         today = now()
-        for dow, total in totals.items():
-            # Only fire the metric for today or days in the future so that
-            # estimates for the week don't get updated after the day in
-            # question.
-            if dow >= (today.weekday()):
-                fire_metric.apply_async(
-                    kwargs={
-                        "metric_name": "subscriptions.send.estimate.%s.last" % dow,
-                        "metric_value": total,
-                    }
-                )
+        monday = today.date() - timedelta(days=today.weekday())
+        totals = [0] * 7
+        counts = ScheduleSubscriptionCount.objects.filter(count__gt=0).select_related(
+            "schedule"
+        )
+        for count in counts:
+            for dow in range(7):
+                if count.schedule.runs_on(monday + timedelta(days=dow)):
+                    totals[dow] += count.count
+
+        # Only fire the metric for today or days in the future so that
+        # estimates for the week don't get updated after the day in
+        # question.
+        fire_metrics_batch.apply_async(
+            kwargs={
+                "metrics": {
+                    "subscriptions.send.estimate.%s.last" % dow: total
+                    for dow, total in enumerate(totals)
+                    if dow >= today.weekday()
+                }
+            }
+        )
 
 
 fire_week_estimate_last = FireWeekEstimateLast()
 
 
+@app.task
+def reconcile_schedule_subscription_counts():
+    """
+    Recounts the active subscriptions on each schedule, correcting any drift
+    in the counts that the send estimates are made from.
+    """
+    corrected = ScheduleSubscriptionCount.reconcile()
+    return "Corrected %d schedule subscription counts" % corrected
+
+
+@app.task
+def collect_schedule_runs():
+    """
+    Saves the progress recorded by the send tasks to the schedule runs that
+    haven't finished, and marks the runs that are done as finished.
+    """
+    ScheduleRun.collect_unfinished()
+    return "Collected schedule runs"
+
+
 class FireDailySendEstimate(Task):
     """Fires daily estimated send counts.
     """
@@ -563,31 +1119,50 @@ class FireDailySendEstimate(Task):
     name = "subscriptions.tasks.fire_daily_send_estimate"
 
     def run(self):
-        # Django's datetime's weekday method has Monday = 0
-        # whereas the cron format used in the schedules has Sunday = 0
-        day = now().weekday() + 1
-
-        schedules = (
-            Schedule.objects.filter(
-                Q(day_of_week__contains=day) | Q(day_of_week__contains="*"),
-                subscriptions__active=True,
-                subscriptions__completed=False,
-                subscriptions__process_status=0,
+        today = now().date()
+        schedule_ids = [
+            schedule.id
+            for schedule in Schedule.objects.all()
+            if schedule.runs_on(today)
+        ]
+
+        estimates = (
+            Subscription.objects.filter(
+                schedule_id__in=schedule_ids,
+                active=True,
+                completed=False,
+                process_status=0,
             )
-            .values("subscriptions__messageset")
+            .order_by()
+            .values_list("messageset_id")
             .annotate(
-                total_subs=Count("subscriptions"),
-                total_unique=Count("subscriptions__identity", distinct=True),
+                total_subs=Count("id"), total_unique=Count("identity", distinct=True)
             )
         )
 
-        for schedule in schedules:
-            EstimatedSend.objects.get_or_create(
-                send_date=now().date(),
-                messageset_id=schedule["subscriptions__messageset"],
-                estimate_subscriptions=schedule["total_subs"],
-                estimate_identities=schedule["total_unique"],
-            )
+        self.save_estimates(
+            [
+                (today, messageset_id, total_subs, total_unique)
+                for messageset_id, total_subs, total_unique in estimates
+            ]
+        )
+
+    def save_estimates(self, estimates):
+        """
+        Saves the (send_date, messageset_id, estimate_subscriptions,
+        estimate_identities) estimates, replacing any existing estimates for
+        the same date and messageset.
+        """
+        with transaction.atomic():
+            for send_date, messageset_id, subscriptions, identities in estimates:
+                EstimatedSend.objects.update_or_create(
+                    send_date=send_date,
+                    messageset_id=messageset_id,
+                    defaults={
+                        "estimate_subscriptions": subscriptions,
+                        "estimate_identities": identities,
+                    },
+                )
 
 
 fire_daily_send_estimate = FireDailySendEstimate()
@@ -652,9 +1227,11 @@ def find_behind_subscriptions():
     """
     Finds any subscriptions that are behind according to where they should be,
     and creates a BehindSubscription entry for them.
+
+    The lifecycles are calculated in bulk, see subscriptions.lifecycle.
     """
     subscriptions = Subscription.objects.filter(
         active=True, completed=False, process_status=0
-    ).values_list("id", flat=True)
-    for subscription_id in subscriptions.iterator():
-        calculate_subscription_lifecycle.delay(str(subscription_id))
+    )
+    created = create_behind_subscriptions(subscriptions)
+    return "Found %d behind subscriptions" % created
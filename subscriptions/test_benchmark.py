@@ -0,0 +1,132 @@
+import json
+from io import StringIO
+
+import requests
+from django.core.management import call_command
+from django.test import TestCase, override_settings
+
+from contentstore.models import MessageSet, Schedule
+from subscriptions.benchmark import (
+    FAKE_ADDRESS,
+    FakeService,
+    histogram_quantile,
+    histogram_quantiles,
+)
+from subscriptions.models import Subscription
+
+
+class HistogramQuantileTests(TestCase):
+    def test_interpolates(self):
+        """
+        The quantile should be interpolated linearly within the bucket that
+        it falls in.
+        """
+        buckets = [(0.1, 10), (0.5, 30), (1.0, 40), (float("inf"), 40)]
+        self.assertAlmostEqual(histogram_quantile(0.25, buckets), 0.1)
+        self.assertAlmostEqual(histogram_quantile(0.5, buckets), 0.3)
+        self.assertAlmostEqual(histogram_quantile(0.875, buckets), 0.75)
+
+    def test_overflow(self):
+        """
+        Quantiles in the +Inf bucket should be the highest finite bound, and
+        there are no quantiles without observations.
+        """
+        self.assertEqual(histogram_quantile(0.99, [(1.0, 1), (float("inf"), 2)]), 1.0)
+        self.assertIsNone(histogram_quantile(0.5, [(1.0, 0), (float("inf"), 0)]))
+
+    def test_histogram_quantiles(self):
+        """
+        The quantiles should be given for each value of the label
+        """
+        samples = {
+            ("latency_bucket", (("le", "1.0"), ("stage", "a"))): 2,
+            ("latency_bucket", (("le", "+Inf"), ("stage", "a"))): 2,
+            ("latency_bucket", (("le", "1.0"), ("stage", "b"))): 0,
+            ("latency_bucket", (("le", "+Inf"), ("stage", "b"))): 0,
+            ("latency_count", (("stage", "a"),)): 2,
+        }
+        self.assertEqual(
+            histogram_quantiles(samples, "latency", "stage"),
+            {"a": {"count": 2, "p50": 0.5, "p95": 0.95, "p99": 0.99}},
+        )
+
+
+class FakeServiceTests(TestCase):
+    def test_responses(self):
+        """
+        Address lookups should return the fake address, created objects
+        should get an ID, and the requests should be counted.
+        """
+        with FakeService() as service:
+            response = requests.get(
+                service.url + "/identities/abc/addresses/msisdn",
+                params={"default": True},
+            )
+            self.assertEqual(response.json()["results"], [{"address": FAKE_ADDRESS}])
+
+            response = requests.post(service.url + "/outbound/", json={"to_addr": "1"})
+            self.assertEqual(response.status_code, 201)
+            self.assertIn("id", response.json())
+
+            self.assertEqual(service.requests, 2)
+
+
+class BenchSendCommandTests(TestCase):
+    def test_eager(self):
+        """
+        The seeded subscriptions should all be sent to through the fake
+        services, the results reported, and the seeded data removed.
+        """
+        stdout = StringIO()
+        call_command(
+            "bench_send",
+            "--subscriptions",
+            "6",
+            "--messagesets",
+            "2",
+            "--messages",
+            "2",
+            "--json",
+            stdout=stdout,
+        )
+        results = json.loads(stdout.getvalue())
+
+        self.assertEqual(results["subscriptions"], 6)
+        self.assertEqual(results["sent"], 6)
+        self.assertEqual(results["failed"], 0)
+        self.assertEqual(
+            results["requests"], {"identity_store": 6, "message_sender": 6}
+        )
+        self.assertGreater(results["queries_per_message"], 0)
+        self.assertEqual(results["stages"]["send_message"]["count"], 6)
+        self.assertEqual(results["services"]["message_sender"]["count"], 6)
+
+        self.assertFalse(Subscription.objects.exists())
+        self.assertFalse(MessageSet.objects.exists())
+        self.assertFalse(Schedule.objects.exists())
+
+    def test_text(self):
+        """
+        The results should be summarised as text by default
+        """
+        stdout = StringIO()
+        call_command("bench_send", "--subscriptions", "2", stdout=stdout)
+        output = stdout.getvalue()
+
+        self.assertIn("Sent 2 of 2 messages in", output)
+        self.assertIn("2 Identity Store and 2 Message Sender requests", output)
+        self.assertIn("send_message", output)
+
+    @override_settings(SUBSCRIPTION_SEND_BATCH_SIZE=2)
+    def test_batches(self):
+        """
+        When sending in batches, the batch send should be timed as a stage
+        """
+        stdout = StringIO()
+        call_command("bench_send", "--subscriptions", "5", "--json", stdout=stdout)
+        results = json.loads(stdout.getvalue())
+
+        self.assertEqual(results["sent"], 5)
+        self.assertEqual(results["stages"]["send_batch"]["count"], 3)
+        self.assertEqual(results["services"]["identity_store"]["count"], 5)
+        self.assertEqual(results["services"]["message_sender"]["count"], 5)
@@ -0,0 +1,142 @@
+from io import StringIO
+from unittest.mock import patch
+from uuid import uuid4
+
+import responses
+from django.core.cache import caches
+from django.core.management import call_command
+from django.db import DatabaseError
+from django.test import TestCase
+
+from contentstore.models import Message, MessageSet, Schedule
+from contentstore.signals import schedule_saved
+from subscriptions.executor import AsyncSendExecutor
+from subscriptions.models import Subscription
+from subscriptions.test_tasks import FakeMessageSender, disable_signal
+
+redis_cache = caches["redis"]
+
+
+class AsyncSendExecutorTests(TestCase):
+    def setUp(self):
+        with disable_signal("post_save", schedule_saved, Schedule):
+            self.schedule = Schedule.objects.create(minute=0)
+        self.messageset = MessageSet.objects.create(
+            short_name="executor", default_schedule=self.schedule
+        )
+        for i in range(1, 3):
+            Message.objects.create(
+                messageset=self.messageset,
+                text_content="Message {}".format(i),
+                sequence_number=i,
+                lang="eng_ZA",
+            )
+
+    def make_subscription(self, address="+27820001001"):
+        subscription = Subscription.objects.create(
+            identity=str(uuid4()),
+            schedule=self.schedule,
+            messageset=self.messageset,
+            lang="eng_ZA",
+        )
+        responses.add(
+            responses.GET,
+            "http://seed-identity-store/api/v1/identities/{}/addresses/msisdn".format(
+                subscription.identity
+            ),
+            json={
+                "next": None,
+                "previous": None,
+                "results": [{"address": address}] if address else [],
+            },
+            status=200,
+        )
+        return subscription
+
+    @responses.activate
+    def test_executor(self):
+        """
+        All of the subscriptions should be sent to, across batches. Identities
+        without an address should be marked as broken, and failed sends should
+        be handed over to the send chain.
+        """
+        subscriptions = [self.make_subscription() for _ in range(5)]
+        no_address = self.make_subscription(address=None)
+        failing = subscriptions[0]
+        message_sender = FakeMessageSender(fail_identities=[failing.identity])
+        message_sender.add_callback()
+
+        executor = AsyncSendExecutor(concurrency=3, batch_size=2)
+        with patch("subscriptions.tasks.send_next_message") as send_next_message:
+            sent, total = executor.run(str(s.id) for s in subscriptions + [no_address])
+
+        self.assertEqual((sent, total), (4, 6))
+        send_next_message.delay.assert_called_once_with(str(failing.id), None, None)
+        self.assertEqual(
+            sorted(o["to_identity"] for o in message_sender.outbounds.values()),
+            sorted(s.identity for s in subscriptions[1:]),
+        )
+        for subscription in subscriptions[1:]:
+            subscription.refresh_from_db()
+            self.assertEqual(subscription.next_sequence_number, 2)
+        failing.refresh_from_db()
+        self.assertEqual(failing.next_sequence_number, 1)
+        no_address.refresh_from_db()
+        self.assertEqual(no_address.process_status, -1)
+
+    @responses.activate
+    def test_executor_post_send_error(self):
+        """
+        If moving the sent subscriptions on fails, they should be handed over
+        to the post send task instead of being unlocked to be sent again.
+        """
+        subscription = self.make_subscription()
+        FakeMessageSender().add_callback()
+
+        executor = AsyncSendExecutor(concurrency=1, batch_size=1)
+        with patch(
+            "subscriptions.tasks.post_send_process_batch", side_effect=DatabaseError()
+        ):
+            with self.assertRaises(DatabaseError):
+                executor.run([str(subscription.id)])
+
+        subscription.refresh_from_db()
+        self.assertEqual(subscription.next_sequence_number, 2)
+        self.assertIsNone(
+            redis_cache.get("subscription_lock:{}".format(subscription.id))
+        )
+
+    @responses.activate
+    def test_send_messages_command(self):
+        """
+        The command should send to all of the active subscriptions on the
+        schedule.
+        """
+        subscriptions = [self.make_subscription() for _ in range(3)]
+        Subscription.objects.filter(id=subscriptions[0].id).update(active=False)
+        message_sender = FakeMessageSender()
+        message_sender.add_callback()
+
+        stdout = StringIO()
+        call_command("send_messages", schedule=self.schedule.id, stdout=stdout)
+
+        self.assertEqual(stdout.getvalue().strip(), "Sent to 2 of 2 subscriptions.")
+        self.assertEqual(len(message_sender.outbounds), 2)
+
+    @responses.activate
+    def test_send_messages_command_stdin(self):
+        """
+        If no subscriptions or schedule are given, the subscription IDs should
+        be read from stdin.
+        """
+        subscription = self.make_subscription()
+        FakeMessageSender().add_callback()
+
+        stdout = StringIO()
+        call_command(
+            "send_messages",
+            stdin=StringIO("{}\n\n".format(subscription.id)),
+            stdout=stdout,
+        )
+
+        self.assertEqual(stdout.getvalue().strip(), "Sent to 1 of 1 subscriptions.")
@@ -0,0 +1,129 @@
+from datetime import datetime, timedelta
+
+import pytz
+from django.test import TestCase
+
+from contentstore.models import Message, MessageSet, Schedule
+from seed_stage_based_messaging import test_utils as utils
+from subscriptions.lifecycle import LifecycleEngine, create_behind_subscriptions
+from subscriptions.models import BehindSubscription, Subscription
+
+
+class LifecycleEngineTests(TestCase):
+    def setUp(self):
+        utils.disable_signals()
+        self.messageset3 = self.create_messageset("ms3", "0 8 * * 1,3", 3)
+        self.messageset2 = self.create_messageset("ms2", "0 */2 * * *", 2)
+        self.messageset1 = self.create_messageset("ms1", "0 8 * * *", 4)
+        self.messageset2.next_set = self.messageset3
+        self.messageset2.save()
+        self.messageset1.next_set = self.messageset2
+        self.messageset1.save()
+
+    def tearDown(self):
+        utils.enable_signals()
+
+    def create_messageset(self, name, cron_string, n):
+        minute, hour, day_of_month, month_of_year, day_of_week = cron_string.split()
+        schedule = Schedule.objects.create(
+            minute=minute,
+            hour=hour,
+            day_of_month=day_of_month,
+            month_of_year=month_of_year,
+            day_of_week=day_of_week,
+        )
+        messageset = MessageSet.objects.create(
+            default_schedule=schedule, short_name=name
+        )
+        for i in range(n):
+            Message.objects.create(
+                messageset=messageset,
+                text_content=str(i),
+                sequence_number=i + 1,
+                lang="eng_ZA",
+            )
+        return messageset
+
+    def create_subscription(self, messageset, created_at, **kwargs):
+        kwargs.setdefault("lang", "eng_ZA")
+        subscription = Subscription.objects.create(
+            messageset=messageset, schedule=messageset.default_schedule, **kwargs
+        )
+        Subscription.objects.filter(id=subscription.id).update(created_at=created_at)
+        return Subscription.objects.get(id=subscription.id)
+
+    def test_matches_subscription_methods(self):
+        """
+        The engine should give the same results as the Subscription methods,
+        for subscriptions at all points in the message set chain.
+        """
+        end_date = datetime(2018, 3, 1, 12, 0, tzinfo=pytz.UTC)
+        subscriptions = []
+        for days in (0, 1, 3, 5, 7, 10, 20, 40):
+            for messageset in (self.messageset1, self.messageset2, self.messageset3):
+                created_at = end_date - timedelta(days=days, minutes=days * 7)
+                subscriptions.append(self.create_subscription(messageset, created_at))
+        subscriptions.append(
+            self.create_subscription(
+                self.messageset1,
+                end_date - timedelta(days=3),
+                initial_sequence_number=3,
+                next_sequence_number=4,
+            )
+        )
+        subscriptions.append(
+            self.create_subscription(self.messageset1, end_date - timedelta(days=9))
+        )
+        subscriptions.append(
+            self.create_subscription(
+                self.messageset1, end_date - timedelta(days=9), lang="zul_ZA"
+            )
+        )
+
+        engine = LifecycleEngine(end_date)
+        for subscription in subscriptions:
+            args = (
+                subscription.messageset_id,
+                subscription.schedule_id,
+                subscription.lang,
+                subscription.created_at,
+                subscription.initial_sequence_number,
+            )
+            self.assertEqual(
+                engine.messages_behind(*args, subscription.next_sequence_number),
+                subscription.messages_behind(end_date),
+            )
+            end_subscription = Subscription.fast_forward_lifecycle(
+                subscription, end_date, save=False
+            )[-1]
+            self.assertEqual(
+                engine.expected_position(*args),
+                (end_subscription.messageset.id, end_subscription.next_sequence_number),
+            )
+
+    def test_create_behind_subscriptions(self):
+        """
+        BehindSubscriptions should only be created for the subscriptions that
+        are behind, with a constant number of queries.
+        """
+        end_date = datetime(2018, 3, 1, 12, 0, tzinfo=pytz.UTC)
+        behind = self.create_subscription(
+            self.messageset1, end_date - timedelta(days=6)
+        )
+        self.create_subscription(self.messageset1, end_date - timedelta(hours=1))
+
+        # Message sets, schedules, message counts, subscriptions, and insert
+        with self.assertNumQueries(5):
+            created = create_behind_subscriptions(
+                Subscription.objects.all(), end_date, batch_size=10
+            )
+
+        self.assertEqual(created, 1)
+        [behind_subscription] = BehindSubscription.objects.all()
+        self.assertEqual(behind_subscription.subscription, behind)
+        self.assertEqual(
+            behind_subscription.messages_behind, behind.messages_behind(end_date)
+        )
+        # 4 daily messages, 2 two-hourly messages, then Wednesday's message
+        self.assertEqual(behind_subscription.expected_messageset, self.messageset3)
+        self.assertEqual(behind_subscription.expected_sequence_number, 2)
@@ -0,0 +1,153 @@
+from argparse import ArgumentTypeError
+from io import StringIO
+from uuid import UUID, uuid4
+
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.test import TestCase, TransactionTestCase
+
+from contentstore.models import MessageSet, Schedule
+from contentstore.signals import schedule_saved
+from subscriptions.models import Subscription
+from subscriptions.partitions import Partition, partition_type
+from subscriptions.test_tasks import disable_signal
+
+
+class PartitionTests(TestCase):
+    def test_bounds(self):
+        """
+        The partitions should split the UUID keyspace evenly, with no lower
+        bound for the first and no upper bound for the last.
+        """
+        self.assertEqual(Partition(0, 1).bounds, (None, None))
+        self.assertEqual(
+            [Partition(i, 4).bounds for i in range(4)],
+            [
+                (None, UUID("40000000-0000-0000-0000-000000000000")),
+                (
+                    UUID("40000000-0000-0000-0000-000000000000"),
+                    UUID("80000000-0000-0000-0000-000000000000"),
+                ),
+                (
+                    UUID("80000000-0000-0000-0000-000000000000"),
+                    UUID("c0000000-0000-0000-0000-000000000000"),
+                ),
+                (UUID("c0000000-0000-0000-0000-000000000000"), None),
+            ],
+        )
+
+    def test_split(self):
+        """
+        Splitting a partition between workers should give the parts of the
+        partition's range.
+        """
+        self.assertEqual(Partition(1, 2).split(2), [Partition(2, 4), Partition(3, 4)])
+
+    def test_partition_type(self):
+        """
+        Partitions should be given as i/N, counting from 1
+        """
+        self.assertEqual(partition_type("1/3"), Partition(0, 3))
+        self.assertEqual(partition_type("3/3"), Partition(2, 3))
+        for value in ("0/3", "4/3", "1", "a/b"):
+            with self.assertRaises(ArgumentTypeError):
+                partition_type(value)
+
+
+class PartitionedCommandMixin(object):
+    def setUp(self):
+        with disable_signal("post_save", schedule_saved, Schedule):
+            self.schedule = Schedule.objects.create()
+        self.messageset = MessageSet.objects.create(
+            short_name="partitions", default_schedule=self.schedule
+        )
+
+    def make_subscriptions(self, identity, count):
+        return [
+            Subscription.objects.create(
+                identity=identity,
+                messageset=self.messageset,
+                schedule=self.schedule,
+                lang="eng_ZA",
+            )
+            for _ in range(count)
+        ]
+
+
+class PartitionFilterTests(PartitionedCommandMixin, TestCase):
+    def test_filter(self):
+        """
+        Each subscription should be in exactly one partition, whether it's
+        partitioned by its ID or by its identity.
+        """
+        for _ in range(20):
+            self.make_subscriptions(str(uuid4()), 1)
+        self.make_subscriptions("not a uuid", 1)
+        subscriptions = Subscription.objects.all()
+
+        for field in ("id", "identity"):
+            partitioned = []
+            for partition in Partition(0, 1).split(4):
+                partitioned.extend(
+                    partition.filter(subscriptions, field).values_list("id", flat=True)
+                )
+            self.assertEqual(sorted(partitioned), sorted(s.id for s in subscriptions))
+
+    def test_remove_duplicates_partition(self):
+        """
+        Only the duplicates whose identity is in the given partition should be
+        removed.
+        """
+        first = self.make_subscriptions("10000000-0000-0000-0000-000000000000", 2)
+        self.make_subscriptions("90000000-0000-0000-0000-000000000000", 2)
+
+        stdout = StringIO()
+        call_command(
+            "remove_duplicate_subscriptions", "--partition", "1/2", stdout=stdout
+        )
+
+        self.assertEqual(
+            stdout.getvalue().strip().split("\n"),
+            [
+                "Not removing %s, use --fix to actually remove." % (first[1],),
+                "Removed 1 duplicate subscriptions.",
+            ],
+        )
+
+    def test_remove_duplicates_requires_identity(self):
+        """
+        Duplicates can only be found within a partition if they must have the
+        same identity.
+        """
+        with self.assertRaises(CommandError):
+            call_command(
+                "remove_duplicate_subscriptions",
+                "--partition",
+                "1/2",
+                "--fields",
+                "messageset",
+                "lang",
+            )
+
+
+class PartitionWorkersTests(PartitionedCommandMixin, TransactionTestCase):
+    def test_workers(self):
+        """
+        The partitions should be processed in separate worker processes, and
+        their output and counts merged.
+        """
+        first = self.make_subscriptions("10000000-0000-0000-0000-000000000000", 2)
+        second = self.make_subscriptions("90000000-0000-0000-0000-000000000000", 3)
+
+        stdout = StringIO()
+        call_command("remove_duplicate_subscriptions", "--workers", "2", stdout=stdout)
+
+        self.assertEqual(
+            stdout.getvalue().strip().split("\n"),
+            [
+                "Not removing %s, use --fix to actually remove." % (first[1],),
+                "Not removing %s, use --fix to actually remove." % (second[1],),
+                "Not removing %s, use --fix to actually remove." % (second[2],),
+                "Removed 3 duplicate subscriptions.",
+            ],
+        )
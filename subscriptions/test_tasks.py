@@ -1,20 +1,42 @@
+import json
 from contextlib import contextmanager
 from datetime import datetime, timedelta
+from threading import Lock
 from unittest.mock import patch
+from uuid import uuid4
 
+import responses
+from demands import HTTPServiceError
+from django.core import serializers
+from django.core.cache import caches
+from django.db import DatabaseError
 from django.db.models import signals
 from django.test import TestCase
+from django.utils.timezone import now
+from prometheus_client import REGISTRY
 
-from contentstore.models import Message, MessageSet, Schedule
+from contentstore.models import Message, MessageSet, Schedule, ScheduleRun
 from contentstore.signals import schedule_saved
-from subscriptions.models import BehindSubscription, Subscription
+from subscriptions.models import (
+    BehindSubscription,
+    ResendRequest,
+    ScheduleSubscriptionCount,
+    Subscription,
+)
 from subscriptions.tasks import (
     calculate_subscription_lifecycle,
+    clear_prepend_next_delivery,
     find_behind_subscriptions,
+    load_send_context,
+    lock_subscriptions,
     post_send_process,
     pre_send_process,
+    process_subscription_send,
+    send_next_message_batch,
 )
 
+redis_cache = caches["redis"]
+
 
 @contextmanager
 def disable_signal(signal_name, signal_fn, sender):
@@ -26,31 +48,70 @@ def disable_signal(signal_name, signal_fn, sender):
         signal.connect(signal_fn, sender)
 
 
+class FakeMessageSender(object):
+    """
+    A stub Message Sender outbound endpoint, that records the created
+    outbounds and fails for the identities in fail_identities.
+    """
+
+    url = "http://seed-message-sender/api/v1/outbound/"
+
+    def __init__(self, fail_identities=()):
+        self.fail_identities = set(fail_identities)
+        self.outbounds = {}
+        self.lock = Lock()
+
+    def add_callback(self):
+        responses.add_callback(
+            responses.POST,
+            self.url,
+            callback=self.create_outbound,
+            content_type="application/json",
+        )
+
+    def create_outbound(self, request):
+        payload = json.loads(request.body)
+        if payload["to_identity"] in self.fail_identities:
+            return (500, {}, json.dumps({"detail": "error"}))
+        outbound_id = str(uuid4())
+        with self.lock:
+            self.outbounds[outbound_id] = payload
+        return (201, {}, json.dumps(dict(payload, id=outbound_id)))
+
+
 class TestFindBehindSubscriptionsTask(TestCase):
-    def test_find_behind_subscriptions_queues_tasks(self):
+    def test_find_behind_subscriptions(self):
         """
-        find_behind_subscriptions should queue processing for all the
-        subscriptions that are active
+        find_behind_subscriptions should create BehindSubscriptions for all
+        the active subscriptions that are behind
         """
         with disable_signal("post_save", schedule_saved, Schedule):
-            schedule = Schedule.objects.create()
+            schedule = Schedule.objects.create(minute=0)
         messageset = MessageSet.objects.create(default_schedule=schedule)
-        sub_valid = Subscription.objects.create(
+        for i in range(10):
+            Message.objects.create(
+                messageset=messageset, text_content=str(i), sequence_number=i
+            )
+        sub_behind = Subscription.objects.create(
             schedule=schedule, messageset=messageset
         )
+        # Subscriptions that are up to date, or that aren't active
         Subscription.objects.create(
-            schedule=schedule, messageset=messageset, active=False
-        )
-        Subscription.objects.create(
-            schedule=schedule, messageset=messageset, completed=True
-        )
-        Subscription.objects.create(
-            schedule=schedule, messageset=messageset, process_status=-1
+            schedule=schedule, messageset=messageset, next_sequence_number=3
         )
+        for kwargs in ({"active": False}, {"completed": True}, {"process_status": -1}):
+            Subscription.objects.create(
+                schedule=schedule, messageset=messageset, **kwargs
+            )
+        Subscription.objects.update(created_at=datetime.now() - timedelta(hours=2))
 
-        with patch.object(calculate_subscription_lifecycle, "delay") as p:
-            find_behind_subscriptions.delay()
-        p.assert_called_once_with(str(sub_valid.id))
+        result = find_behind_subscriptions.delay()
+
+        self.assertEqual(result.get(), "Found 1 behind subscriptions")
+        [behind] = BehindSubscription.objects.all()
+        self.assertEqual(behind.subscription, sub_behind)
+        self.assertEqual(behind.messages_behind, 2)
+        self.assertEqual(behind.expected_sequence_number, 3)
 
 
 class TestCalculateSubscriptionLifecycle(TestCase):
@@ -72,8 +133,10 @@ class TestCalculateSubscriptionLifecycle(TestCase):
 
         # Ensure that we make the minumum amount of requests needed
         # 1: Get the subscription with related schedule and messageset
-        # 2: Get the count of messages for the messageset
-        with self.assertNumQueries(2):
+        # 2-4: Load the messageset graph, the first time only
+        with self.assertNumQueries(4):
+            calculate_subscription_lifecycle.delay(str(subscription.id))
+        with self.assertNumQueries(1):
             calculate_subscription_lifecycle.delay(str(subscription.id))
         self.assertEqual(BehindSubscription.objects.count(), 0)
 
@@ -154,3 +217,560 @@ class CachedMessageLookupTests(TestCase):
 
         with self.assertNumQueries(1):
             post_send_process(res)
+
+
+class SendNextMessageBatchTests(TestCase):
+    def setUp(self):
+        with disable_signal("post_save", schedule_saved, Schedule):
+            self.schedule = Schedule.objects.create(minute=0)
+        self.messageset = MessageSet.objects.create(
+            short_name="batch", default_schedule=self.schedule
+        )
+        for i in range(1, 4):
+            Message.objects.create(
+                messageset=self.messageset,
+                text_content="Message {}".format(i),
+                sequence_number=i,
+                lang="eng_ZA",
+            )
+
+    def make_subscription(self, identity):
+        return Subscription.objects.create(
+            identity=identity,
+            schedule=self.schedule,
+            messageset=self.messageset,
+            lang="eng_ZA",
+        )
+
+    def add_identity_address_response(self, identity, address="+27820001001"):
+        responses.add(
+            responses.GET,
+            "http://seed-identity-store/api/v1/identities/{}/addresses/msisdn".format(
+                identity
+            ),
+            json={"next": None, "previous": None, "results": [{"address": address}]},
+            status=200,
+        )
+
+    @responses.activate
+    def test_send_next_message_batch(self):
+        """
+        Every subscription in the batch should get its next message sent, and
+        be moved on to the next sequence number.
+        """
+        subscriptions = [
+            self.make_subscription(str(uuid4())),
+            self.make_subscription(str(uuid4())),
+        ]
+        for subscription in subscriptions:
+            self.add_identity_address_response(subscription.identity)
+        responses.add(
+            responses.POST,
+            "http://seed-message-sender/api/v1/outbound/",
+            json={"id": str(uuid4())},
+            status=201,
+        )
+
+        send_next_message_batch.delay([str(s.id) for s in subscriptions])
+
+        outbounds = [
+            json.loads(c.request.body)
+            for c in responses.calls
+            if c.request.method == "POST"
+        ]
+        self.assertEqual(
+            sorted(o["to_identity"] for o in outbounds),
+            sorted(s.identity for s in subscriptions),
+        )
+        self.assertEqual(set(o["content"] for o in outbounds), {"Message 1"})
+        for subscription in subscriptions:
+            subscription.refresh_from_db()
+            self.assertEqual(subscription.next_sequence_number, 2)
+
+    @responses.activate
+    def test_send_next_message_batch_failure(self):
+        """
+        If a step fails for one of the subscriptions, the remaining steps for
+        that subscription should be queued separately, and the rest of the
+        batch should still be processed.
+        """
+        failing = self.make_subscription(str(uuid4()))
+        working = self.make_subscription(str(uuid4()))
+        responses.add(
+            responses.GET,
+            "http://seed-identity-store/api/v1/identities/{}/addresses/msisdn".format(
+                failing.identity
+            ),
+            status=500,
+        )
+        self.add_identity_address_response(working.identity)
+        responses.add(
+            responses.POST,
+            "http://seed-message-sender/api/v1/outbound/",
+            json={"id": str(uuid4())},
+            status=201,
+        )
+
+        with patch("subscriptions.tasks.send_next_message") as send_next_message:
+            send_next_message_batch.delay([str(failing.id), str(working.id)])
+
+        send_next_message.delay.assert_called_once_with(str(failing.id), None, None)
+        self.assertIsNone(redis_cache.get("subscription_lock:{}".format(failing.id)))
+
+        failing.refresh_from_db()
+        self.assertEqual(failing.next_sequence_number, 1)
+        working.refresh_from_db()
+        self.assertEqual(working.next_sequence_number, 2)
+
+    @responses.activate
+    def test_send_next_message_batch_outbound_failure(self):
+        """
+        If creating some of the outbounds fails, only those subscriptions
+        should be queued separately.
+        """
+        subscriptions = [self.make_subscription(str(uuid4())) for _ in range(4)]
+        for subscription in subscriptions:
+            self.add_identity_address_response(subscription.identity)
+        failing = subscriptions[0]
+        message_sender = FakeMessageSender(fail_identities=[failing.identity])
+        message_sender.add_callback()
+
+        with patch("subscriptions.tasks.send_next_message") as send_next_message:
+            result = send_next_message_batch.delay([str(s.id) for s in subscriptions])
+
+        self.assertEqual(result.get(), "Sent to 3 of 4 subscriptions")
+        send_next_message.delay.assert_called_once_with(str(failing.id), None, None)
+        self.assertEqual(
+            sorted(o["to_identity"] for o in message_sender.outbounds.values()),
+            sorted(s.identity for s in subscriptions[1:]),
+        )
+        for subscription in subscriptions:
+            subscription.refresh_from_db()
+            self.assertEqual(
+                subscription.next_sequence_number, 1 if subscription == failing else 2
+            )
+
+    @responses.activate
+    def test_send_next_message_batch_malformed_outbound(self):
+        """
+        An unexpected error creating one of the outbounds, such as a response
+        without an ID, should only queue that subscription separately.
+        """
+        subscriptions = [self.make_subscription(str(uuid4())) for _ in range(2)]
+        for subscription in subscriptions:
+            self.add_identity_address_response(subscription.identity)
+        failing = subscriptions[0]
+
+        def create_outbound(request):
+            if json.loads(request.body)["to_identity"] == failing.identity:
+                return (201, {}, json.dumps({}))
+            return (201, {}, json.dumps({"id": str(uuid4())}))
+
+        responses.add_callback(
+            responses.POST,
+            "http://seed-message-sender/api/v1/outbound/",
+            callback=create_outbound,
+            content_type="application/json",
+        )
+
+        with patch("subscriptions.tasks.send_next_message") as send_next_message:
+            result = send_next_message_batch.delay([str(s.id) for s in subscriptions])
+
+        self.assertEqual(result.get(), "Sent to 1 of 2 subscriptions")
+        send_next_message.delay.assert_called_once_with(str(failing.id), None, None)
+        subscriptions[1].refresh_from_db()
+        self.assertEqual(subscriptions[1].next_sequence_number, 2)
+
+    @responses.activate
+    def test_send_next_message_batch_no_address(self):
+        """
+        Subscriptions without a valid address should be marked as errored,
+        and removed from their schedule's subscription count.
+        """
+        invalid = self.make_subscription(str(uuid4()))
+        responses.add(
+            responses.GET,
+            "http://seed-identity-store/api/v1/identities/{}/addresses/msisdn".format(
+                invalid.identity
+            ),
+            json={"next": None, "previous": None, "results": []},
+            status=200,
+        )
+        self.assertEqual(self.schedule.subscription_count.count, 1)
+
+        send_next_message_batch.delay([str(invalid.id)])
+
+        invalid.refresh_from_db()
+        self.assertEqual(invalid.process_status, -1)
+        self.assertEqual(invalid.next_sequence_number, 1)
+        self.assertEqual(
+            ScheduleSubscriptionCount.objects.get(schedule=self.schedule).count, 0
+        )
+
+    @responses.activate
+    def test_send_next_message_batch_schedule_run(self):
+        """
+        The subscriptions that were sent to, and the ones that couldn't be,
+        should be recorded on the schedule run.
+        """
+        sent = self.make_subscription(str(uuid4()))
+        self.add_identity_address_response(sent.identity)
+        invalid = self.make_subscription(str(uuid4()))
+        responses.add(
+            responses.GET,
+            "http://seed-identity-store/api/v1/identities/{}/addresses/msisdn".format(
+                invalid.identity
+            ),
+            json={"next": None, "previous": None, "results": []},
+            status=200,
+        )
+        FakeMessageSender().add_callback()
+        run = ScheduleRun.objects.create(
+            schedule=self.schedule, queued_at=now(), subscriptions=2
+        )
+
+        send_next_message_batch.delay([str(sent.id), str(invalid.id)], run_id=run.id)
+
+        ScheduleRun.collect_unfinished()
+        run.refresh_from_db()
+        self.assertEqual((run.sent, run.failed, run.finished), (1, 1, True))
+
+    @responses.activate
+    def test_send_next_message_batch_locked(self):
+        """
+        Subscriptions that are already locked should be handed over to the send
+        chain, which will retry once the lock expires.
+        """
+        subscription = self.make_subscription(str(uuid4()))
+        lock_subscriptions([str(subscription.id)])
+        contention = REGISTRY.get_sample_value("subscription_lock_contention_total")
+
+        with patch("subscriptions.tasks.send_next_message") as send_next_message:
+            send_next_message_batch.delay([str(subscription.id)])
+
+        send_next_message.delay.assert_called_once_with(
+            str(subscription.id), None, None
+        )
+        self.assertEqual(len(responses.calls), 0)
+        self.assertEqual(
+            REGISTRY.get_sample_value("subscription_lock_contention_total"),
+            contention + 1,
+        )
+
+    @responses.activate
+    def test_send_next_message_batch_queries(self):
+        """
+        The number of database queries shouldn't depend on the number of
+        subscriptions in the batch.
+        """
+        subscriptions = [self.make_subscription(str(uuid4())) for _ in range(5)]
+        for subscription in subscriptions:
+            self.add_identity_address_response(subscription.identity)
+        responses.add(
+            responses.POST,
+            "http://seed-message-sender/api/v1/outbound/",
+            json={"id": str(uuid4())},
+            status=201,
+        )
+
+        # 1. Load the subscriptions with their messagesets
+        # 2. Load the messages
+        # 3. Count the messageset sizes
+        # 4. Savepoint
+        # 5. Increment all of the subscriptions
+        # 6. Release savepoint
+        with self.assertNumQueries(6):
+            send_next_message_batch([str(s.id) for s in subscriptions])
+
+    def test_send_next_message_batch_prepare_error(self):
+        """
+        If preparing the batch fails before anything is sent, each
+        subscription should be queued separately instead of being dropped.
+        """
+        subscriptions = [
+            self.make_subscription(str(uuid4())),
+            self.make_subscription(str(uuid4())),
+        ]
+
+        with patch(
+            "subscriptions.tasks.utils.get_identity_addresses", side_effect=ValueError()
+        ), patch("subscriptions.tasks.send_next_message") as send_next_message:
+            with self.assertRaises(ValueError):
+                send_next_message_batch([str(s.id) for s in subscriptions], 3)
+
+        self.assertEqual(
+            sorted(c[0] for c in send_next_message.delay.call_args_list),
+            sorted((str(s.id), None, 3) for s in subscriptions),
+        )
+        for subscription in subscriptions:
+            self.assertIsNone(
+                redis_cache.get("subscription_lock:{}".format(subscription.id))
+            )
+
+    @responses.activate
+    def test_send_next_message_batch_post_send_error(self):
+        """
+        If moving the sent subscriptions on fails, they should be handed over
+        to the post send task instead of being unlocked to be sent again.
+        """
+        subscription = self.make_subscription(str(uuid4()))
+        self.add_identity_address_response(subscription.identity)
+        responses.add(
+            responses.POST,
+            "http://seed-message-sender/api/v1/outbound/",
+            json={"id": str(uuid4())},
+            status=201,
+        )
+
+        with patch(
+            "subscriptions.tasks.post_send_process_batch", side_effect=DatabaseError()
+        ):
+            with self.assertRaises(DatabaseError):
+                send_next_message_batch([str(subscription.id)])
+
+        subscription.refresh_from_db()
+        self.assertEqual(subscription.next_sequence_number, 2)
+        self.assertIsNone(
+            redis_cache.get("subscription_lock:{}".format(subscription.id))
+        )
+
+    @responses.activate
+    def test_send_next_message_batch_complete(self):
+        """
+        Subscriptions that receive their last message should be completed, and
+        subscribed to the next message set.
+        """
+        next_set = MessageSet.objects.create(
+            short_name="batch_next", default_schedule=self.schedule
+        )
+        self.messageset.next_set = next_set
+        self.messageset.save()
+        subscription = self.make_subscription(str(uuid4()))
+        subscription.next_sequence_number = 3
+        subscription.save()
+        self.add_identity_address_response(subscription.identity)
+        responses.add(
+            responses.POST,
+            "http://seed-message-sender/api/v1/outbound/",
+            json={"id": str(uuid4())},
+            status=201,
+        )
+
+        send_next_message_batch([str(subscription.id)])
+
+        subscription.refresh_from_db()
+        self.assertTrue(subscription.completed)
+        self.assertFalse(subscription.active)
+        self.assertEqual(subscription.process_status, 2)
+        [new_subscription] = Subscription.objects.filter(messageset=next_set)
+        self.assertEqual(new_subscription.identity, subscription.identity)
+        self.assertEqual(new_subscription.lang, "eng_ZA")
+        self.assertEqual(new_subscription.schedule, self.schedule)
+        self.assertEqual(ScheduleSubscriptionCount.reconcile(), 0)
+
+
+class SendContextTests(TestCase):
+    def setUp(self):
+        with disable_signal("post_save", schedule_saved, Schedule):
+            self.schedule = Schedule.objects.create(minute=0)
+        self.messageset = MessageSet.objects.create(
+            short_name="context", default_schedule=self.schedule, channel="WHATSAPP"
+        )
+        self.message = Message.objects.create(
+            messageset=self.messageset,
+            text_content="Message 1",
+            sequence_number=1,
+            lang="eng_ZA",
+            metadata={"foo": "bar"},
+        )
+        self.subscription = Subscription.objects.create(
+            identity=str(uuid4()),
+            schedule=self.schedule,
+            messageset=self.messageset,
+            lang="eng_ZA",
+            metadata={"prepend_next_delivery": "Welcome", "large": ["data"] * 100},
+        )
+
+    def test_pre_send_process_context(self):
+        """
+        The context should only contain the fields the later steps need, and
+        not the serialized models.
+        """
+        context = pre_send_process(str(self.subscription.id))
+        self.assertEqual(
+            context,
+            {
+                "version": 1,
+                "subscription_id": str(self.subscription.id),
+                "identity": self.subscription.identity,
+                "lang": "eng_ZA",
+                "next_sequence_number": 1,
+                "prepend_next": "Welcome",
+                "messageset": {
+                    "id": self.messageset.id,
+                    "channel": "WHATSAPP",
+                    "content_type": "text",
+                    "next_set_id": None,
+                    "next_set_schedule_id": None,
+                },
+                "message": {
+                    "id": self.message.id,
+                    "text_content": "Message 1",
+                    "metadata": {"foo": "bar"},
+                    "binary_content_url": None,
+                },
+            },
+        )
+        # Must be serializable by the task serializer
+        json.dumps(context)
+
+    def test_load_send_context_legacy(self):
+        """
+        Contexts that contain Django serialized models should be converted to
+        the current format.
+        """
+        context = load_send_context(
+            {
+                "subscription": serializers.serialize("json", [self.subscription]),
+                "messageset": serializers.serialize("json", [self.messageset]),
+                "message": serializers.serialize("json", [self.message]),
+                "to_addr": "+27820001001",
+            }
+        )
+        self.assertEqual(context["version"], 1)
+        self.assertEqual(context["subscription_id"], str(self.subscription.id))
+        self.assertEqual(context["prepend_next"], "Welcome")
+        self.assertEqual(context["messageset"]["channel"], "WHATSAPP")
+        self.assertEqual(context["message"]["text_content"], "Message 1")
+        self.assertEqual(context["to_addr"], "+27820001001")
+        self.assertNotIn("subscription", context)
+
+    def test_clear_prepend_next_delivery(self):
+        """
+        Only the prepended content should be cleared from the metadata.
+        """
+        clear_prepend_next_delivery(self.subscription.id)
+        self.subscription.refresh_from_db()
+        self.assertEqual(
+            self.subscription.metadata,
+            {"prepend_next_delivery": None, "large": ["data"] * 100},
+        )
+
+
+class ProcessSubscriptionSendTests(TestCase):
+    def setUp(self):
+        with disable_signal("post_save", schedule_saved, Schedule):
+            self.schedule = Schedule.objects.create(minute=0)
+        self.messageset = MessageSet.objects.create(
+            short_name="single", default_schedule=self.schedule
+        )
+        for i in range(1, 3):
+            Message.objects.create(
+                messageset=self.messageset,
+                text_content="Message {}".format(i),
+                sequence_number=i,
+                lang="eng_ZA",
+            )
+        self.subscription = Subscription.objects.create(
+            identity=str(uuid4()),
+            schedule=self.schedule,
+            messageset=self.messageset,
+            lang="eng_ZA",
+        )
+        responses.add(
+            responses.GET,
+            "http://seed-identity-store/api/v1/identities/{}/addresses/msisdn".format(
+                self.subscription.identity
+            ),
+            json={"next": None, "previous": None, "results": [{"address": "+2782"}]},
+            status=200,
+        )
+
+    @responses.activate
+    def test_process_subscription_send(self):
+        """
+        All of the send steps should be run in the one task.
+        """
+        responses.add(
+            responses.POST,
+            "http://seed-message-sender/api/v1/outbound/",
+            json={"id": str(uuid4())},
+            status=201,
+        )
+
+        process_subscription_send.delay(str(self.subscription.id))
+
+        self.subscription.refresh_from_db()
+        self.assertEqual(self.subscription.next_sequence_number, 2)
+        self.assertEqual(
+            json.loads(responses.calls[1].request.body)["content"], "Message 1"
+        )
+        self.assertIsNone(
+            redis_cache.get("subscription_lock:{}".format(self.subscription.id))
+        )
+
+    @responses.activate
+    def test_process_subscription_send_resend(self):
+        """
+        If a resend ID is given, the current message should be resent and the
+        resend request updated.
+        """
+        outbound_id = str(uuid4())
+        responses.add(
+            responses.POST,
+            "http://seed-message-sender/api/v1/outbound/",
+            json={"id": outbound_id},
+            status=201,
+        )
+        self.subscription.next_sequence_number = 2
+        self.subscription.save()
+        resend_request = ResendRequest.objects.create(subscription=self.subscription)
+
+        process_subscription_send.delay(str(self.subscription.id), resend_request.id)
+
+        resend_request.refresh_from_db()
+        self.assertEqual(str(resend_request.outbound), outbound_id)
+        self.assertEqual(resend_request.message.sequence_number, 1)
+        self.subscription.refresh_from_db()
+        self.assertEqual(self.subscription.next_sequence_number, 2)
+
+    @responses.activate
+    def test_process_subscription_send_error(self):
+        """
+        If the message sender keeps failing, the task should give up after
+        retrying, and leave the subscription unlocked and where it was.
+        """
+        responses.add(
+            responses.POST, "http://seed-message-sender/api/v1/outbound/", status=500
+        )
+
+        with self.assertRaises(HTTPServiceError):
+            process_subscription_send.delay(str(self.subscription.id))
+
+        self.subscription.refresh_from_db()
+        self.assertEqual(self.subscription.next_sequence_number, 1)
+        self.assertIsNone(
+            redis_cache.get("subscription_lock:{}".format(self.subscription.id))
+        )
+
+    @responses.activate
+    def test_process_subscription_send_post_send_error(self):
+        """
+        If the post send step fails after the message was sent, it should be
+        queued separately instead of sending the message again.
+        """
+        responses.add(
+            responses.POST,
+            "http://seed-message-sender/api/v1/outbound/",
+            json={"id": str(uuid4())},
+            status=201,
+        )
+
+        with patch(
+            "subscriptions.tasks.update_sent_subscription", side_effect=DatabaseError()
+        ), patch.object(post_send_process, "delay") as delay:
+            process_subscription_send.delay(str(self.subscription.id))
+
+        [(context,), _] = delay.call_args
+        self.assertEqual(context["subscription_id"], str(self.subscription.id))
+        self.assertEqual(len(responses.calls), 2)
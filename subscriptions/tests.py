@@ -1,4 +1,6 @@
 import json
+import os
+import tempfile
 from datetime import datetime, timedelta
 from unittest.mock import patch
 from uuid import uuid4
@@ -10,7 +12,7 @@ from celery.exceptions import Retry
 from django.conf import settings
 from django.contrib.auth.models import User
 from django.core.cache import caches
-from django.core.management import call_command
+from django.core.management import CommandError, call_command
 from django.test import TestCase, override_settings
 from django.utils import timezone
 from requests.exceptions import HTTPError
@@ -18,14 +20,30 @@ from rest_framework import status
 from rest_framework.authtoken.models import Token
 from rest_framework.test import APIClient
 
-from contentstore.models import BinaryContent, Message, MessageSet, Schedule
+from contentstore.models import (
+    BinaryContent,
+    Message,
+    MessageSet,
+    Schedule,
+    ScheduleRun,
+)
 from seed_stage_based_messaging import test_utils as utils
 
 from . import tasks
-from .models import EstimatedSend, ResendRequest, Subscription, SubscriptionSendFailure
+from .management.commands.mark_invalid_subscriptions import Command
+from .models import (
+    EstimatedSend,
+    ResendRequest,
+    ScheduleSubscriptionCount,
+    Subscription,
+    SubscriptionSendFailure,
+)
+from .partitions import Partition
 from .tasks import (
     BaseSendMessage,
     fire_metric,
+    fire_metrics_batch,
+    post_send_process,
     pre_send_process,
     schedule_disable,
     scheduled_metrics,
@@ -697,13 +715,16 @@ class TestSendMessageTask(AuthenticatedAPITestCase):
         # Queue subscriptions endpoint
         # 1. Auth token lookup
         # 2. Schedule lookup
-        # 3. Subscriptions lookup
+        # 3. Create the schedule run
+        # 4. Distinct content for the subscriptions
+        # 5. Message lookup, to warm the cache
+        # 6. Find total number of messages in message set, to warm the cache
+        # 7. Subscriptions lookup
         # Send next message task
-        # 4. Subscription and MessageSet lookup
-        # 5. Message lookup
-        # 7. Find total number of messages in message set
-        # 8. Increment next sequence number
-        with self.assertNumQueries(7):
+        # 8. Subscription and MessageSet lookup
+        # 9. Increment next sequence number
+        # 10. Record the number of subscriptions queued on the schedule run
+        with self.assertNumQueries(10):
             response = self.client.post(
                 existing.schedule.send_url, content_type="application/json"
             )
@@ -1842,6 +1863,43 @@ class TestSendMessageTask(AuthenticatedAPITestCase):
         self.assertEqual(fail.subscription_id, existing.id)
         self.assertEqual(fail.reason, "Hey!")
 
+    def test_base_send_message_on_failure_run(self):
+        """
+        When on_failure is called for a send that's part of a schedule run,
+        the run should record a failed send, unless the message has already
+        been sent.
+        """
+        existing = self.make_subscription_audio()
+        run = ScheduleRun.objects.create(
+            schedule=self.schedule, queued_at=timezone.now(), subscriptions=3
+        )
+
+        base_send_message = BaseSendMessage()
+        base_send_message.on_failure(
+            Exception("Hey!"),
+            existing.id,
+            [{"subscription_id": existing.id, "run_id": run.id}],
+            {},
+            "",
+        )
+        base_send_message.on_failure(
+            Exception("Hey!"), existing.id, [existing.id, None, run.id], {}, ""
+        )
+        post_send_process.on_failure(
+            Exception("Hey!"),
+            existing.id,
+            [{"subscription_id": existing.id, "run_id": run.id}],
+            {},
+            "",
+        )
+
+        self.assertEqual(SubscriptionSendFailure.objects.all().count(), 3)
+        ScheduleRun.collect_unfinished()
+        run.refresh_from_db()
+        self.assertEqual(run.failed, 2)
+        self.assertEqual(run.sent, 0)
+        self.assertFalse(run.finished)
+
     @override_settings(USE_SSL=True)
     def test_make_absolute_url(self):
         self.assertEqual(tasks.make_absolute_url("foo"), "https://example.com/foo")
@@ -1938,6 +1996,19 @@ class TestMetrics(AuthenticatedAPITestCase):
         self.check_request(request, "POST", data={"foo.last": 1.0})
         self.assertEqual(result.get(), "Fired metric <foo.last> with value <1.0>")
 
+    @responses.activate
+    def test_fire_metrics_batch(self):
+        """
+        When calling the `fire_metrics_batch` task, it should send all of the
+        metrics to the metrics API in a single request.
+        """
+        result = fire_metrics_batch.apply_async(
+            kwargs={"metrics": {"foo.last": 1, "bar.sum": "2"}}
+        )
+        [call] = responses.calls
+        self.check_request(call.request, "POST", data={"foo.last": 1.0, "bar.sum": 2.0})
+        self.assertEqual(result.get(), "Fired 2 metrics")
+
     @responses.activate
     def test_scheduled_metrics(self):
         # Setup
@@ -1952,21 +2023,29 @@ class TestMetrics(AuthenticatedAPITestCase):
             content_type="application/json",
         )
 
+        # a schedule subscription count that has drifted
+        ScheduleSubscriptionCount.objects.update_or_create(
+            schedule=self.schedule, defaults={"count": 5}
+        )
+
         # Execute
         result = scheduled_metrics.apply_async()
         # Check
-        self.assertEqual(result.get(), "1 Scheduled metrics launched")
-        # fire_week_estimate_last can fire up to 7 extra metrics based on the
-        # day of the week
-        total = 7 - datetime.today().weekday()
-        self.assertEqual(len(responses.calls), total)
+        self.assertEqual(result.get(), "3 Scheduled metrics launched")
+        # the drifted count is reconciled
+        self.assertEqual(
+            ScheduleSubscriptionCount.objects.get(schedule=self.schedule).count, 0
+        )
+        # fire_week_estimate_last fires up to 7 metrics, based on the day of
+        # the week, in a single request
+        self.assertEqual(len(responses.calls), 1)
 
     @responses.activate
     def test_fire_week_estimate_last(self):
         """
         Ensure that the fire_week_estimate_last task sends the correct amount
         of metrics to the metrics API, which should be the amount of days left
-        in this week.
+        in this week, in a single request.
         """
         # Setup
         self.make_subscription()
@@ -1976,13 +2055,59 @@ class TestMetrics(AuthenticatedAPITestCase):
 
         # Check
         days_left_in_week = 7 - datetime.now().weekday()
-        self.assertEqual(len(responses.calls), days_left_in_week)
+        [call] = responses.calls
+        self.assertEqual(len(json.loads(call.request.body)), days_left_in_week)
+
+    @responses.activate
+    @patch("subscriptions.tasks.now")
+    def test_fire_week_estimate_last_ranges(self, mock_now):
+        """
+        The estimates should include the subscriptions on every day in the
+        range of each schedule's days of the week, and only on the days of the
+        month and months of the year that the schedule runs on.
+        """
+        mock_now.return_value = datetime(2018, 10, 1, tzinfo=timezone.utc)
+        self.schedule.day_of_week = "1-5"
+        self.schedule.save()
+        self.make_subscription()
+        self.make_subscription()
+        # The first Monday of the month
+        self.schedule = Schedule.objects.create(day_of_week="1#1")
+        self.make_subscription()
+        # Only on the 3rd of the month
+        self.schedule = Schedule.objects.create(day_of_month="3")
+        self.make_subscription()
+        # Every day, but only in November
+        self.schedule = Schedule.objects.create(month_of_year="11")
+        self.make_subscription()
+
+        tasks.fire_week_estimate_last.apply_async()
+
+        [call] = responses.calls
+        self.assertEqual(
+            json.loads(call.request.body),
+            {
+                "subscriptions.send.estimate.0.last": 3.0,
+                "subscriptions.send.estimate.1.last": 2.0,
+                "subscriptions.send.estimate.2.last": 3.0,
+                "subscriptions.send.estimate.3.last": 2.0,
+                "subscriptions.send.estimate.4.last": 2.0,
+                "subscriptions.send.estimate.5.last": 0.0,
+                "subscriptions.send.estimate.6.last": 0.0,
+            },
+        )
 
 
 class TestDailySendEstimates(AuthenticatedAPITestCase):
-    def make_schedule_day(self, dow="*"):
+    def make_schedule(self):
+        # Create daily schedule
+        schedule_data = {"hour": 1, "minute": 0}
+        return Schedule.objects.create(**schedule_data)
+
+    def make_schedule_day(self, dow="*", **kwargs):
         # Create hourly schedule on a day specified
         schedule_data = {"hour": 1, "day_of_week": dow}
+        schedule_data.update(kwargs)
         return Schedule.objects.create(**schedule_data)
 
     def setUp(self):
@@ -2055,6 +2180,51 @@ class TestDailySendEstimates(AuthenticatedAPITestCase):
         )
         self.assertEqual(estimate.estimate_subscriptions, 2)
 
+    def test_fire_daily_send_estimate_cron_fields(self):
+        """
+        Only schedules that run today should be included, taking into account
+        day of week ranges and lists, the day of the month, and the month.
+        """
+        schedules = {
+            "1-5": (self.make_schedule_day("1-5"), True),
+            "0,1": (self.make_schedule_day("0,1"), True),
+            "2-5": (self.make_schedule_day("2-5"), False),
+            "1st": (self.make_schedule_day(day_of_month="1"), False),
+            "30th": (self.make_schedule_day(day_of_month="30"), True),
+            "Nov": (self.make_schedule_day(month_of_year="11"), False),
+        }
+        for schedule, _ in schedules.values():
+            sub = self.make_subscription()
+            sub.schedule = schedule
+            sub.save()
+
+        today = datetime(2017, 10, 30, tzinfo=timezone.utc)  # a Monday
+        with patch.object(tasks, "now", return_value=today):
+            tasks.fire_daily_send_estimate.apply()
+
+        [estimate] = EstimatedSend.objects.all()
+        self.assertEqual(
+            estimate.estimate_subscriptions,
+            len([runs for _, runs in schedules.values() if runs]),
+        )
+        self.assertEqual(estimate.estimate_identities, 1)
+
+    def test_fire_daily_send_estimate_rerun(self):
+        """
+        Running the estimate again on the same day should replace the
+        estimates.
+        """
+        self.make_subscription()
+
+        today = datetime(2017, 10, 30, tzinfo=timezone.utc)
+        with patch.object(tasks, "now", return_value=today):
+            tasks.fire_daily_send_estimate.apply()
+            self.make_subscription()
+            tasks.fire_daily_send_estimate.apply()
+
+        [estimate] = EstimatedSend.objects.all()
+        self.assertEqual(estimate.estimate_subscriptions, 2)
+
     def test_fire_daily_send_estimate_api(self):
         """
         Ensure that the send estimation task is executed when we post to the
@@ -2222,6 +2392,50 @@ class TestRemoveDuplicateSubscriptions(AuthenticatedAPITestCase):
         )
         self.assertEqual(Subscription.objects.count(), 1)
 
+    @responses.activate
+    def test_duplicate_removal_scheduler_error(self):
+        """
+        If deleting a scheduler schedule fails, the failure should be logged,
+        and the rest of the schedules should still be deleted.
+        """
+        responses.add(
+            responses.DELETE, "http://scheduler/schedule/schedule-id-2/", status=500
+        )
+        responses.add(responses.DELETE, "http://scheduler/schedule/schedule-id-3/")
+
+        subs = [self.make_subscription() for i in range(3)]
+        for i, sub in enumerate(subs):
+            sub.metadata["scheduler_schedule_id"] = "schedule-id-%d" % (i + 1)
+            sub.save()
+
+        stdout = StringIO()
+        call_command(
+            "remove_duplicate_subscriptions",
+            "--fix",
+            "--concurrency",
+            "1",
+            stdout=stdout,
+        )
+        lines = stdout.getvalue().strip().split("\n")
+        self.assertTrue(
+            lines[0].startswith("Failed to delete scheduler schedule schedule-id-2:")
+        )
+        self.assertEqual(
+            lines[1:],
+            [
+                "Removed 2 duplicate subscriptions.",
+                "Failed to delete 1 scheduler schedules.",
+            ],
+        )
+        self.assertEqual(
+            [call.request.url for call in responses.calls],
+            [
+                "http://scheduler/schedule/schedule-id-2/",
+                "http://scheduler/schedule/schedule-id-3/",
+            ],
+        )
+        self.assertEqual(Subscription.objects.count(), 1)
+
     @responses.activate
     def test_retain_duplicates_outside_time_delta(self):
 
@@ -2287,6 +2501,39 @@ class TestRemoveDuplicateSubscriptions(AuthenticatedAPITestCase):
         )
         self.assertEqual(Subscription.objects.count(), 1)
 
+    @responses.activate
+    def test_duplicate_removal_batches(self):
+        """
+        Duplicates should be deleted in batches, and only the first of each
+        group of duplicates kept.
+        """
+        subs = [self.make_subscription() for i in range(5)]
+        for i, sub in enumerate(subs):
+            sub.metadata["scheduler_schedule_id"] = "schedule-id-%s" % i
+            sub.save()
+            if i > 0:
+                responses.add(
+                    responses.DELETE, "http://scheduler/schedule/schedule-id-%s/" % i
+                )
+
+        stdout = StringIO()
+        call_command(
+            "remove_duplicate_subscriptions",
+            "--fix",
+            "--batch-size",
+            "2",
+            stdout=stdout,
+        )
+
+        self.assertEqual(
+            stdout.getvalue().strip(), "Removed 4 duplicate subscriptions."
+        )
+        self.assertEqual(list(Subscription.objects.all()), subs[:1])
+        self.assertEqual(
+            sorted(call.request.url for call in responses.calls),
+            ["http://scheduler/schedule/schedule-id-%s/" % i for i in range(1, 5)],
+        )
+
 
 class TestSubscription(AuthenticatedAPITestCase):
     def make_schedule(self):
@@ -3022,6 +3269,94 @@ class TestFixSubscriptionLifecycle(AuthenticatedAPITestCase):
         updated_sub = Subscription.objects.get(pk=sub2.id)
         self.assertEqual(updated_sub.next_sequence_number, 3)
 
+    def test_bulk_fast_forward(self):
+        """
+        Fast forwarding in bulk should make the same changes as fast
+        forwarding each subscription, including creating the subscriptions
+        for the next message sets.
+        """
+        for sequence in range(2):
+            Message.objects.create(
+                messageset=self.messageset_second,
+                sequence_number=sequence + 1,
+                lang="eng_ZA",
+                text_content="Second set message %s." % (sequence + 1),
+            )
+        self.make_subscription()
+        behind = []
+        for created_at in (datetime(2016, 1, 1), datetime(2016, 11, 15)):
+            sub = self.make_subscription()
+            sub.created_at = created_at.replace(tzinfo=pytz.UTC)
+            sub.save()
+            behind.append(sub)
+        end_date = datetime(2017, 1, 1, tzinfo=pytz.UTC)
+        expected = [
+            Subscription.fast_forward_lifecycle(
+                Subscription.objects.get(pk=sub.pk), end_date, save=False
+            )
+            for sub in behind
+        ]
+
+        stdout = StringIO()
+        call_command(
+            "fix_subscription_lifecycle",
+            "--action",
+            "fast_forward",
+            "--end_date",
+            "20170101",
+            "--bulk",
+            "--batch-size",
+            "1",
+            stdout=stdout,
+        )
+
+        lines = stdout.getvalue().strip().split("\n")
+        self.assertEqual(len(lines), 5)
+        # The rows aren't ordered, so the batches can be reported after any of
+        # the rows
+        self.assertIn(", fast forwarded 1, ", lines[0])
+        self.assertIn(", fast forwarded 2, ", lines[1])
+        self.assertEqual(
+            lines[2:],
+            [
+                "2 subscriptions behind schedule.",
+                "2 subscriptions fast forwarded to end date.",
+                "Message sent to 0 subscriptions.",
+            ],
+        )
+        fields = (
+            "messageset_id",
+            "schedule_id",
+            "next_sequence_number",
+            "created_at",
+            "active",
+            "completed",
+            "process_status",
+        )
+
+        def values(subs):
+            return [[getattr(sub, field) for field in fields] for sub in subs]
+
+        self.assertEqual(
+            values(Subscription.objects.get(pk=sub.pk) for sub in behind),
+            values(subs[0] for subs in expected),
+        )
+        created = Subscription.objects.filter(
+            created_at__lt=datetime(2017, 1, 1, tzinfo=pytz.UTC)
+        ).exclude(pk__in=[sub.pk for sub in behind])
+        self.assertEqual(created.count(), 1)
+        self.assertEqual(
+            values(created.order_by("created_at")),
+            values(
+                sorted(
+                    (sub for subs in expected for sub in subs[1:]),
+                    key=lambda sub: sub.created_at,
+                )
+            ),
+        )
+        # The schedule subscription counts should have been kept up to date
+        self.assertEqual(ScheduleSubscriptionCount.reconcile(), 0)
+
     def test_diff_action(self):
         stdout, stderr = StringIO(), StringIO()
 
@@ -3494,6 +3829,111 @@ class TestMarkInvalidSubscription(AuthenticatedAPITestCase):
         error = stdout.getvalue().strip()
         self.assertEqual(error, "hub-url and hub-token is required.")
 
+    @responses.activate
+    def test_mark_invalid_subscription_checkpoint(self):
+        """
+        The last processed subscription should be saved to the checkpoint
+        file, and the next run should resume after it.
+        """
+        responses.add(
+            responses.GET,
+            (
+                "http://seed-hub/api/v1/registrations/"
+                "?mother_id=8646b7bc-b511-4965-a90b-e1145e398703"
+            ),
+            json={"next": None, "previous": None, "results": []},
+            status=200,
+            content_type="application/json",
+            match_querystring=True,
+        )
+        responses.add(
+            responses.GET,
+            (
+                "http://seed-identity-store/api/v1/identities/"
+                "8646b7bc-b511-4965-a90b-e1145e398703/"
+            ),
+            json={
+                "id": "8646b7bc-b511-4965-a90b-e1145e398703",
+                "details": {"exclude_report": True},
+            },
+            status=200,
+            content_type="application/json",
+        )
+        subs = [self.make_subscription() for _ in range(3)]
+        Subscription.objects.update(process_status=5)
+        last_id = max(sub.id for sub in subs)
+
+        with tempfile.TemporaryDirectory() as directory:
+            checkpoint = os.path.join(directory, "checkpoint")
+            for _ in range(2):
+                stdout = StringIO()
+                call_command(
+                    "mark_invalid_subscriptions",
+                    "--hub-url",
+                    "http://seed-hub/api/v1/",
+                    "--hub-token",
+                    "HUBTOKEN",
+                    "--concurrency",
+                    "2",
+                    "--rate-limit",
+                    "1000",
+                    "--checkpoint",
+                    checkpoint,
+                    stdout=stdout,
+                )
+                with open(checkpoint) as f:
+                    self.assertEqual(f.read(), str(last_id))
+
+        self.assertEqual(
+            stdout.getvalue().strip(), "Updated 0 identities and 0 registrations."
+        )
+        # Both requests for the shared identity on the first run, none on the
+        # second
+        self.assertEqual(len(responses.calls), 2)
+
+    def test_mark_invalid_subscription_checkpoint_layout(self):
+        """
+        Checkpoints from a run with a different number of partitions
+        shouldn't be silently ignored.
+        """
+        with tempfile.TemporaryDirectory() as directory:
+            checkpoint = os.path.join(directory, "checkpoint")
+            with open(checkpoint + ".1-of-2", "w") as f:
+                f.write(str(uuid4()))
+
+            with self.assertRaisesRegex(CommandError, "with 2 partitions, not 1"):
+                call_command(
+                    "mark_invalid_subscriptions",
+                    "--hub-url",
+                    "http://seed-hub/api/v1/",
+                    "--hub-token",
+                    "HUBTOKEN",
+                    "--checkpoint",
+                    checkpoint,
+                )
+
+            # The same layout can be resumed
+            Command().check_checkpoints(checkpoint, 2)
+
+    @patch("subscriptions.management.commands.mark_invalid_subscriptions.RateLimiter")
+    def test_mark_invalid_subscription_rate_limit_workers(self, RateLimiter):
+        """
+        The rate limit should be shared between the worker processes
+        """
+        Command().handle_partition(
+            Partition(0, 4),
+            hub_url="http://seed-hub/api/v1/",
+            hub_token="HUBTOKEN",
+            identity_url="http://seed-identity-store/api/v1/",
+            identity_token="TOKEN",
+            hub_identity_field="mother_id",
+            concurrency=2,
+            rate_limit=100,
+            checkpoint=None,
+            workers=4,
+        )
+        RateLimiter.assert_called_once_with(25)
+
 
 class TestAddNotificationToSubscription(AuthenticatedAPITestCase):
     def test_noop(self):
@@ -4,7 +4,7 @@ from django.test import TestCase
 
 from contentstore.models import Message, MessageSet, Schedule
 from seed_stage_based_messaging import test_utils as utils
-from subscriptions.models import Subscription
+from subscriptions.models import ScheduleSubscriptionCount, Subscription
 
 
 class SubscriptionTest(TestCase):
@@ -66,3 +66,153 @@ class SubscriptionTest(TestCase):
         # Should be on second message of 3rd set, so 3 messages behind
         end = datetime(2018, 1, 1, 4, 0, 0)
         self.assertEqual(sub.messages_behind(end), 3)
+
+
+class ScheduleSubscriptionCountTest(TestCase):
+    def setUp(self):
+        utils.disable_signals()
+        self.schedule = Schedule.objects.create(minute="0")
+        self.other_schedule = Schedule.objects.create(minute="30")
+        self.messageset = MessageSet.objects.create(
+            default_schedule=self.schedule, short_name="counts"
+        )
+
+    def tearDown(self):
+        utils.enable_signals()
+
+    def make_subscription(self, **kwargs):
+        return Subscription.objects.create(
+            identity="8646b7bc-b511-4965-a90b-e1145e398703",
+            messageset=self.messageset,
+            schedule=self.schedule,
+            lang="eng_ZA",
+            **kwargs
+        )
+
+    def assertCounts(self, expected):
+        self.assertEqual(
+            dict(
+                ScheduleSubscriptionCount.objects.exclude(count=0).values_list(
+                    "schedule_id", "count"
+                )
+            ),
+            expected,
+        )
+
+    def test_counts_maintained(self):
+        """
+        The count of each schedule should follow its subscriptions as they
+        are created, completed, deactivated, rescheduled, and deleted.
+        """
+        first = self.make_subscription()
+        second = self.make_subscription()
+        self.make_subscription(active=False)
+        self.assertCounts({self.schedule.id: 2})
+
+        second.schedule = self.other_schedule
+        second.save()
+        self.assertCounts({self.schedule.id: 1, self.other_schedule.id: 1})
+
+        first.mark_as_complete()
+        second = Subscription.objects.get(id=second.id)
+        second.active = False
+        second.save()
+        self.assertCounts({})
+
+        second.active = True
+        second.save()
+        second.delete()
+        self.assertCounts({})
+
+    def test_errored_not_counted(self):
+        """
+        Subscriptions that aren't ready to be sent to shouldn't be counted,
+        until they are ready again.
+        """
+        self.make_subscription(process_status=-1)
+        subscription = self.make_subscription()
+        self.assertCounts({self.schedule.id: 1})
+
+        subscription.process_status = -1
+        subscription.save()
+        self.assertCounts({})
+
+        subscription.process_status = 0
+        subscription.save()
+        self.assertCounts({self.schedule.id: 1})
+        self.assertEqual(ScheduleSubscriptionCount.reconcile(), 0)
+
+    def test_unchanged_save(self):
+        """
+        Saving a subscription without changing the fields that the counts
+        depend on shouldn't touch the counts.
+        """
+        subscription = self.make_subscription()
+        subscription = Subscription.objects.get(id=subscription.id)
+        subscription.lang = "eng_UG"
+        with self.assertNumQueries(1):
+            subscription.save()
+
+        subscription.active = False
+        with self.assertNumQueries(1):
+            subscription.save(update_fields=["lang"])
+        self.assertCounts({self.schedule.id: 1})
+
+    def test_never_negative(self):
+        """
+        Removing subscriptions that weren't counted shouldn't take the count
+        below zero, or create a negative count.
+        """
+        ScheduleSubscriptionCount.adjust({self.schedule.id: -1})
+        self.assertFalse(ScheduleSubscriptionCount.objects.exists())
+
+        ScheduleSubscriptionCount.adjust({self.schedule.id: 1})
+        ScheduleSubscriptionCount.adjust({self.schedule.id: -2})
+        self.assertEqual(
+            ScheduleSubscriptionCount.objects.get(schedule=self.schedule).count, 0
+        )
+
+    def test_stale_instance(self):
+        """
+        An instance loaded before a queryset update doesn't know about the
+        update, so saving it can make the counts drift, until they're
+        reconciled.
+        """
+        subscription = self.make_subscription()
+        stale = Subscription.objects.get(id=subscription.id)
+        Subscription.objects.filter(id=subscription.id).update(process_status=-1)
+        ScheduleSubscriptionCount.adjust({self.schedule.id: -1})
+        self.assertCounts({})
+
+        # This saves the stale process_status of 0 over the update
+        stale.lang = "eng_UG"
+        stale.save()
+        self.assertCounts({})
+
+        self.assertEqual(ScheduleSubscriptionCount.reconcile(), 1)
+        self.assertCounts({self.schedule.id: 1})
+
+    def test_deferred_fields(self):
+        """
+        Subscriptions loaded without the fields that the counts depend on
+        shouldn't change the counts when they are saved.
+        """
+        subscription = self.make_subscription()
+        subscription = Subscription.objects.only("id", "lang").get()
+        subscription.lang = "eng_UG"
+        subscription.save()
+        self.assertCounts({self.schedule.id: 1})
+
+    def test_reconcile(self):
+        """
+        Reconciling should correct the counts that have drifted, and return
+        how many were wrong.
+        """
+        self.make_subscription()
+        self.make_subscription()
+        Subscription.objects.update(schedule=self.other_schedule)
+        self.assertCounts({self.schedule.id: 2})
+
+        self.assertEqual(ScheduleSubscriptionCount.reconcile(), 2)
+        self.assertCounts({self.other_schedule.id: 2})
+        self.assertEqual(ScheduleSubscriptionCount.reconcile(), 0)